@@ -0,0 +1,34 @@
+# Normalisation d'un arrière-plan image à l'import : taille du fichier et durée de
+# génération d'une page A5 avec l'original puis avec l'image retenue par
+# normalize_background_image (l'original quand la variante n'est pas plus petite).
+# Usage : python benchmarks/bench_background_image.py [image] [dpi]
+import os, sys, io, time, shutil, tempfile
+from reportlab.pdfgen import canvas
+from reportlab.lib.pagesizes import A5
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import main
+
+def render_ms(path, repeat=5):
+    # Page A5 avec l'image en plein format, sans le cache d'images de l'application
+    start = time.perf_counter()
+    for _ in range(repeat):
+        c = canvas.Canvas(io.BytesIO(), pagesize=A5)
+        c.drawImage(path, 0, 0, width=A5[0], height=A5[1])
+        c.save()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+if __name__ == "__main__":
+    source = sys.argv[1] if len(sys.argv) > 1 else os.path.join(ROOT, "MEDICSAS_FILES", "Background", "Arriere_plans_et_logos.png")
+    dpi = int(sys.argv[2]) if len(sys.argv) > 2 else main.BACKGROUND_DPI
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, os.path.basename(source))
+        shutil.copy(source, path)
+        start = time.perf_counter()
+        processed = main.normalize_background_image(path, dpi)
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"{os.path.basename(source)} à {dpi} DPI : traitement {elapsed:.0f} ms, "
+              f"{'variante ' + os.path.basename(processed) if processed != path else 'original conservé'}")
+        print(f"  taille : {os.path.getsize(path) / 1024:.0f} Ko → {os.path.getsize(processed) / 1024:.0f} Ko")
+        print(f"  génération d'une page : {render_ms(path):.0f} ms → {render_ms(processed):.0f} ms")
@@ -0,0 +1,80 @@
+# Mesure de la mise à jour d'un commentaire dans un classeur de N lignes (50 000 par défaut) :
+# masque + réécriture complète (ancien comportement) / journal des commentaires indexé,
+# puis coût de la fusion à la lecture et de l'intégration au classeur.
+# Usage : python benchmarks/bench_comment_update.py [lignes] [mises_a_jour]
+import os, sys, time, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pandas as pd
+import main
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    updates = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    with tempfile.TemporaryDirectory() as folder:
+        main.EXCEL_FILE_PATH = os.path.join(folder, "ConsultationData.xlsx")
+        main.PATCH_FILE_PATH = os.path.join(folder, "ConsultationData.patches.jsonl")
+        main.TOMBSTONE_FILE_PATH = os.path.join(folder, "ConsultationData.tombstones.jsonl")
+        main.SNAPSHOT_FILE_PATH = os.path.join(folder, "ConsultationData.snapshot.pkl")
+        store = main.ExcelConsultationStore()
+
+        # Identifiants vides ou en double : un commentaire « patient » atteint toutes ses lignes
+        check = pd.DataFrame([{col: f"{col}-{i}" for col in main.CONSULTATION_COLUMNS} for i in range(10)])
+        check["patient_id"] = "P0"
+        check["doctor_comment"] = [f"c{i}" for i in range(10)]
+        check.loc[[1, 4, 6], "consultation_id"] = None
+        check.loc[8, "consultation_id"] = "consultation_id-2"
+        main.write_excel_atomic(check, main.EXCEL_FILE_PATH)
+        main.invalidate_frame_cache()
+        store.set_patient_comment("P0", "tous")
+        assert (store.read_all()["doctor_comment"] == "tous").all(), "lignes du patient non mises à jour"
+        main.remove_side_file(main.PATCH_FILE_PATH)
+        print("identifiants vides ou en double : commentaire appliqué aux 10 lignes")
+
+        df = pd.DataFrame([{col: f"{col}-{i}" for col in main.CONSULTATION_COLUMNS} for i in range(rows)])
+        df["patient_id"] = [f"P{i % (rows // 5)}" for i in range(rows)]  # 5 consultations par patient
+        start = time.perf_counter()
+        main.write_excel_atomic(df, main.EXCEL_FILE_PATH)
+        print(f"classeur de {rows} lignes écrit en {time.perf_counter() - start:.1f} s")
+        main.invalidate_frame_cache()
+        start = time.perf_counter()
+        store.read_all()
+        store.consultation_index()
+        store.patient_index()
+        print(f"lecture et index : {time.perf_counter() - start:.1f} s")
+
+        # Ancien comportement : masque sur tout le tableau puis réécriture du classeur
+        start = time.perf_counter()
+        current = store.read_rows().copy()
+        current.loc[current["patient_id"].astype(str) == "P1", "doctor_comment"] = "ancien"
+        main.write_excel_atomic(current, main.EXCEL_FILE_PATH)
+        rewrite = time.perf_counter() - start
+        main.invalidate_frame_cache(main.EXCEL_FILE_PATH)
+        store.read_all()
+        store.consultation_index()
+        store.patient_index()
+
+        start = time.perf_counter()
+        for i in range(updates):
+            store.set_consultation_comment(f"consultation_id-{100 + i * 7}", f"ciblé {i}")
+        targeted = (time.perf_counter() - start) / updates
+        start = time.perf_counter()
+        for i in range(updates):
+            store.set_patient_comment(f"P{i}", f"patient {i}")
+        patient = (time.perf_counter() - start) / updates
+
+        start = time.perf_counter()
+        live = store.read_all()
+        merge = time.perf_counter() - start
+        assert live["doctor_comment"].iloc[107] == "ciblé 1" and live["doctor_comment"].iloc[3] == "patient 3"
+
+        start = time.perf_counter()
+        store.write_all(store.read_rows())
+        fold = time.perf_counter() - start
+
+        print(f"réécriture complète : {rewrite * 1000:.0f} ms / mise à jour")
+        print(f"journal, par consultation : {targeted * 1000:.2f} ms / mise à jour (gain x{rewrite / targeted:.0f})")
+        print(f"journal, par patient : {patient * 1000:.2f} ms / mise à jour (gain x{rewrite / patient:.0f})")
+        print(f"fusion de {2 * updates} mise(s) à jour à la lecture : {merge * 1000:.0f} ms")
+        print(f"intégration au classeur (prochaine réécriture) : {fold:.1f} s, journal restant : "
+              f"{os.path.exists(main.PATCH_FILE_PATH)}")
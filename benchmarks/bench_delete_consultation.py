@@ -0,0 +1,46 @@
+# Mesure de la suppression d'une consultation dans un classeur de N lignes : réécriture
+# complète (ancien comportement) / pierre tombale, puis coût de la compaction.
+# Usage : python benchmarks/bench_delete_consultation.py [lignes] [suppressions]
+import os, sys, time, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pandas as pd
+import main
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    deletes = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    with tempfile.TemporaryDirectory() as folder:
+        main.EXCEL_FILE_PATH = os.path.join(folder, "ConsultationData.xlsx")
+        main.TOMBSTONE_FILE_PATH = os.path.join(folder, "ConsultationData.tombstones.jsonl")
+        main.SNAPSHOT_FILE_PATH = os.path.join(folder, "ConsultationData.snapshot.pkl")
+        main.PATCH_FILE_PATH = os.path.join(folder, "ConsultationData.patches.jsonl")
+        main.TOMBSTONE_COMPACT_MIN = rows  # compaction déclenchée à la main ci-dessous
+        df = pd.DataFrame([{col: f"{col}-{i}" for col in main.CONSULTATION_COLUMNS} for i in range(rows)])
+        main.write_excel_atomic(df, main.EXCEL_FILE_PATH)
+        store = main.ExcelConsultationStore()
+        store.read_all()
+        store.consultation_index()
+
+        start = time.perf_counter()
+        for i in range(deletes):
+            current = store.read_all()
+            store.write_all(current[current["consultation_id"] != f"consultation_id-{i}"])
+        rewrite = (time.perf_counter() - start) / deletes
+        store.consultation_index()  # index reconstruit une fois après les réécritures
+
+        start = time.perf_counter()
+        for i in range(deletes, 2 * deletes):
+            store.delete(f"consultation_id-{i}")
+        tombstone = (time.perf_counter() - start) / deletes
+        remaining = len(store.read_all())
+
+        start = time.perf_counter()
+        compacted = store.compact(grace=0)  # sans attendre le délai d'annulation
+        compaction = time.perf_counter() - start
+
+        print(f"{rows} lignes : réécriture {rewrite * 1000:.1f} ms / suppression, "
+              f"pierre tombale {tombstone * 1000:.2f} ms / suppression "
+              f"(gain x{rewrite / tombstone:.0f}), {remaining} lignes visibles")
+        print(f"compaction de {compacted} suppression(s) : {compaction * 1000:.0f} ms, "
+              f"{len(store.read_rows())} lignes dans le classeur")
@@ -0,0 +1,47 @@
+# Découpage des lignes des certificats : ancien algorithme (stringWidth sur toute la ligne
+# à chaque mot) contre break_lines (largeurs des mots en cache, largeur cumulée), sur les
+# textes de certificate_categories, avec vérification que le découpage est identique.
+# Usage : python benchmarks/bench_line_breaking.py [répétitions]
+import os, sys, time
+from reportlab.lib.pagesizes import A5
+from reportlab.pdfbase import pdfmetrics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+MAX_WIDTH = A5[0] - 56.7 * 2
+
+def legacy_break(paragraph, max_width):
+    lines = []
+    current_line = ""
+    for word in paragraph.split():
+        test_line = f"{current_line} {word}".strip()
+        if pdfmetrics.stringWidth(test_line, "Helvetica", 10) <= max_width:
+            current_line = test_line
+        else:
+            lines.append(current_line)
+            current_line = word
+    lines.append(current_line)
+    return lines
+
+def new_break(paragraph, max_width):
+    return [line for line, _ in main.break_lines(paragraph.split(), max_width, "Helvetica", 10)]
+
+def run(break_func, paragraphs, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for paragraph in paragraphs:
+            break_func(paragraph, MAX_WIDTH)
+    return (time.perf_counter() - start) / repeats * 1000
+
+if __name__ == "__main__":
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    texts = list(main.certificate_categories.values())
+    paragraphs = [p for text in texts for p in text.splitlines()]
+    long_paragraphs = [" ".join(texts)]  # Un certificat très long : cas quadratique de l'ancien code
+    mismatches = sum(legacy_break(p, MAX_WIDTH) != new_break(p, MAX_WIDTH) for p in paragraphs + long_paragraphs)
+    print(f"{len(texts)} certificats, {len(paragraphs)} paragraphes, découpages différents : {mismatches}")
+    for label, data in (("certificats", paragraphs), ("texte concaténé", long_paragraphs)):
+        legacy_ms = run(legacy_break, data, repeats)
+        new_ms = run(new_break, data, repeats)
+        print(f"{label:<16} ancien {legacy_ms:8.2f} ms | break_lines {new_ms:8.2f} ms | gain {legacy_ms / new_ms:5.1f}x")
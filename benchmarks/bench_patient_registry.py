@@ -0,0 +1,104 @@
+# Mesure mémoire du registre des patients : 14 dictionnaires parallèles (ancien code)
+# contre PatientRegistry (un PatientRecord à __slots__ par patient), fiches seules puis avec
+# l'index de recherche (PatientSearchIndex, absent de l'ancien code) préparé en
+# arrière-plan après le chargement. Mesure aussi la latence d'une recherche par nom juste
+# après le chargement et pendant un rechargement complet (mise à jour de l'index en place).
+# Usage : python benchmarks/bench_patient_registry.py [nombre_de_patients]
+import os, sys, time, random, tracemalloc
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+def make_patients(n):
+    rng = random.Random(42)
+    first = ["Ali", "Fatima", "Youssef", "Khadija", "Omar", "Salma", "Karim", "Nadia"]
+    last = ["Benali", "El Idrissi", "Alaoui", "Berrada", "Tazi", "Chraibi", "Fassi", "Bennani"]
+    return pd.DataFrame({
+        "patient_id": [f"P{i:06d}" for i in range(n)],
+        "patient_name": [f"{rng.choice(first)} {rng.choice(last)} {i}" for i in range(n)],
+        "age": [f"{rng.randint(0, 90)} ans" for _ in range(n)],
+        "patient_phone": [f"06{rng.randint(10000000, 99999999)}" for _ in range(n)],
+        "antecedents": [rng.choice(["", "HTA", "Diabète type 2", "Asthme"]) for _ in range(n)],
+        "date_of_birth": [f"{rng.randint(1930, 2024)}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}" for _ in range(n)],
+        "gender": [rng.choice(["Masculin", "Féminin"]) for _ in range(n)],
+    })
+
+def build_legacy(df):
+    df = df.copy()
+    for col in ["patient_id", "patient_name", "date_of_birth", "gender"]:
+        df[col] = df[col].astype(str)
+    structures = [
+        sorted(df['patient_id'].unique().tolist(), key=str.lower),
+        sorted(df['patient_name'].unique().tolist(), key=str.lower),
+    ]
+    for key in ("patient_id", "patient_name"):
+        other = "patient_name" if key == "patient_id" else "patient_id"
+        structures.append(dict(zip(df[key], df[other])))
+        for col in ["age", "patient_phone", "antecedents", "date_of_birth", "gender"]:
+            structures.append(dict(zip(df[key], df[col])))
+    return structures
+
+class RecordsOnly(main.PatientRegistry):
+    # Registre sans index de recherche : seules les fiches sont mesurées
+    def refresh_search_index(self):
+        pass
+
+def build_records(df):
+    registry = RecordsOnly()
+    registry.update_from_frame(df)
+    return registry
+
+def build_registry(df):
+    # Chargement puis attente de l'index préparé en arrière-plan
+    registry = main.PatientRegistry()
+    registry.update_from_frame(df)
+    wait_for_index(registry)
+    return registry
+
+def wait_for_index(registry):
+    thread = registry._search_thread
+    if thread is not None:
+        thread.join()
+
+def search_ms(registry):
+    start = time.perf_counter()
+    registry.suggest("name", "Benali")
+    return (time.perf_counter() - start) * 1000
+
+def measure(builder, df):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = builder(df)
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, elapsed
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    df = make_patients(n)
+    _, legacy_bytes, legacy_time = measure(build_legacy, df)
+    _, records_bytes, records_time = measure(build_records, df)
+    registry, total_bytes, total_time = measure(build_registry, df)
+
+    # Recherche juste après le chargement (index encore en préparation)
+    fresh = main.PatientRegistry()
+    fresh.update_from_frame(df)
+    first_ms = search_ms(fresh)
+    # Rechargement complet (import, paramètres) : l'index existant reste servi pendant sa mise à jour
+    start = time.perf_counter()
+    registry.update_from_frame(df, replace=True)
+    reload_search_ms = search_ms(registry)
+    wait_for_index(registry)
+    sync_time = time.perf_counter() - start
+
+    print(f"{n} patients")
+    print(f"  14 dictionnaires + 2 listes : {legacy_bytes / 1e6:8.1f} Mo  ({legacy_time:.2f} s)")
+    print(f"  PatientRegistry, fiches     : {records_bytes / 1e6:8.1f} Mo  ({records_time:.2f} s), "
+          f"{100 * (records_bytes / legacy_bytes - 1):+.0f} % par rapport à l'ancien code")
+    print(f"  fiches + index de recherche : {total_bytes / 1e6:8.1f} Mo  ({total_time:.2f} s), "
+          f"{100 * (total_bytes / legacy_bytes - 1):+.0f} % par rapport à l'ancien code")
+    print(f"  recherche juste après chargement : {first_ms:.0f} ms (attend la première construction)")
+    print(f"  recherche pendant un rechargement : {reload_search_ms:.1f} ms, "
+          f"index mis à jour en place en {sync_time:.2f} s")
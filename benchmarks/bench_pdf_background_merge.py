@@ -0,0 +1,68 @@
+# Fusion avec un arrière-plan PDF : ancien code (PdfReader relu + deepcopy de la page de
+# fond pour chaque page) contre merge_with_background_pdf (fond lu une fois, XObject partagé,
+# fusion en mémoire), pour des documents de 1, 5 et 50 pages.
+# Usage : python benchmarks/bench_pdf_background_merge.py [répétitions]
+import os, sys, io, copy, time, tempfile
+from reportlab.pdfgen import canvas
+from reportlab.lib.pagesizes import A5
+from PyPDF2 import PdfReader, PdfWriter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import main
+
+def make_background(path):
+    c = canvas.Canvas(path, pagesize=A5)
+    image = os.path.join(ROOT, "MEDICSAS_FILES", "Background", "Arriere_plans_et_logos.png")
+    if os.path.exists(image):
+        c.drawImage(image, 0, 0, width=A5[0], height=A5[1])
+    c.setFont("Helvetica-Bold", 18)
+    c.drawCentredString(A5[0] / 2, A5[1] - 60, "Cabinet médical")
+    c.save()
+
+def make_foreground(pages):
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer, pagesize=A5)
+    for i in range(pages):
+        c.setFont("Helvetica", 10)
+        for line in range(30):
+            c.drawString(56.7, 450 - line * 12, f"Page {i + 1} - ligne {line + 1}")
+        c.showPage()
+    c.save()
+    return buffer.getvalue()
+
+def legacy_merge(background_path, foreground_path):
+    bg_reader = PdfReader(background_path)
+    fg_reader = PdfReader(foreground_path)
+    writer = PdfWriter()
+    num_bg_pages = len(bg_reader.pages)
+    for i in range(len(fg_reader.pages)):
+        bg_page = copy.deepcopy(bg_reader.pages[i] if i < num_bg_pages else bg_reader.pages[-1])
+        bg_page.merge_page(fg_reader.pages[i])
+        writer.add_page(bg_page)
+    with open(foreground_path, "wb") as f_out:
+        writer.write(f_out)
+
+if __name__ == "__main__":
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    with tempfile.TemporaryDirectory() as tmp:
+        background_path = os.path.join(tmp, "fond.pdf")
+        output_path = os.path.join(tmp, "ordonnance.pdf")
+        make_background(background_path)
+        main.background_file = background_path
+        for pages in (1, 5, 50):
+            foreground = make_foreground(pages)
+            results = {}
+            for label in ("ancien", "nouveau"):
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    if label == "ancien":
+                        with open(output_path, "wb") as f:
+                            f.write(foreground)
+                        legacy_merge(background_path, output_path)
+                    else:
+                        main.merge_with_background_pdf(io.BytesIO(foreground), output_path)
+                results[label] = ((time.perf_counter() - start) / repeats * 1000, os.path.getsize(output_path))
+            (old_ms, old_size), (new_ms, new_size) = results["ancien"], results["nouveau"]
+            print(f"{pages:>3} pages : ancien {old_ms:8.1f} ms {old_size / 1024:9.0f} Ko | "
+                  f"nouveau {new_ms:8.1f} ms {new_size / 1024:9.0f} Ko")
@@ -0,0 +1,46 @@
+# Mesure des lectures du classeur des consultations au démarrage (registre des patients)
+# et après une écriture : lecture complète non typée (ancien comportement), lecture
+# typée unique qui produit l'instantané en colonnes, puis relectures depuis l'instantané.
+# Usage : python benchmarks/bench_startup_reads.py [lignes]
+import os, sys, time, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pandas as pd
+import main
+
+def timed(action):
+    start = time.perf_counter()
+    result = action()
+    return result, (time.perf_counter() - start) * 1000
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    with tempfile.TemporaryDirectory() as folder:
+        main.EXCEL_FILE_PATH = os.path.join(folder, "ConsultationData.xlsx")
+        main.SNAPSHOT_FILE_PATH = os.path.join(folder, "ConsultationData.snapshot.pkl")
+        main.TOMBSTONE_FILE_PATH = os.path.join(folder, "ConsultationData.tombstones.jsonl")
+        main.PATCH_FILE_PATH = os.path.join(folder, "ConsultationData.patches.jsonl")
+        main.CONSULTATION_STORAGE = "excel"
+        df = pd.DataFrame([{col: f"{col}-{i}" for col in main.CONSULTATION_COLUMNS} for i in range(rows)])
+        df["age"] = [i % 90 for i in range(rows)]
+        main.write_excel_atomic(df, main.EXCEL_FILE_PATH)
+
+        _, full = timed(lambda: pd.read_excel(main.EXCEL_FILE_PATH, sheet_name=0))
+        _, cold = timed(main.read_consultation_workbook)
+        main.invalidate_frame_cache()
+        _, startup = timed(main.load_patient_data)
+        main.invalidate_frame_cache()
+        _, route = timed(lambda: main.consultation_store().read_patient("patient_id-7"))
+
+        # Après une écriture par l'application, l'instantané est réécrit avec le classeur
+        store = main.consultation_store()
+        store.write_all(store.read_rows())
+        _, after_write = timed(store.read_all)
+
+        print(f"{rows} lignes :")
+        print(f"  lecture complète non typée (ancien démarrage) : {full:.0f} ms")
+        print(f"  lecture complète typée + instantané            : {cold:.0f} ms")
+        print(f"  load_patient_data() avec instantané            : {startup:.0f} ms")
+        print(f"  première lecture d'une route avec instantané   : {route:.0f} ms")
+        print(f"  relecture après écriture par l'application     : {after_write:.0f} ms")
+        print(f"  instantané : {os.path.getsize(main.SNAPSHOT_FILE_PATH) // 1024} Ko, {main.snapshot_stats}")
@@ -0,0 +1,40 @@
+# Rendu de la page principale : render_template_string (gabarit recompilé à chaque
+# requête, ancien code) contre render_template sur le gabarit précompilé "main.html".
+# Usage : python benchmarks/bench_template_render.py [nombre_de_rendus]
+import os, sys, time
+from datetime import datetime
+from flask import render_template, render_template_string
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+def page_context():
+    return dict(
+        config=main.load_config(),
+        current_date=datetime.now().strftime("%d/%m/%Y"),
+        medications_options=main.default_medications_options,
+        analyses_options=main.default_analyses_options,
+        radiologies_options=main.default_radiologies_options,
+        certificate_categories=main.certificate_categories,
+        default_certificate_text=main.default_certificate_text,
+        host_address=f"http://{main.LOCAL_IP}:3000",
+        saved_medications=[],
+        saved_analyses=[],
+        saved_radiologies=[],
+    )
+
+def timed(label, render, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        html = render()
+    elapsed = (time.perf_counter() - start) / n * 1000
+    print(f"{label:<40} {elapsed:8.2f} ms/page  ({len(html)} octets)")
+    return elapsed
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    ctx = page_context()
+    with main.app.test_request_context("/"):
+        legacy = timed("render_template_string (recompilé)", lambda: render_template_string(main.main_template, **ctx), n)
+        compiled = timed("render_template (précompilé)", lambda: render_template("main.html", **ctx), n)
+    print(f"Gain : {legacy / compiled:.1f}x")
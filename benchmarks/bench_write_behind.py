@@ -0,0 +1,99 @@
+# Mesure de la file d'écriture différée : N sessions enregistrent des consultations en même
+# temps (heure de pointe) ; comparaison écriture directe / file regroupant les mutations.
+# Usage : python benchmarks/bench_write_behind.py [sessions] [enregistrements_par_session] [excel|journal|sqlite]
+import os, sys, time, tempfile, threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+def run(folder, storage, sessions, saves, write_behind):
+    main.EXCEL_FILE_PATH = os.path.join(folder, f"ConsultationData.{int(write_behind)}.xlsx")
+    main.JOURNAL_FILE_PATH = os.path.join(folder, f"ConsultationData.{int(write_behind)}.journal.jsonl")
+    main.SQLITE_FILE_PATH = os.path.join(folder, f"ConsultationData.{int(write_behind)}.sqlite3")
+    main.SNAPSHOT_FILE_PATH = os.path.join(folder, f"ConsultationData.{int(write_behind)}.snapshot.pkl")
+    main.TOMBSTONE_FILE_PATH = os.path.join(folder, f"ConsultationData.{int(write_behind)}.tombstones.jsonl")
+    main.PATCH_FILE_PATH = os.path.join(folder, f"ConsultationData.{int(write_behind)}.patches.jsonl")
+    main.DEADLETTER_FILE_PATH = os.path.join(folder, f"ConsultationData.{int(write_behind)}.deadletter.jsonl")
+    main.CONSULTATION_STORAGE = storage
+    main.CONSULTATION_WRITE_BEHIND = write_behind
+    before = main.consultation_writer.health()
+
+    def session(session_id):
+        for i in range(saves):
+            row = {col: "" for col in main.CONSULTATION_COLUMNS}
+            row.update(consultation_id=f"s{session_id}-{i}", patient_id=f"P{session_id}",
+                       patient_name=f"Patient {session_id}", consultation_date="2024-01-01")
+            main.submit_consultation_mutation("append", row)
+
+    threads = [threading.Thread(target=session, args=(n,)) for n in range(sessions)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    accepted = time.perf_counter() - start
+    main.flush_consultation_writes()
+    durable = time.perf_counter() - start
+    after = main.consultation_writer.health()
+    found = main.consultation_store().read_all()["consultation_id"].nunique()
+    batches = after["batches"] - before["batches"]
+    label = "file différée" if write_behind else "écriture directe"
+    print(f"{label:17s}: {found}/{sessions * saves} consultations, acceptées en {accepted * 1000:.0f} ms, "
+          f"sur disque en {durable * 1000:.0f} ms" + (f", {batches} lot(s)" if write_behind else ""))
+
+# Commentaire « patient » passé par la file après des ajouts du même lot, dont des
+# consultations sans identifiant (modes classeur ; SQLite impose un identifiant unique) :
+# toutes les lignes déjà enregistrées du patient le reçoivent
+def check_patient_comment(storage):
+    for i in range(4):
+        row = {col: "" for col in main.CONSULTATION_COLUMNS}
+        row.update(consultation_id="" if i % 2 and storage != "sqlite" else f"c{i}", patient_id="PC",
+                   patient_name="Patient C", consultation_date="2024-01-01", doctor_comment=f"c{i}")
+        main.submit_consultation_mutation("append", row)
+    main.submit_consultation_mutation("comment", "PC", "vu")
+    main.flush_consultation_writes()
+    comments = main.consultation_store().read_patient("PC")["doctor_comment"].tolist()
+    assert comments == ["vu"] * 4, comments
+    print("commentaire patient via la file : appliqué aux 4 lignes")
+
+# Mutations qui échouent à chaque tentative : mises de côté (un ajout mis de côté ne laisse
+# pas son patient dans le registre), puis les mutations suivantes sont de nouveau regroupées
+def check_batching_after_quarantine():
+    apply_batch, attempts = main.apply_consultation_batch, main.WRITE_BEHIND_MAX_ATTEMPTS
+    def failing(mutations):
+        if any(m[0] == "comment" and m[1] == "poison" or m[0] == "append" and m[1]["consultation_id"] == "poison"
+               for m in mutations):
+            raise ValueError("mutation empoisonnée")
+        apply_batch(mutations)
+    main.apply_consultation_batch, main.WRITE_BEHIND_MAX_ATTEMPTS = failing, 1
+    try:
+        # Dans un lot de plusieurs mutations : le lot est rejoué une mutation à la fois
+        for patient_id in ("P0", "poison", "P1"):
+            main.submit_consultation_mutation("comment", patient_id, "x")
+        # Ajout mis de côté : le patient n'entre pas dans le registre
+        row = {col: "" for col in main.CONSULTATION_COLUMNS}
+        row.update(consultation_id="poison", patient_id="PPOISON", patient_name="Patient jamais enregistré")
+        main.submit_consultation_mutation("append", row)
+        main.flush_consultation_writes()
+        assert main.patient_registry.get("PPOISON") is None, "patient d'un ajout mis de côté dans le registre"
+        before = main.consultation_writer.health()
+        assert before["dead_letters"] >= 1, before
+        for i in range(10):
+            main.submit_consultation_mutation("comment", f"Q{i}", "x")
+            time.sleep(0.02)
+        main.flush_consultation_writes()
+        batches = main.consultation_writer.health()["batches"] - before["batches"]
+    finally:
+        main.apply_consultation_batch, main.WRITE_BEHIND_MAX_ATTEMPTS = apply_batch, attempts
+    assert batches <= 2, f"{batches} lots pour 10 mutations après une mise de côté"
+    print(f"après des mutations mises de côté : 10 mutations en {batches} lot(s), registre des patients intact")
+
+if __name__ == "__main__":
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    saves = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    storage = sys.argv[3] if len(sys.argv) > 3 else "excel"
+    with tempfile.TemporaryDirectory() as folder:
+        run(folder, storage, sessions, saves, write_behind=False)
+        run(folder, storage, sessions, saves, write_behind=True)
+        check_patient_comment(storage)
+        check_batching_after_quarantine()
@@ -0,0 +1,64 @@
+# Contrôle de non-régression de l'arrière-plan image des PDF : la réutilisation de l'image
+# déjà encodée (apply_background) repose sur des internes de ReportLab. Après une mise à
+# jour de ReportLab, vérifie qu'elle est toujours active, que chaque document ne contient
+# qu'une seule image (drawImage n'en a pas encodé une seconde) et que le rendu est le même
+# qu'avec l'API publique seule.
+# Usage : python benchmarks/check_pdf_background_reuse.py [documents]
+import os, sys, io, time
+from reportlab.pdfgen import canvas
+from reportlab.lib.pagesizes import A5
+from PyPDF2 import PdfReader
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import main
+
+def render(pages=3):
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer, pagesize=A5)
+    for i in range(pages):
+        main.apply_background(c, *A5)
+        c.drawString(56.7, 400, f"Page {i + 1}")
+        c.showPage()
+    c.save()
+    return buffer.getvalue()
+
+def images(pdf_bytes):
+    found = {}
+    for page in PdfReader(io.BytesIO(pdf_bytes)).pages:
+        for form in page["/Resources"]["/XObject"].values():
+            for xobject in form.get_object()["/Resources"]["/XObject"].values():
+                xobject = xobject.get_object()
+                if xobject["/Subtype"] == "/Image":
+                    found[xobject.indirect_reference.idnum] = xobject.get_data()
+    return list(found.values())
+
+def timed(documents):
+    render()
+    start = time.perf_counter()
+    for _ in range(documents):
+        output = render()
+    return output, (time.perf_counter() - start) / documents * 1000
+
+if __name__ == "__main__":
+    documents = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    main.background_file = os.path.join(ROOT, "MEDICSAS_FILES", "Background", "Arriere_plans_et_logos.png")
+    if not main.background_image_path():
+        sys.exit(f"Image d'arrière-plan introuvable : {main.background_file}")
+    reused, reused_ms = timed(documents)
+    active = main._background_image_reuse
+    main._background_image_reuse = False
+    public, public_ms = timed(documents)
+    print(f"ReportLab {main.reportlab.Version} : réutilisation {'active' if active else 'désactivée'}")
+    print(f"  image réutilisée : {reused_ms:.1f} ms / document, API publique seule : {public_ms:.1f} ms / document")
+    errors = []
+    if not active:
+        errors.append("les internes de ReportLab utilisés par apply_background ont changé")
+    if len(images(reused)) != 1:
+        errors.append(f"{len(images(reused))} image(s) dans le document au lieu d'une")
+    if images(reused) != images(public):
+        errors.append("l'image réutilisée diffère de celle encodée par drawImage")
+    if errors:
+        print("ÉCHEC : " + " ; ".join(errors))
+        sys.exit(1)
+    print("OK : une seule image par document, identique à celle de l'API publique")
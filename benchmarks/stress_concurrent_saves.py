@@ -0,0 +1,55 @@
+# Test de charge : plusieurs processus (comme des workers gunicorn) enregistrent des
+# consultations en même temps dans le même classeur ; aucune ligne ne doit être perdue.
+# Usage : python benchmarks/stress_concurrent_saves.py [processus] [enregistrements_par_processus] [excel|journal]
+import os, sys, time, tempfile, multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def use_folder(main, folder):
+    # Classeur et fichiers annexes (instantané, suppressions, commentaires) dans le dossier temporaire
+    main.EXCEL_FILE_PATH = os.path.join(folder, "ConsultationData.xlsx")
+    main.JOURNAL_FILE_PATH = os.path.join(folder, "ConsultationData.journal.jsonl")
+    main.SNAPSHOT_FILE_PATH = os.path.join(folder, "ConsultationData.snapshot.pkl")
+    main.TOMBSTONE_FILE_PATH = os.path.join(folder, "ConsultationData.tombstones.jsonl")
+    main.PATCH_FILE_PATH = os.path.join(folder, "ConsultationData.patches.jsonl")
+
+def worker(folder, storage, worker_id, saves, start_event):
+    import main
+    use_folder(main, folder)
+    store = main.CONSULTATION_STORES[storage]
+    start_event.wait()
+    for i in range(saves):
+        row = {col: "" for col in main.CONSULTATION_COLUMNS}
+        row.update(consultation_id=f"w{worker_id}-{i}", patient_id=f"P{worker_id}",
+                   patient_name=f"Patient {worker_id}", consultation_date="2024-01-01")
+        store.append(row)
+
+if __name__ == "__main__":
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    saves = int(sys.argv[2]) if len(sys.argv) > 2 else 15
+    storage = sys.argv[3] if len(sys.argv) > 3 else "excel"
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as folder:
+        start_event = ctx.Event()
+        workers = [ctx.Process(target=worker, args=(folder, storage, n, saves, start_event)) for n in range(processes)]
+        for p in workers:
+            p.start()
+        time.sleep(3)  # Laisse chaque processus importer l'application
+        start = time.perf_counter()
+        start_event.set()
+        for p in workers:
+            p.join()
+        elapsed = time.perf_counter() - start
+
+        import main
+        use_folder(main, folder)
+        df = main.CONSULTATION_STORES[storage].read_all()
+        expected = processes * saves
+        found = df["consultation_id"].nunique()
+        print(f"{storage} : {processes} processus x {saves} enregistrements en {elapsed:.1f} s -> "
+              f"{found}/{expected} consultations présentes")
+        leftovers = [name for name in os.listdir(folder) if ".tmp" in name]
+        if found != expected or len(df) != expected or leftovers or any(p.exitcode for p in workers):
+            print(f"ÉCHEC : lignes perdues ou dupliquées, fichiers temporaires restants : {leftovers}")
+            sys.exit(1)
+        print("OK : aucune consultation perdue")
@@ -1,7 +1,13 @@
-from flask import Flask, request, render_template_string, redirect, url_for, send_file, flash, has_request_context, jsonify, session, make_response
-import os, sys, platform, json, uuid, hashlib, re, pandas as pd, subprocess, io, base64, socket, requests, copy
+from flask import Flask, request, render_template, stream_with_context, redirect, url_for, send_file, flash, has_request_context, jsonify, session, make_response
+import os, sys, platform, json, uuid, hashlib, re, pandas as pd, subprocess, io, base64, socket, requests, copy, threading, sqlite3, bisect, unicodedata, time, zipfile, multiprocessing, contextlib, atexit, pickle
 from datetime import datetime, date, timedelta
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict
+from array import array
+from filelock import FileLock, Timeout
 from werkzeug.utils import secure_filename
+from jinja2 import ChoiceLoader, DictLoader
+import reportlab
 from reportlab.lib.pagesizes import A5, A4
 from reportlab.lib.units import inch
 from reportlab.platypus import BaseDocTemplate, PageTemplate, Frame, Paragraph, Spacer, Table, TableStyle, PageBreak, ListFlowable
@@ -9,6 +15,14 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 import PyPDF2
 from PIL import Image, ImageDraw
 from reportlab.pdfgen import canvas
+from reportlab.lib.utils import ImageReader
+try:
+    # Interne de ReportLab (version épinglée dans requirements.txt) : nom des images
+    # dessinées par drawImage, voir apply_background
+    from reportlab.lib.utils import _digester
+except ImportError:
+    _digester = None
+from reportlab.pdfbase import pdfdoc, pdfmetrics
 from reportlab.lib.enums import TA_JUSTIFY
 
 # Détermination de l'adresse IP locale (pour affichage dans la page trial_expired)
@@ -17,6 +31,12 @@ LOCAL_IP = socket.gethostbyname(socket.gethostname())
 app = Flask(__name__)
 app.secret_key = 'votre_cle_secrete'
 
+# Processus du pool de rendu des lots PDF : "spawn" y réimporte ce module, dont seules les
+# fonctions de rendu servent ; le registre des patients, la migration SQLite et la
+# précompilation des gabarits y sont sautés (voir pdf_batch_pool)
+# (le nom du processus est déjà fixé quand "spawn" réimporte le script principal)
+PDF_RENDER_WORKER = multiprocessing.current_process().name != "MainProcess" and os.environ.get("MEDICSAS_PDF_RENDER_WORKER") == "1"
+
 # ---------------------------
 # Répertoires de travail
 # ---------------------------
@@ -33,6 +53,18 @@ os.makedirs(BACKGROUND_FOLDER, exist_ok=True)
 
 CONFIG_FILE = os.path.join(CONFIG_FOLDER, "config.json")
 EXCEL_FILE_PATH = os.path.join(EXCEL_FOLDER, "ConsultationData.xlsx")
+# Journal en ajout seul des nouvelles consultations (mode de stockage "journal")
+JOURNAL_FILE_PATH = os.path.join(EXCEL_FOLDER, "ConsultationData.journal.jsonl")
+# Base SQLite des consultations (mode de stockage "sqlite")
+SQLITE_FILE_PATH = os.path.join(EXCEL_FOLDER, "ConsultationData.sqlite3")
+# Suppressions en attente de compaction (modes "excel" et "journal")
+TOMBSTONE_FILE_PATH = os.path.join(EXCEL_FOLDER, "ConsultationData.tombstones.jsonl")
+# Commentaires modifiés en attente de réécriture du classeur (modes "excel" et "journal")
+PATCH_FILE_PATH = os.path.join(EXCEL_FOLDER, "ConsultationData.patches.jsonl")
+# Instantané en colonnes du classeur, relu à la place du .xlsx tant que celui-ci n'a pas changé
+SNAPSHOT_FILE_PATH = os.path.join(EXCEL_FOLDER, "ConsultationData.snapshot.pkl")
+# Mutations de la file d'écriture différée abandonnées après échecs répétés, à reprendre à la main
+DEADLETTER_FILE_PATH = os.path.join(EXCEL_FOLDER, "ConsultationData.deadletter.jsonl")
 
 # ---------------------------
 # Nouvelle partie : Activation et Gestion des Licences
@@ -68,6 +100,7 @@ else:
     ACTIVATION_DIR = os.path.join(os.path.expanduser('~'), '.systemdata')
 os.makedirs(ACTIVATION_DIR, exist_ok=True)
 ACTIVATION_FILE = os.path.join(ACTIVATION_DIR, 'activation32x32.json')
+TRIAL_FILE = os.path.join(ACTIVATION_DIR, 'windows32x32' if platform.system() == "Windows" else 'windows3')
 
 def check_activation():
     if not os.path.exists(ACTIVATION_FILE):
@@ -113,27 +146,22 @@ def update_activation_after_payment(plan):
     }
     with open(ACTIVATION_FILE, "w", encoding="utf-8") as f:
         json.dump(data, f)
+    invalidate_licence_state()
 
 # Contrôle de la période d'essai
-def check_trial_period():
+def evaluate_trial_period():
+    # Renvoie (licence valide, message d'erreur éventuel) sans passer par flash()
     # Si le fichier d'activation existe et que le plan n'est pas "essai_7jours", l'application est considérée activée.
     if os.path.exists(ACTIVATION_FILE):
         try:
             with open(ACTIVATION_FILE, "r", encoding="utf-8") as f:
                 data = json.load(f)
             if data.get("plan") != "essai_7jours":
-                return True
+                return True, None
         except Exception:
             pass
 
-    if platform.system() == "Windows":
-        hidden_folder = os.path.join(os.environ.get('APPDATA'), 'SystemData')
-        os.makedirs(hidden_folder, exist_ok=True)
-        file_path = os.path.join(hidden_folder, 'windows32x32')
-    else:
-        hidden_folder = os.path.join(os.path.expanduser('~'), '.systemdata')
-        os.makedirs(hidden_folder, exist_ok=True)
-        file_path = os.path.join(hidden_folder, 'windows3')
+    file_path = TRIAL_FILE
     from datetime import datetime as dt
     if os.path.exists(file_path):
         try:
@@ -141,19 +169,17 @@ def check_trial_period():
                 stored_date_str = f.read().strip()
             stored_date = dt.strptime(stored_date_str, '%Y-%m-%d')
         except Exception as e:
-            flash("Le fichier de licence est corrompu. Veuillez contacter le support.", "error")
-            return False
+            return False, "Le fichier de licence est corrompu. Veuillez contacter le support."
         if stored_date > dt.now():
-            flash("Le fichier de licence est corrompu ou la date système a été modifiée.", "error")
-            return False
+            return False, "Le fichier de licence est corrompu ou la date système a été modifiée."
         days_passed = (dt.now() - stored_date).days
         if days_passed > 7:
-            flash("La période d'essai de 7 jours est terminée.<br>Contactez sastoukadigital@gmail.com ou Whatsapp au +212652084735.", "error")
-            return False
-        return True
+            return False, "La période d'essai de 7 jours est terminée.<br>Contactez sastoukadigital@gmail.com ou Whatsapp au +212652084735."
+        return True, None
     else:
         current_date_str = dt.now().strftime('%Y-%m-%d')
         try:
+            os.makedirs(ACTIVATION_DIR, exist_ok=True)
             with open(file_path, 'w', encoding="utf-8") as f:
                 f.write(current_date_str)
             if platform.system() == "Windows":
@@ -165,9 +191,48 @@ def check_trial_period():
             else:
                 os.chmod(file_path, 0)
         except Exception as e:
-            flash("Impossible de créer le fichier de licence.", "error")
-            return False
-        return True
+            return False, "Impossible de créer le fichier de licence."
+        return True, None
+
+# État de licence mis en cache : une licence valide est réévaluée au plus toutes les
+# LICENCE_CACHE_TTL secondes. Tant que la licence est invalide, la signature des fichiers
+# d'activation / d'essai est comparée à chaque requête : une activation ou un paiement
+# enregistré par un autre worker est pris en compte dès la requête suivante.
+LICENCE_CACHE_TTL = 60
+_licence_lock = threading.Lock()
+_licence_state = {"valid": None, "message": None, "day": None, "expires_at": 0.0, "signature": None}
+
+def invalidate_licence_state():
+    with _licence_lock:
+        _licence_state["expires_at"] = 0.0
+        _licence_state["signature"] = None
+
+def licence_state():
+    # Chemin rapide : une simple comparaison d'horodatage tant que le TTL court (licence
+    # valide), plus la signature des fichiers (licence invalide)
+    if time.monotonic() < _licence_state["expires_at"] and (
+            _licence_state["valid"] or _file_signature([ACTIVATION_FILE, TRIAL_FILE]) == _licence_state["signature"]):
+        return _licence_state["valid"], _licence_state["message"]
+    with _licence_lock:
+        now = time.monotonic()
+        if now >= _licence_state["expires_at"] or not _licence_state["valid"]:
+            today = date.today()
+            signature = _file_signature([ACTIVATION_FILE, TRIAL_FILE])
+            # Réévaluation si un fichier a changé, si le jour a changé (échéance de l'essai)
+            # ou si la dernière évaluation a échoué
+            if signature != _licence_state["signature"] or today != _licence_state["day"] or not _licence_state["valid"]:
+                valid, message = evaluate_trial_period()
+                # Le fichier d'essai a pu être créé par l'évaluation
+                _licence_state.update(valid=valid, message=message, day=today,
+                                      signature=_file_signature([ACTIVATION_FILE, TRIAL_FILE]))
+            _licence_state["expires_at"] = now + LICENCE_CACHE_TTL
+        return _licence_state["valid"], _licence_state["message"]
+
+def check_trial_period():
+    valid, message = licence_state()
+    if not valid and message:
+        flash(message, "error")
+    return valid
 
 @app.before_request
 def enforce_trial_period():
@@ -175,21 +240,26 @@ def enforce_trial_period():
         if not check_trial_period():
             return redirect(url_for("trial_expired"))
 
-@app.route("/trial_expired")
-def trial_expired():
-    # Désactiver le plan d'essai de 7 jours en modifiant le fichier d'activation
-    if os.path.exists(ACTIVATION_FILE):
-        try:
-            with open(ACTIVATION_FILE, "r+", encoding="utf-8") as f:
-                data = json.load(f)
-                if data.get("plan") == "essai_7jours":
-                    data["plan"] = "essai_expire"
-                    f.seek(0)
-                    json.dump(data, f)
-                    f.truncate()
-        except Exception:
-            pass
-    return render_template_string("""
+@app.before_request
+def wait_for_own_writes():
+    seq = session.get("write_seq")
+    if seq is None:
+        return
+    # Requête servie par un autre worker : le numéro est comparé au marqueur publié par le
+    # processus qui a reçu la mutation une fois son lot sur disque
+    writer_id = session.get("write_writer")
+    if writer_id is None:
+        written = True
+    elif writer_id == consultation_writer.writer_id:
+        written = consultation_writer.wait_for(seq, WRITE_BEHIND_READ_TIMEOUT)
+    else:
+        written = wait_for_durable_marker(writer_id, seq, WRITE_BEHIND_READ_TIMEOUT)
+    if not written:
+        return
+    session.pop("write_seq", None)
+    session.pop("write_writer", None)
+
+trial_expired_template = """
     <!DOCTYPE html>
     <html lang="fr">
     <head>
@@ -215,7 +285,24 @@ def trial_expired():
       </footer>
     </body>
     </html>
-    """, local_ip=LOCAL_IP)
+    """
+
+@app.route("/trial_expired")
+def trial_expired():
+    # Désactiver le plan d'essai de 7 jours en modifiant le fichier d'activation
+    if os.path.exists(ACTIVATION_FILE):
+        try:
+            with open(ACTIVATION_FILE, "r+", encoding="utf-8") as f:
+                data = json.load(f)
+                if data.get("plan") == "essai_7jours":
+                    data["plan"] = "essai_expire"
+                    f.seek(0)
+                    json.dump(data, f)
+                    f.truncate()
+            invalidate_licence_state()
+        except Exception:
+            pass
+    return render_template("trial_expired.html", local_ip=LOCAL_IP)
 
 # ---------------------------
 # Partie PayPal et Achat de Plans (mise à jour pour autoriser le paiement par carte bancaire)
@@ -411,6 +498,7 @@ def activation():
             }
             with open(ACTIVATION_FILE, "w", encoding="utf-8") as f:
                 json.dump(data, f)
+            invalidate_licence_state()
             flash("Essai de 7 jours activé.", "success")
             return redirect(url_for("index"))
         elif choix in ["Illimité", "1 an"]:
@@ -430,7 +518,7 @@ def activation():
                     return redirect(approval_url)
                 except Exception as e:
                     flash(f"Erreur lors de la création de la commande PayPal: {e}", "error")
-    return render_template_string(activation_template, machine_id=machine_id)
+    return render_template("activation.html", machine_id=machine_id)
 
 # -----------------------------------------------------------------------------
 # Données et Fonctions Utilitaires (Consultations, PDF, etc.)
@@ -444,8 +532,11 @@ def load_config():
     return config
 
 def save_config(config):
-    with open(CONFIG_FILE, 'w', encoding="utf-8") as f:
+    # Remplacement atomique : les autres workers relisent ce fichier (mode de stockage)
+    tmp_path = f"{CONFIG_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding="utf-8") as f:
         json.dump(config, f)
+    os.replace(tmp_path, CONFIG_FILE)
 
 def extract_rest_duration(text):
     placeholders = ["[Nom du Médecin]", "[Nom du Patient]", "[Lieu]", "[Date]", "[X]"]
@@ -564,88 +655,1566 @@ default_certificate_text = """Je soussigné(e) [Nom du Médecin], certifie que l
 
 Fait à [Lieu], le [Date]."""
 
-patient_ids = []
-patient_names = []
-patient_id_to_name = {}
-patient_name_to_id = {}
-patient_name_to_age = {}
-patient_id_to_age = {}
-patient_name_to_phone = {}
-patient_id_to_phone = {}
-patient_name_to_antecedents = {}
-patient_id_to_antecedents = {}
-patient_name_to_dob = {}
-patient_id_to_dob = {}
-patient_name_to_gender = {}
-patient_id_to_gender = {}
+# -----------------------------------------------------------------------------
+# Stockage des consultations (interface commune : Excel, journal, SQLite)
+# -----------------------------------------------------------------------------
+CONSULTATION_COLUMNS = [
+    "consultation_date", "patient_id", "patient_name", "date_of_birth", "gender", "age", "patient_phone", "antecedents",
+    "clinical_signs", "bp", "temperature", "heart_rate", "respiratory_rate", "diagnosis",
+    "medications", "analyses", "radiologies", "certificate_category", "certificate_content",
+    "rest_duration", "doctor_comment", "consultation_id"
+]
+# Types imposés à la lecture du classeur : mesures en nombres (tri numérique des tableaux),
+# identifiants et textes en chaînes (un ID 12 ou un téléphone 0612... ne deviennent pas
+# 12.0 ou 612...), consultation_date laissée telle que lue
+CONSULTATION_NUMERIC_COLUMNS = ["age", "temperature", "heart_rate", "respiratory_rate"]
+CONSULTATION_TEXT_COLUMNS = [col for col in CONSULTATION_COLUMNS
+                             if col not in CONSULTATION_NUMERIC_COLUMNS and col != "consultation_date"]
+
+# "excel" : chaque enregistrement réécrit le classeur (comportement historique)
+# "journal" : les nouvelles consultations sont ajoutées à JOURNAL_FILE_PATH et le classeur
+#             n'est plus qu'un export matérialisé périodiquement
+# "sqlite" : base SQLite indexée (SQLITE_FILE_PATH), migrée une fois depuis le classeur
+CONSULTATION_STORAGE = os.environ.get("MEDICSAS_STORAGE") or load_config().get("consultation_storage", "excel")
+JOURNAL_MATERIALIZE_EVERY = int(load_config().get("journal_materialize_every", 200))
+
+_consultation_lock = threading.RLock()
+# Écrivains du processus : attendent le verrou de fichier sans bloquer les lecteurs
+_consultation_write_mutex = threading.RLock()
+
+# Écritures coordonnées entre processus (plusieurs workers gunicorn) : verrou consultatif
+# sur un fichier .lock voisin du classeur, écriture dans un fichier temporaire puis
+# os.replace, nouvelles tentatives espacées (classeur ouvert dans Excel sous Windows)
+CONSULTATION_LOCK_TIMEOUT = float(load_config().get("consultation_lock_timeout", 30))
+CONSULTATION_WRITE_RETRIES = 5
+CONSULTATION_BUSY_MESSAGE = "Les consultations sont en cours d'enregistrement par un autre processus, veuillez réessayer dans quelques instants."
+_consultation_file_locks = {}
+
+# Ordre des verrous : écrivains du processus, fichier .lock, puis _consultation_lock une
+# fois le fichier obtenu (jamais l'inverse). Un délai dépassé lève filelock.Timeout,
+# renvoyé en 503 par les routes. Les lecteurs ne prennent aucun de ces verrous (voir
+# cached_frame) : une réécriture du classeur ne bloque pas /get_consultations
+@contextlib.contextmanager
+def consultation_write_lock():
+    with _consultation_write_mutex:
+        lock_path = EXCEL_FILE_PATH + ".lock"
+        lock = _consultation_file_locks.get(lock_path)
+        if lock is None:
+            lock = _consultation_file_locks[lock_path] = FileLock(lock_path)
+        # Réentrant : append() -> write_all() reprend le même verrou sans se bloquer
+        lock.acquire(timeout=CONSULTATION_LOCK_TIMEOUT)
+        try:
+            with _consultation_lock:
+                yield
+        finally:
+            lock.release()
+
+def with_write_retries(action):
+    delay = 0.1
+    for attempt in range(CONSULTATION_WRITE_RETRIES):
+        try:
+            return action()
+        except PermissionError:
+            if attempt == CONSULTATION_WRITE_RETRIES - 1:
+                raise
+            time.sleep(delay)
+            delay *= 2
+
+def write_excel_atomic(df, path):
+    root, ext = os.path.splitext(path)
+    tmp_path = f"{root}.{os.getpid()}.{threading.get_ident()}.tmp{ext}"
+    try:
+        df.to_excel(tmp_path, index=False, engine="openpyxl")
+        with open(tmp_path, "rb+") as f:
+            os.fsync(f.fileno())
+        # Un arrêt brutal laisse soit l'ancien classeur, soit le nouveau, jamais un fichier tronqué
+        with_write_retries(lambda: os.replace(tmp_path, path))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# Cache des DataFrame lus depuis le disque, validé par (mtime, taille) de chaque fichier source.
+# Les DataFrame renvoyés sont partagés : copier avant toute modification.
+# Les lectures ne prennent aucun verrou : les écrivains remplacent les fichiers par os.replace
+# et une lecture croisée par une écriture (invalidation pendant le chargement) n'est pas
+# mise en cache, la suivante relit le fichier
+_frame_cache = {}
+frame_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+def _file_signature(paths):
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            signature.append((path, st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            signature.append((path, None, None))
+    return tuple(signature)
+
+def cached_frame(key, paths, loader):
+    signature = _file_signature(paths)
+    entry = _frame_cache.get(key)
+    if entry is not None and entry[0] == signature:
+        frame_cache_stats["hits"] += 1
+        return entry[1]
+    frame_cache_stats["misses"] += 1
+    generation = frame_cache_stats["invalidations"]
+    df = loader()
+    if generation == frame_cache_stats["invalidations"] and signature == _file_signature(paths):
+        _frame_cache[key] = (signature, df)
+    return df
+
+def invalidate_frame_cache(path=None):
+    # Appelée après chaque écriture faite par l'application (la résolution du mtime ne suffit pas toujours) :
+    # seules les entrées qui dépendent du fichier modifié sont retirées
+    for key, (signature, _) in list(_frame_cache.items()):
+        if path is None or any(entry[0] == path for entry in signature):
+            _frame_cache.pop(key, None)
+    frame_cache_stats["invalidations"] += 1
+
+# Instantané du classeur : pickle des colonnes typées, avec la signature (mtime, taille) du
+# .xlsx dont il est issu. Écrit après chaque réécriture du classeur par l'application et
+# après chaque lecture complète du .xlsx ; ignoré dès que le classeur a changé (modification
+# dans Excel, autre version de l'application)
+SNAPSHOT_VERSION = 1
+snapshot_stats = {"hits": 0, "misses": 0}
+
+def _text_value(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def typed_consultation_frame(df):
+    # Même normalisation pour une lecture du .xlsx et pour un DataFrame qu'on vient d'écrire :
+    # l'instantané est identique à ce que donnerait une relecture du classeur
+    df = df.reset_index(drop=True)
+    for col in df.columns:
+        series = df[col]
+        if col in CONSULTATION_TEXT_COLUMNS:
+            series = series.astype(object)
+        if series.dtype == object:
+            series = series.where(series.notna() & (series != ""))
+            if col in CONSULTATION_TEXT_COLUMNS:
+                series = series.map(_text_value, na_action="ignore")
+            elif col in CONSULTATION_NUMERIC_COLUMNS:
+                series = pd.to_numeric(series, errors="ignore")
+        df[col] = series
+    return df
+
+def read_consultation_excel(path):
+    # object et non str : une colonne entièrement vide deviendrait la chaîne "nan"
+    dtype = {col: object for col in CONSULTATION_TEXT_COLUMNS}
+    return typed_consultation_frame(pd.read_excel(path, sheet_name=0, dtype=dtype))
+
+def snapshot_is_fresh():
+    try:
+        return os.path.getmtime(SNAPSHOT_FILE_PATH) >= os.path.getmtime(EXCEL_FILE_PATH)
+    except OSError:
+        return False
+
+def load_consultation_snapshot():
+    if not snapshot_is_fresh():
+        return None
+    try:
+        with open(SNAPSHOT_FILE_PATH, "rb") as f:
+            snapshot = pickle.load(f)
+    except (OSError, EOFError, ValueError, AttributeError, ImportError, pickle.UnpicklingError):
+        return None
+    if snapshot.get("version") != SNAPSHOT_VERSION or snapshot.get("source") != _file_signature([EXCEL_FILE_PATH])[0][1:]:
+        return None
+    # DataFrame reconstruit à partir des colonnes : avec pandas 1.5, astype(str) sur un
+    # tableau object dépicklé tel quel modifie ce tableau (donc le cache) en place
+    return pd.DataFrame(dict(zip(snapshot["columns"], snapshot["data"])), columns=snapshot["columns"])
+
+def save_consultation_snapshot(df, source):
+    tmp_path = f"{SNAPSHOT_FILE_PATH}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"version": SNAPSHOT_VERSION, "source": source, "columns": list(df.columns),
+                         "data": [df[col].tolist() if df[col].dtype == object else df[col].to_numpy() for col in df.columns]},
+                        f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, SNAPSHOT_FILE_PATH)
+    except OSError as e:
+        print(f"Avertissement : instantané des consultations non enregistré ({e}).")
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def read_consultation_workbook():
+    df = load_consultation_snapshot()
+    if df is not None:
+        snapshot_stats["hits"] += 1
+        return df
+    snapshot_stats["misses"] += 1
+    # Signature prise avant la lecture : si le classeur est remplacé pendant ce temps,
+    # l'instantané porte l'ancienne signature et sera ignoré
+    source = _file_signature([EXCEL_FILE_PATH])[0][1:]
+    df = read_consultation_excel(EXCEL_FILE_PATH)
+    save_consultation_snapshot(df, source)
+    return df
+
+def write_consultation_workbook(df):
+    with consultation_write_lock():
+        df = typed_consultation_frame(df)
+        write_excel_atomic(df, EXCEL_FILE_PATH)
+        save_consultation_snapshot(df, _file_signature([EXCEL_FILE_PATH])[0][1:])
+        invalidate_frame_cache(EXCEL_FILE_PATH)
+
+# Suppression par pierre tombale : l'identifiant de la consultation est ajouté à
+# TOMBSTONE_FILE_PATH (une ligne, un fsync) au lieu de réécrire le classeur. Les lignes
+# marquées sont filtrées à la lecture, peuvent être restaurées, et sont retirées du
+# classeur par une compaction lancée en arrière-plan quand elles dépassent
+# TOMBSTONE_COMPACT_FRACTION des lignes (et au moins TOMBSTONE_COMPACT_MIN).
+# Une suppression reste annulable pendant TOMBSTONE_GRACE_SECONDS : la compaction (et la
+# purge de la corbeille SQLite) ne retire que les suppressions plus anciennes
+TOMBSTONE_COMPACT_FRACTION = float(load_config().get("tombstone_compact_fraction", 0.1))
+TOMBSTONE_COMPACT_MIN = int(load_config().get("tombstone_compact_min", 20))
+TOMBSTONE_GRACE_SECONDS = float(load_config().get("tombstone_grace_seconds", 600))
+_compaction_lock = threading.Lock()
+_compaction_timer = None
+
+def tombstone_cutoff(grace=None):
+    grace = TOMBSTONE_GRACE_SECONDS if grace is None else grace
+    return (datetime.now() - timedelta(seconds=grace)).isoformat(timespec="seconds")
+
+def compaction_due(deleted, rows):
+    return deleted >= TOMBSTONE_COMPACT_MIN and deleted > TOMBSTONE_COMPACT_FRACTION * rows
+
+def read_jsonl_entries(path, label):
+    entries = []
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # Ligne tronquée (arrêt brutal pendant l'écriture) : on l'ignore
+                    print(f"Avertissement : ligne du fichier des {label} illisible ignorée.")
+    return entries
+
+def append_jsonl_entries(path, entries):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries))
+        f.flush()
+        os.fsync(f.fileno())
+    invalidate_frame_cache(path)
+
+def rewrite_jsonl_entries(path, entries):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write("".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    invalidate_frame_cache(path)
+
+def remove_side_file(path):
+    if os.path.exists(path):
+        os.remove(path)
+    invalidate_frame_cache(path)
+
+def read_tombstones():
+    def load():
+        tombstones = {}
+        for entry in read_jsonl_entries(TOMBSTONE_FILE_PATH, "suppressions"):
+            if entry.get("restored"):
+                tombstones.pop(entry["consultation_id"], None)
+            else:
+                tombstones[entry["consultation_id"]] = entry
+        return tombstones
+    return cached_frame(("tombstones", TOMBSTONE_FILE_PATH), [TOMBSTONE_FILE_PATH], load)
+
+def clear_tombstones():
+    remove_side_file(TOMBSTONE_FILE_PATH)
+
+def drop_tombstoned(df):
+    tombstones = read_tombstones()
+    if tombstones and not df.empty and "consultation_id" in df.columns:
+        df = df[~df["consultation_id"].astype(str).isin(list(tombstones))]
+    return df
+
+# Journal des commentaires modifiés : une ligne par mise à jour, fusionnée à la lecture
+# via les index consultation_id / patient_id, et intégrée au classeur à sa prochaine
+# réécriture (enregistrement en mode "excel", export du journal, compaction).
+# Une mise à jour « patient » ne vise que les lignes déjà enregistrées (positions < upto),
+# comme l'ancienne réécriture : une consultation ajoutée ensuite garde son commentaire.
+def read_patches():
+    return cached_frame(("patches", PATCH_FILE_PATH), [PATCH_FILE_PATH],
+                        lambda: read_jsonl_entries(PATCH_FILE_PATH, "commentaires"))
+
+class ExcelConsultationStore:
+    def exists(self):
+        return os.path.exists(EXCEL_FILE_PATH)
+
+    def source_paths(self):
+        return [EXCEL_FILE_PATH]
+
+    def read_snapshot(self):
+        if not os.path.exists(EXCEL_FILE_PATH):
+            return pd.DataFrame(columns=CONSULTATION_COLUMNS)
+        return cached_frame(("excel", EXCEL_FILE_PATH), [EXCEL_FILE_PATH], read_consultation_workbook)
+
+    # Colonnes utiles (registre des patients au démarrage) tirées de la vue complète : sans
+    # instantané à jour, une seule lecture du classeur fournit la vue et l'instantané
+    # (avec openpyxl, usecols ne réduit pas le coût d'analyse du classeur)
+    def read_columns(self, columns):
+        df = self.read_all()
+        return df[[col for col in columns if col in df.columns]]
+
+    def read_stored(self):
+        return self.read_snapshot()
+
+    # Lignes stockées avec les commentaires modifiés, consultations supprimées (non encore
+    # compactées) comprises
+    def read_rows(self):
+        return cached_frame(("rows", type(self).__name__, EXCEL_FILE_PATH),
+                            self.source_paths() + [PATCH_FILE_PATH], self.load_rows)
+
+    def load_rows(self):
+        df = self.read_stored()
+        patches = read_patches()
+        if not patches or df.empty:
+            return df
+        index, patients = self.consultation_index(), self.patient_index()
+        comments = {}
+        for entry in patches:
+            if "consultation_id" in entry:
+                position = index.get(entry["consultation_id"])
+                if position is not None:
+                    comments[position] = entry["doctor_comment"]
+            else:
+                for position in patients.get(entry["patient_id"], ()):
+                    if position < entry["upto"]:
+                        comments[position] = entry["doctor_comment"]
+        df = df.copy()
+        if "doctor_comment" not in df.columns:
+            df["doctor_comment"] = None
+        df["doctor_comment"] = df["doctor_comment"].astype(object)
+        positions = list(comments)
+        df.iloc[positions, df.columns.get_loc("doctor_comment")] = [comments[p] for p in positions]
+        return df
+
+    def read_all(self):
+        return cached_frame(("live", type(self).__name__, EXCEL_FILE_PATH),
+                            self.source_paths() + [PATCH_FILE_PATH, TOMBSTONE_FILE_PATH], self.load_live)
+
+    def load_live(self):
+        return drop_tombstoned(self.read_rows())
+
+    def consultation_index(self):
+        # consultation_id -> position de la ligne dans read_rows(), reconstruit seulement
+        # quand le classeur (ou le journal) change
+        return cached_frame(("index", type(self).__name__, EXCEL_FILE_PATH), self.source_paths(),
+                            lambda: {str(cid): pos for pos, cid in enumerate(self.read_stored()["consultation_id"])})
+
+    def patient_index(self):
+        # patient_id -> positions de ses lignes dans read_rows()
+        def build():
+            positions = {}
+            for pos, patient_id in enumerate(self.read_stored()["patient_id"].astype(str)):
+                positions.setdefault(patient_id, []).append(pos)
+            return positions
+        return cached_frame(("patients", type(self).__name__, EXCEL_FILE_PATH), self.source_paths(), build)
+
+    def read_patient(self, patient_id):
+        df = self.read_all()
+        return df[df['patient_id'].astype(str) == patient_id]
+
+    def read_patients(self, patient_ids):
+        df = self.read_all()
+        return df[df['patient_id'].astype(str).isin(patient_ids)]
+
+    def find_patient_name(self, patient_id):
+        df = self.read_patient(patient_id)
+        return None if df.empty else str(df['patient_name'].iloc[0])
+
+    def write_all(self, df):
+        # df provient de read_rows() : les commentaires modifiés y sont intégrés
+        with consultation_write_lock():
+            write_consultation_workbook(df)
+            remove_side_file(PATCH_FILE_PATH)
+
+    def append(self, row):
+        self.append_rows([row])
+
+    # Lecture et réécriture sous le même verrou : une consultation enregistrée entre-temps
+    # par un autre worker est relue (le cache est validé par mtime) au lieu d'être écrasée
+    def append_rows(self, rows):
+        with consultation_write_lock():
+            df = self.read_rows()
+            self.write_all(pd.concat([df, pd.DataFrame(rows)], ignore_index=True))
+
+    def delete(self, consultation_id):
+        return self.update_tombstones([("delete", consultation_id)])
+
+    def restore(self, consultation_id):
+        return self.update_tombstones([("restore", consultation_id)])
+
+    def set_patient_comment(self, patient_id, comment):
+        return self.write_patches([("comment", patient_id, comment, 0)])
+
+    def set_consultation_comment(self, consultation_id, comment):
+        return self.write_patches([("consultation_comment", consultation_id, comment, 0)])
+
+    # appended : lignes ajoutées plus loin dans le même lot, déjà enregistrées. upto compte
+    # les lignes stockées et non les clés de l'index : des identifiants vides ou en double
+    # y sont fusionnés et écarteraient les dernières consultations du patient
+    def write_patches(self, mutations):
+        with consultation_write_lock():
+            index, patients = self.consultation_index(), self.patient_index()
+            stored_rows = len(self.read_stored())
+            entries = []
+            for kind, key, comment, appended in mutations:
+                key = str(key)
+                if kind == "consultation_comment" and key in index:
+                    entries.append({"consultation_id": key, "doctor_comment": comment})
+                elif kind == "comment" and key in patients:
+                    entries.append({"patient_id": key, "doctor_comment": comment, "upto": stored_rows - appended})
+            if entries:
+                append_jsonl_entries(PATCH_FILE_PATH, entries)
+            return bool(entries)
+
+    def pending_patches(self):
+        return len(read_patches())
+
+    def update_tombstones(self, operations):
+        with consultation_write_lock():
+            tombstones = dict(read_tombstones())
+            index = self.consultation_index()
+            entries = []
+            for kind, consultation_id in operations:
+                consultation_id = str(consultation_id)
+                if kind == "delete" and consultation_id in index and consultation_id not in tombstones:
+                    entry = {"consultation_id": consultation_id, "position": index[consultation_id],
+                             "deleted_at": datetime.now().isoformat(timespec="seconds")}
+                    tombstones[consultation_id] = entry
+                elif kind == "restore" and consultation_id in tombstones:
+                    entry = {"consultation_id": consultation_id, "restored": True}
+                    del tombstones[consultation_id]
+                else:
+                    continue
+                entries.append(entry)
+            if entries:
+                append_jsonl_entries(TOMBSTONE_FILE_PATH, entries)
+                if compaction_due(len(tombstones), len(index)):
+                    self.schedule_compaction(tombstones)
+            return bool(entries)
+
+    # La compaction attend que la plus ancienne suppression soit sortie du délai
+    # d'annulation ; une seule compaction est programmée à la fois
+    def schedule_compaction(self, tombstones):
+        global _compaction_timer
+        with _consultation_lock:
+            if _compaction_timer is not None:
+                return
+            oldest = min((entry.get("deleted_at", "") for entry in tombstones.values()), default="")
+            try:
+                delay = (datetime.fromisoformat(oldest) - datetime.now()).total_seconds() + TOMBSTONE_GRACE_SECONDS + 1
+            except ValueError:
+                delay = 0
+            _compaction_timer = threading.Timer(max(delay, 0), self.run_scheduled_compaction)
+            _compaction_timer.daemon = True
+            _compaction_timer.start()
+
+    def run_scheduled_compaction(self):
+        global _compaction_timer
+        with _consultation_lock:
+            _compaction_timer = None
+        self.compact()
+        with consultation_write_lock():
+            tombstones = read_tombstones()
+            if compaction_due(len(tombstones), len(self.consultation_index())):
+                self.schedule_compaction(tombstones)
+
+    def pending_deletions(self):
+        return len(read_tombstones())
+
+    def compact(self, grace=None):
+        # Retrait physique des consultations supprimées depuis plus de grace secondes : elles
+        # ne peuvent plus être restaurées ; les suppressions récentes restent annulables
+        if not _compaction_lock.acquire(blocking=False):
+            return 0
+        try:
+            with consultation_write_lock():
+                tombstones = read_tombstones()
+                cutoff = tombstone_cutoff(grace)
+                expired = [cid for cid, entry in tombstones.items() if entry.get("deleted_at", "") <= cutoff]
+                if expired:
+                    df = self.read_rows()
+                    self.write_all(df[~df["consultation_id"].astype(str).isin(expired)])
+                    kept = [entry for cid, entry in tombstones.items() if entry.get("deleted_at", "") > cutoff]
+                    if kept:
+                        rewrite_jsonl_entries(TOMBSTONE_FILE_PATH, kept)
+                    else:
+                        clear_tombstones()
+                return len(expired)
+        finally:
+            _compaction_lock.release()
+
+    # Lot de mutations de la file d'écriture : les ajouts sont écrits ensemble, puis les
+    # commentaires vont au journal des commentaires et les suppressions et restaurations au
+    # fichier des pierres tombales
+    def apply_batch(self, mutations):
+        with consultation_write_lock():
+            rows = [args[0] for kind, *args in mutations if kind == "append"]
+            if rows:
+                self.append_rows(rows)
+            patches, appended_after = [], len(rows)
+            for kind, *args in mutations:
+                if kind == "append":
+                    appended_after -= 1
+                elif kind in ("comment", "consultation_comment"):
+                    # Un commentaire « patient » ne touche pas les consultations ajoutées après lui
+                    patches.append((kind, args[0], args[1], appended_after))
+            if patches:
+                self.write_patches(patches)
+            tombstone_operations = [(m[0], m[1]) for m in mutations if m[0] in ("delete", "restore")]
+            if tombstone_operations:
+                self.update_tombstones(tombstone_operations)
+
+    def materialize(self):
+        pass
+
+class JournalConsultationStore(ExcelConsultationStore):
+    def __init__(self):
+        self._pending = None
+
+    def exists(self):
+        return os.path.exists(EXCEL_FILE_PATH) or os.path.exists(JOURNAL_FILE_PATH)
+
+    def read_journal_rows(self):
+        return read_jsonl_entries(JOURNAL_FILE_PATH, "consultations")
+
+    def source_paths(self):
+        return [EXCEL_FILE_PATH, JOURNAL_FILE_PATH]
+
+    def read_stored(self):
+        return cached_frame(("journal", EXCEL_FILE_PATH), self.source_paths(), self.load_merged)
+
+    def load_merged(self):
+        df = self.read_snapshot()
+        journal_rows = self.read_journal_rows()
+        if journal_rows:
+            df_journal = typed_consultation_frame(pd.DataFrame(journal_rows, columns=CONSULTATION_COLUMNS))
+            df = df_journal if df.empty else pd.concat([df, df_journal], ignore_index=True)
+        return df
+
+    def write_all(self, df):
+        # df contient la vue complète (classeur + journal) : le journal est donc vidé après écriture
+        with consultation_write_lock():
+            super().write_all(df)
+            if os.path.exists(JOURNAL_FILE_PATH):
+                os.remove(JOURNAL_FILE_PATH)
+                invalidate_frame_cache(JOURNAL_FILE_PATH)
+            self._pending = 0
+
+    def append(self, row):
+        self.append_rows([row])
+
+    def append_rows(self, rows):
+        with consultation_write_lock():
+            if self._pending is None:
+                self._pending = len(self.read_journal_rows())
+            append_jsonl_entries(JOURNAL_FILE_PATH, rows)
+            self._pending += len(rows)
+            if self._pending >= JOURNAL_MATERIALIZE_EVERY:
+                # Export du classeur hors de la requête pour garder un coût d'enregistrement constant
+                self._pending = 0
+                threading.Thread(target=self.materialize, daemon=True).start()
+
+    def materialize(self):
+        with consultation_write_lock():
+            if os.path.exists(JOURNAL_FILE_PATH) or os.path.exists(PATCH_FILE_PATH):
+                # Lignes supprimées conservées : elles restent restaurables jusqu'à la compaction
+                self.write_all(self.read_rows())
+
+def _sqlite_value(value):
+    if value is None or (not isinstance(value, str) and pd.isnull(value)):
+        return None
+    if isinstance(value, float) and value.is_integer():
+        # pandas lit une colonne d'entiers contenant des vides en float (ex: ID 12 -> 12.0)
+        return str(int(value))
+    return str(value)
+
+class SQLiteConsultationStore:
+    def __init__(self):
+        self._local = threading.local()
+
+    def connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.path != SQLITE_FILE_PATH:
+            conn = sqlite3.connect(SQLITE_FILE_PATH, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.path = conn, SQLITE_FILE_PATH
+            self.create_schema(conn)
+        return conn
+
+    def create_schema(self, conn):
+        columns_sql = ", ".join(f"{col} TEXT" for col in CONSULTATION_COLUMNS)
+        with conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS consultations (id INTEGER PRIMARY KEY AUTOINCREMENT, {columns_sql})")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_consultations_patient_id ON consultations (patient_id)")
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_consultations_consultation_id ON consultations (consultation_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_consultations_date ON consultations (consultation_date)")
+            conn.execute("CREATE TABLE IF NOT EXISTS storage_meta (key TEXT PRIMARY KEY, value TEXT)")
+            # Corbeille : lignes supprimées conservées jusqu'à la compaction pour pouvoir les restaurer
+            conn.execute("CREATE TABLE IF NOT EXISTS deleted_consultations (consultation_id TEXT PRIMARY KEY, row_json TEXT, deleted_at TEXT)")
+
+    # Sous le verrou du classeur : un seul processus migre, les autres trouvent la marque
+    def ensure_migrated(self):
+        with consultation_write_lock():
+            migrated = self.connect().execute("SELECT value FROM storage_meta WHERE key = 'migrated_from_excel'").fetchone()
+            if not migrated:
+                self.migrate_from_excel()
+
+    def migrate_from_excel(self):
+        # Reprise du classeur (et d'un éventuel journal en attente) dans la base
+        df = JournalConsultationStore().read_all()
+        self.replace_all(df)
+        with self.connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO storage_meta (key, value) VALUES ('migrated_from_excel', ?)",
+                         (datetime.now().isoformat(),))
+        print(f"Migration SQLite : {len(df)} consultation(s) importée(s) depuis {EXCEL_FILE_PATH}")
+
+    def replace_all(self, df):
+        conn = self.connect()
+        df = df.reindex(columns=CONSULTATION_COLUMNS)
+        if df["consultation_id"].isnull().any():
+            df = df.copy()
+            missing = df["consultation_id"].isnull()
+            df.loc[missing, "consultation_id"] = [str(uuid.uuid4()) for _ in range(missing.sum())]
+        rows = [tuple(_sqlite_value(v) for v in row) for row in df.itertuples(index=False, name=None)]
+        placeholders = ", ".join("?" for _ in CONSULTATION_COLUMNS)
+        with _consultation_lock, conn:
+            conn.execute("DELETE FROM consultations")
+            conn.executemany(f"INSERT OR REPLACE INTO consultations ({', '.join(CONSULTATION_COLUMNS)}) VALUES ({placeholders})", rows)
+
+    # Colonnes stockées en TEXT : mêmes types à la lecture que les modes classeur et journal
+    # (mesures numériques pour les tris, textes en chaînes)
+    def query(self, where="", params=()):
+        sql = f"SELECT {', '.join(CONSULTATION_COLUMNS)} FROM consultations {where} ORDER BY id"
+        return typed_consultation_frame(pd.read_sql_query(sql, self.connect(), params=params))
+
+    def exists(self):
+        return self.connect().execute("SELECT 1 FROM consultations LIMIT 1").fetchone() is not None
+
+    def read_all(self):
+        return self.query()
+
+    def read_columns(self, columns):
+        columns = [col for col in columns if col in CONSULTATION_COLUMNS]
+        return typed_consultation_frame(pd.read_sql_query(f"SELECT {', '.join(columns)} FROM consultations ORDER BY id", self.connect()))
+
+    def read_patient(self, patient_id):
+        return self.query("WHERE patient_id = ?", (patient_id,))
+
+    def read_patients(self, patient_ids):
+        patient_ids = list(patient_ids)
+        if not patient_ids:
+            return pd.DataFrame(columns=CONSULTATION_COLUMNS)
+        return self.query(f"WHERE patient_id IN ({', '.join('?' for _ in patient_ids)})", tuple(patient_ids))
+
+    def find_patient_name(self, patient_id):
+        row = self.connect().execute("SELECT patient_name FROM consultations WHERE patient_id = ? LIMIT 1", (patient_id,)).fetchone()
+        return None if row is None else str(row[0])
+
+    def append(self, row):
+        placeholders = ", ".join("?" for _ in CONSULTATION_COLUMNS)
+        conn = self.connect()
+        with conn:
+            conn.execute(f"INSERT INTO consultations ({', '.join(CONSULTATION_COLUMNS)}) VALUES ({placeholders})",
+                         tuple(_sqlite_value(row.get(col)) for col in CONSULTATION_COLUMNS))
+
+    def delete(self, consultation_id):
+        conn = self.connect()
+        with conn:
+            deleted = self.delete_row(conn, consultation_id)
+        if deleted:
+            self.purge_trash()
+        return deleted
+
+    def restore(self, consultation_id):
+        conn = self.connect()
+        with conn:
+            return self.restore_row(conn, consultation_id)
+
+    # Suppression par l'index unique sur consultation_id ; la ligne (avec son id d'origine,
+    # pour garder l'ordre d'affichage) part dans la corbeille
+    def delete_row(self, conn, consultation_id):
+        row = conn.execute(f"SELECT id, {', '.join(CONSULTATION_COLUMNS)} FROM consultations WHERE consultation_id = ?",
+                           (consultation_id,)).fetchone()
+        if row is None:
+            return False
+        conn.execute("INSERT OR REPLACE INTO deleted_consultations (consultation_id, row_json, deleted_at) VALUES (?, ?, ?)",
+                     (consultation_id, json.dumps(dict(zip(["id"] + CONSULTATION_COLUMNS, row)), ensure_ascii=False),
+                      datetime.now().isoformat(timespec="seconds")))
+        conn.execute("DELETE FROM consultations WHERE consultation_id = ?", (consultation_id,))
+        return True
+
+    def restore_row(self, conn, consultation_id):
+        row = conn.execute("SELECT row_json FROM deleted_consultations WHERE consultation_id = ?", (consultation_id,)).fetchone()
+        if row is None:
+            return False
+        values = json.loads(row[0])
+        columns = ["id"] + CONSULTATION_COLUMNS
+        conn.execute(f"INSERT OR REPLACE INTO consultations ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                     tuple(values.get(col) for col in columns))
+        conn.execute("DELETE FROM deleted_consultations WHERE consultation_id = ?", (consultation_id,))
+        return True
+
+    def pending_deletions(self):
+        return self.connect().execute("SELECT COUNT(*) FROM deleted_consultations").fetchone()[0]
+
+    # Purge de la corbeille, dans sa propre transaction après la suppression : seules les
+    # lignes sorties du délai d'annulation sont retirées
+    def purge_trash(self):
+        conn = self.connect()
+        deleted = conn.execute("SELECT COUNT(*) FROM deleted_consultations").fetchone()[0]
+        if compaction_due(deleted, conn.execute("SELECT COUNT(*) FROM consultations").fetchone()[0]):
+            self.compact()
+
+    def compact(self, grace=None):
+        conn = self.connect()
+        with conn:
+            return conn.execute("DELETE FROM deleted_consultations WHERE deleted_at <= ?",
+                                (tombstone_cutoff(grace),)).rowcount
+
+    def set_patient_comment(self, patient_id, comment):
+        conn = self.connect()
+        with conn:
+            conn.execute("UPDATE consultations SET doctor_comment = ? WHERE patient_id = ?", (comment, patient_id))
+
+    def set_consultation_comment(self, consultation_id, comment):
+        conn = self.connect()
+        with conn:
+            return conn.execute("UPDATE consultations SET doctor_comment = ? WHERE consultation_id = ?",
+                                (comment, consultation_id)).rowcount > 0
+
+    def pending_patches(self):
+        return 0
+
+    def apply_batch(self, mutations):
+        # Une seule transaction (et donc une seule synchronisation disque) pour tout le lot
+        placeholders = ", ".join("?" for _ in CONSULTATION_COLUMNS)
+        conn = self.connect()
+        with conn:
+            for kind, *args in mutations:
+                if kind == "append":
+                    conn.execute(f"INSERT INTO consultations ({', '.join(CONSULTATION_COLUMNS)}) VALUES ({placeholders})",
+                                 tuple(_sqlite_value(args[0].get(col)) for col in CONSULTATION_COLUMNS))
+                elif kind == "delete":
+                    self.delete_row(conn, args[0])
+                elif kind == "restore":
+                    self.restore_row(conn, args[0])
+                elif kind == "comment":
+                    conn.execute("UPDATE consultations SET doctor_comment = ? WHERE patient_id = ?", (args[1], args[0]))
+                elif kind == "consultation_comment":
+                    conn.execute("UPDATE consultations SET doctor_comment = ? WHERE consultation_id = ?", (args[1], args[0]))
+        if any(kind == "delete" for kind, *args in mutations):
+            self.purge_trash()
+
+    def materialize(self):
+        # Export du contenu de la base vers le classeur (retour au mode Excel, sauvegarde)
+        with consultation_write_lock():
+            write_consultation_workbook(self.read_all())
+            # L'export est complet : les suppressions et commentaires en attente du classeur ne s'appliquent plus
+            clear_tombstones()
+            remove_side_file(PATCH_FILE_PATH)
+
+CONSULTATION_STORES = {
+    "excel": ExcelConsultationStore(),
+    "journal": JournalConsultationStore(),
+    "sqlite": SQLiteConsultationStore(),
+}
+
+if CONSULTATION_STORAGE == "sqlite" and not PDF_RENDER_WORKER:
+    CONSULTATION_STORES["sqlite"].ensure_migrated()
+
+# Le mode de stockage est partagé par tous les workers via config.json : il est relu dès
+# que le fichier change (comparaison de sa signature à chaque accès au stockage), sauf
+# s'il est imposé par MEDICSAS_STORAGE
+_storage_config_signature = [_file_signature([CONFIG_FILE])]
+
+def refresh_consultation_storage():
+    global CONSULTATION_STORAGE
+    if os.environ.get("MEDICSAS_STORAGE"):
+        return
+    signature = _file_signature([CONFIG_FILE])
+    if signature == _storage_config_signature[0]:
+        return
+    try:
+        mode = load_config().get("consultation_storage")
+    except ValueError:
+        return
+    _storage_config_signature[0] = signature
+    # Clé absente (nouveau dossier de données pas encore configuré) : le mode courant est gardé
+    if mode in CONSULTATION_STORES and mode != CONSULTATION_STORAGE:
+        CONSULTATION_STORAGE = mode
+        if mode == "sqlite":
+            CONSULTATION_STORES["sqlite"].ensure_migrated()
+
+def consultation_store():
+    refresh_consultation_storage()
+    return CONSULTATION_STORES.get(CONSULTATION_STORAGE, CONSULTATION_STORES["excel"])
+
+# Store choisi sous le verrou du classeur : un lot ne part pas dans l'ancien stockage
+# pendant qu'un autre worker change de mode
+def apply_consultation_batch(mutations):
+    with consultation_write_lock():
+        consultation_store().apply_batch(mutations)
+
+def switch_consultation_storage(mode):
+    global CONSULTATION_STORAGE
+    if mode not in CONSULTATION_STORES or mode == consultation_storage_mode():
+        return
+    # Hors verrou : le thread écrivain doit pouvoir prendre le verrou pour vider sa file
+    flush_consultation_writes()
+    with consultation_write_lock():
+        if mode == consultation_storage_mode():
+            return
+        # Le classeur est remis à jour avant de quitter le mode courant
+        consultation_store().materialize()
+        CONSULTATION_STORAGE = mode
+        if mode == "sqlite":
+            CONSULTATION_STORES["sqlite"].migrate_from_excel()
+        # Publié avant de rendre le verrou : les autres workers écrivent ensuite dans le nouveau stockage
+        config = load_config()
+        config["consultation_storage"] = mode
+        save_config(config)
+        _storage_config_signature[0] = _file_signature([CONFIG_FILE])
+
+def consultation_storage_mode():
+    refresh_consultation_storage()
+    return CONSULTATION_STORAGE
+
+# -----------------------------------------------------------------------------
+# File d'écriture différée : les routes déposent leurs mutations (ajout, suppression,
+# commentaire) et rendent la main ; un thread écrivain unique les applique par lots,
+# au plus tard WRITE_BEHIND_MAX_LATENCY après la plus ancienne, ou dès que
+# WRITE_BEHIND_MAX_BATCH mutations attendent
+# -----------------------------------------------------------------------------
+CONSULTATION_WRITE_BEHIND = bool(load_config().get("consultation_write_behind", True))
+WRITE_BEHIND_MAX_LATENCY = float(load_config().get("write_behind_max_latency_ms", 250)) / 1000
+WRITE_BEHIND_MAX_BATCH = int(load_config().get("write_behind_max_batch", 50))
+# Attente maximale d'une requête qui doit relire ses propres écritures
+WRITE_BEHIND_READ_TIMEOUT = 10
+# Tentatives d'un lot avant de rejouer ses mutations une à une, puis d'une mutation seule
+# avant de la mettre de côté dans DEADLETTER_FILE_PATH
+WRITE_BEHIND_MAX_ATTEMPTS = int(load_config().get("write_behind_max_attempts", 3))
+
+# Marqueur de durabilité d'un processus : dernier numéro de mutation sur disque, publié à
+# côté du classeur pour les autres workers (lecture de ses propres écritures quand la
+# requête suivante d'une session arrive ailleurs). Les marqueurs de plus d'un jour sont
+# retirés au démarrage
+DURABLE_MARKER_MAX_AGE = 86400
+
+def durable_marker_path(writer_id):
+    return f"{os.path.splitext(EXCEL_FILE_PATH)[0]}.durable.{secure_filename(str(writer_id))}"
+
+def read_durable_marker(writer_id):
+    try:
+        with open(durable_marker_path(writer_id), "r", encoding="utf-8") as f:
+            return int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+def wait_for_durable_marker(writer_id, seq, timeout):
+    deadline = time.monotonic() + timeout
+    while read_durable_marker(writer_id) < seq:
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+def prune_durable_markers():
+    folder = os.path.dirname(EXCEL_FILE_PATH)
+    prefix = os.path.basename(durable_marker_path(""))
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        try:
+            if name.startswith(prefix) and time.time() - os.path.getmtime(path) > DURABLE_MARKER_MAX_AGE:
+                os.remove(path)
+        except OSError:
+            pass
+
+class ConsultationWriteQueue:
+    def __init__(self, max_latency, max_batch):
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+        self._writer_pid = None
+        self._writer_id = None
+        self.cond = threading.Condition()
+        self.pending = []  # (seq, mutation, instant de dépôt)
+        self.next_seq = 0
+        self.durable_seq = 0
+        self.flush_requested = False
+        self.thread = None
+        self.stats = {"batches": 0, "mutations": 0, "largest_batch": 0, "errors": 0,
+                      "last_error": None, "last_durable_at": None, "last_flush_ms": None,
+                      "dead_letters": 0, "last_dead_letter": None}
+
+    # Identifiant propre au processus : un objet créé avant un fork (gunicorn --preload)
+    # en prend un nouveau dans chaque worker
+    @property
+    def writer_id(self):
+        if self._writer_pid != os.getpid():
+            self._writer_pid, self._writer_id = os.getpid(), f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        return self._writer_id
+
+    def publish_durable(self, seq):
+        path = durable_marker_path(self.writer_id)
+        try:
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(str(seq))
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            print(f"Avertissement : marqueur d'écriture non publié ({e}).")
+
+    def submit(self, kind, *args):
+        with self.cond:
+            self.next_seq += 1
+            self.pending.append((self.next_seq, (kind,) + args, time.monotonic()))
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="consultation-writer", daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+            return self.next_seq
+
+    def wait_for(self, seq, timeout=None):
+        with self.cond:
+            if self.durable_seq < seq:
+                # Une requête attend ses propres écritures : inutile d'attendre la fin de la fenêtre
+                self.flush_requested = True
+                self.cond.notify_all()
+            return self.cond.wait_for(lambda: self.durable_seq >= seq, timeout)
+
+    def flush(self, timeout=None):
+        with self.cond:
+            target = self.next_seq
+            if self.pending:
+                self.flush_requested = True
+                self.cond.notify_all()
+            return self.cond.wait_for(lambda: self.durable_seq >= target, timeout)
+
+    def run(self):
+        delay, attempts, isolate_until = 0.1, 0, 0
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending)
+                # Lot fautif entièrement rejoué : retour au regroupement habituel
+                if isolate_until and self.pending[0][0] > isolate_until:
+                    isolate_until = 0
+                deadline = self.pending[0][2] + self.max_latency
+                while len(self.pending) < self.max_batch and not self.flush_requested and not isolate_until:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                # Mutations d'un lot en échec : rejouées une à une pour isoler la fautive
+                batch = self.pending[:1 if self.pending[0][0] <= isolate_until else self.max_batch]
+            start = time.perf_counter()
+            try:
+                apply_consultation_batch([mutation for _, mutation, _ in batch])
+            except Exception as e:
+                # Le lot reste en tête de file et sera rejoué (classeur verrouillé, disque plein...)
+                attempts += 1
+                with self.cond:
+                    self.stats["errors"] += 1
+                    self.stats["last_error"] = f"{datetime.now().isoformat(timespec='seconds')} {e}"
+                # Verrou du classeur tenu par un autre processus : passager, le lot n'est pas en cause
+                if attempts >= WRITE_BEHIND_MAX_ATTEMPTS and not isinstance(e, Timeout):
+                    if len(batch) > 1:
+                        isolate_until, attempts, delay = batch[-1][0], 0, 0.1
+                        continue
+                    if self.quarantine(batch[0], e):
+                        attempts, delay = 0, 0.1
+                        continue
+                time.sleep(delay)
+                delay = min(delay * 2, 5)
+                continue
+            delay, attempts = 0.1, 0
+            # Marqueur publié et patients enregistrés avant de réveiller les requêtes qui attendent ce lot
+            self.publish_durable(batch[-1][0])
+            register_stored_patients([mutation for _, mutation, _ in batch])
+            with self.cond:
+                del self.pending[:len(batch)]
+                # Le lot est sur disque (fsync du classeur, du journal ou commit SQLite)
+                self.durable_seq = batch[-1][0]
+                if not self.pending:
+                    self.flush_requested = False
+                self.stats["batches"] += 1
+                self.stats["mutations"] += len(batch)
+                self.stats["largest_batch"] = max(self.stats["largest_batch"], len(batch))
+                self.stats["last_error"] = None
+                self.stats["last_durable_at"] = datetime.now().isoformat(timespec="seconds")
+                self.stats["last_flush_ms"] = round((time.perf_counter() - start) * 1000, 1)
+                self.cond.notify_all()
+
+    # Nom du patient d'une consultation encore en file (pas encore visible dans le stockage)
+    def pending_patient_name(self, patient_id):
+        with self.cond:
+            for _, mutation, _ in reversed(self.pending):
+                if mutation[0] == "append" and str(mutation[1].get("patient_id")) == patient_id:
+                    return str(mutation[1].get("patient_name"))
+        return None
+
+    # Mutation qui échoue seule malgré les tentatives : mise de côté pour ne plus bloquer les
+    # suivantes ; elle compte comme traitée pour les requêtes qui attendent leurs écritures
+    def quarantine(self, entry, error):
+        seq, mutation, _ = entry
+        record = {"seq": seq, "failed_at": datetime.now().isoformat(timespec="seconds"), "error": str(error),
+                  "mutation": json.loads(json.dumps(list(mutation), ensure_ascii=False, default=str))}
+        try:
+            append_jsonl_entries(DEADLETTER_FILE_PATH, [record])
+        except OSError:
+            return False
+        print(f"Avertissement : mutation {mutation[0]} mise de côté dans {DEADLETTER_FILE_PATH} ({error}).")
+        self.publish_durable(seq)
+        with self.cond:
+            del self.pending[0]
+            self.durable_seq = seq
+            if not self.pending:
+                self.flush_requested = False
+            self.stats["dead_letters"] += 1
+            self.stats["last_dead_letter"] = {key: record[key] for key in ("seq", "failed_at", "error")}
+            self.stats["last_dead_letter"]["kind"] = mutation[0]
+            self.cond.notify_all()
+        return True
+
+    def health(self):
+        with self.cond:
+            oldest = self.pending[0][2] if self.pending else None
+            return dict(self.stats,
+                        enabled=CONSULTATION_WRITE_BEHIND,
+                        max_latency_ms=round(self.max_latency * 1000),
+                        max_batch=self.max_batch,
+                        pending=len(self.pending),
+                        oldest_pending_ms=None if oldest is None else round((time.monotonic() - oldest) * 1000),
+                        submitted_seq=self.next_seq,
+                        durable_seq=self.durable_seq,
+                        dead_letter_file=DEADLETTER_FILE_PATH)
+
+consultation_writer = ConsultationWriteQueue(WRITE_BEHIND_MAX_LATENCY, WRITE_BEHIND_MAX_BATCH)
+# Les mutations encore en file sont écrites avant l'arrêt du processus
+if not PDF_RENDER_WORKER:
+    atexit.register(consultation_writer.flush, 30)
+    prune_durable_markers()
+
+def submit_consultation_mutation(kind, *args):
+    if not CONSULTATION_WRITE_BEHIND:
+        apply_consultation_batch([(kind,) + args])
+        register_stored_patients([(kind,) + args])
+        return
+    seq = consultation_writer.submit(kind, *args)
+    if has_request_context():
+        # Lecture de ses propres écritures : la requête suivante de cette session attend ce numéro
+        session["write_seq"] = seq
+        session["write_writer"] = consultation_writer.writer_id
+
+# Registre des patients mis à jour une fois la consultation sur disque : un ajout mis de
+# côté (DEADLETTER_FILE_PATH) n'y laisse pas de patient jamais enregistré
+def register_stored_patients(mutations):
+    for kind, *args in mutations:
+        if kind == "append":
+            register_patient(args[0])
+
+def flush_consultation_writes():
+    if not consultation_writer.flush(CONSULTATION_LOCK_TIMEOUT):
+        raise RuntimeError("Des consultations en attente n'ont pas pu être enregistrées.")
+
+# -----------------------------------------------------------------------------
+# Registre des patients (un enregistrement compact par patient)
+# -----------------------------------------------------------------------------
+PATIENT_COLUMNS = ['patient_id', 'patient_name', 'age', 'patient_phone', 'antecedents', 'date_of_birth', 'gender']
+
+def _registry_value(value):
+    return _sqlite_value(value) or ""
+
+class PatientRecord:
+    __slots__ = ("patient_id", "name", "age", "phone", "antecedents", "date_of_birth", "gender")
+
+    def __init__(self, patient_id, name, age, phone, antecedents, date_of_birth, gender):
+        self.patient_id = patient_id
+        self.name = name
+        # Valeurs très répétées (sexe, âge) : une seule chaîne en mémoire pour tous les patients
+        self.age = sys.intern(age)
+        self.phone = phone
+        self.antecedents = antecedents
+        self.date_of_birth = date_of_birth
+        self.gender = sys.intern(gender)
+
+    @classmethod
+    def from_values(cls, patient_id, name, age, phone, antecedents, date_of_birth, gender):
+        return cls(*(_registry_value(v) for v in (patient_id, name, age, phone, antecedents, date_of_birth, gender)))
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "age": self.age,
+            "phone": self.phone,
+            "antecedents": self.antecedents,
+            "date_of_birth": self.date_of_birth,
+            "gender": self.gender
+        }
+
+def _insert_sorted(values, value):
+    # Insertion dichotomique dans une liste triée sans tenir compte de la casse (même ordre que sorted(key=str.lower))
+    key = value.lower()
+    lo, hi = 0, len(values)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if values[mid].lower() <= key:
+            lo = mid + 1
+        else:
+            hi = mid
+    values.insert(lo, value)
+
+def fold_text(text):
+    # Minuscules sans accents : "Élodie Benaïssa" -> "elodie benaissa"
+    text = str(text)
+    if text.isascii():
+        return text.lower().strip()
+    text = unicodedata.normalize("NFKD", text)
+    return "".join(ch for ch in text if not unicodedata.combining(ch)).lower().strip()
+
+def _compact(folded):
+    # Sans espaces ni ponctuation, pour rapprocher "Ben Ali" et "Benali"
+    return "".join(filter(str.isalnum, folded))
+
+def _trigrams(compact, padded=True):
+    text = f"  {compact} " if padded else compact
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def _posting_contains(posting, slot, lo=0):
+    i = bisect.bisect_left(posting, slot, lo)
+    return i < len(posting) and posting[i] == slot
+
+# Candidats examinés au plus par recherche approchée (les trigrammes rares d'abord)
+SEARCH_CANDIDATE_LIMIT = 2000
+
+class PatientSearchIndex:
+    # Index de recherche des patients : chaque patient reçoit un numéro (slot) ; on garde
+    # son nom replié et compact, des clés triées (préfixes) avec leur slot dans un tableau
+    # parallèle, et pour chaque trigramme le tableau trié des slots qui le contiennent
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.patient_ids = []    # slot -> patient_id
+            self.names = []          # slot -> nom replié compact (None : slot remplacé)
+            self.slots = {}          # patient_id -> slot
+            self.prefix_keys = []
+            self.prefix_slots = array("i")
+            self.trigrams = {}       # trigramme -> array("i") de slots croissants
+
+    def _keys(self, patient_id, folded_name, compact_name):
+        keys = {fold_text(patient_id), compact_name} | set(folded_name.split())
+        keys.discard("")
+        return [sys.intern(key) for key in keys]
+
+    def add(self, record, keep_sorted=True):
+        with self._lock:
+            folded_name = fold_text(record.name)
+            compact_name = _compact(folded_name)
+            old = self.slots.get(record.patient_id)
+            if old is not None:
+                if self.names[old] == compact_name:
+                    return
+                # Le nom a changé : l'ancien slot est abandonné (ignoré à la lecture)
+                self.names[old] = None
+            slot = len(self.patient_ids)
+            self.patient_ids.append(record.patient_id)
+            self.names.append(compact_name)
+            self.slots[record.patient_id] = slot
+            for key in self._keys(record.patient_id, folded_name, compact_name):
+                if keep_sorted:
+                    i = bisect.bisect_right(self.prefix_keys, key)
+                    self.prefix_keys.insert(i, key)
+                    self.prefix_slots.insert(i, slot)
+                else:
+                    self.prefix_keys.append(key)
+                    self.prefix_slots.append(slot)
+            if compact_name:
+                # Slots attribués dans l'ordre croissant : les tableaux restent triés
+                for gram in _trigrams(compact_name):
+                    posting = self.trigrams.get(gram)
+                    if posting is None:
+                        posting = self.trigrams[gram] = array("i")
+                    posting.append(slot)
+
+    def remove(self, patient_id):
+        with self._lock:
+            slot = self.slots.pop(patient_id, None)
+            if slot is not None:
+                self.names[slot] = None
+
+    def build(self, records):
+        with self._lock:
+            self.clear()
+            for record in records:
+                self.add(record, keep_sorted=False)
+            order = sorted(range(len(self.prefix_keys)), key=self.prefix_keys.__getitem__)
+            self.prefix_keys = [self.prefix_keys[i] for i in order]
+            self.prefix_slots = array("i", (self.prefix_slots[i] for i in order))
+
+    def _prefix_slots(self, prefix, max_results):
+        found = []
+        i = bisect.bisect_left(self.prefix_keys, prefix)
+        while i < len(self.prefix_keys) and len(found) < max_results:
+            if not self.prefix_keys[i].startswith(prefix):
+                break
+            slot = self.prefix_slots[i]
+            if self.names[slot] is not None:
+                found.append(slot)
+            i += 1
+        return found
+
+    def _candidates(self, grams):
+        # Nombre de trigrammes partagés, en partant des trigrammes les plus rares ; au-delà de
+        # SEARCH_CANDIDATE_LIMIT candidats, les listes suivantes ne font que compléter les
+        # comptes existants (recherche dichotomique) au lieu d'être parcourues
+        postings = sorted((self.trigrams[gram] for gram in grams if gram in self.trigrams), key=len)
+        counts = {}
+        for posting in postings:
+            start = 0
+            if len(counts) < SEARCH_CANDIDATE_LIMIT:
+                start = len(posting)
+                for i, slot in enumerate(posting):
+                    if slot in counts:
+                        counts[slot] += 1
+                    elif len(counts) < SEARCH_CANDIDATE_LIMIT:
+                        counts[slot] = 1
+                    else:
+                        start = i
+                        break
+            if start < len(posting):
+                first = posting[start]
+                for slot in counts:
+                    if slot >= first and _posting_contains(posting, slot, start):
+                        counts[slot] += 1
+        return counts
+
+    def search(self, query, limit=10):
+        folded = fold_text(query)
+        compact = _compact(folded)
+        if not compact:
+            return []
+        with self._lock:
+            scores = {}
+            for prefix in {folded, compact}:
+                for slot in self._prefix_slots(prefix, limit * 20):
+                    scores[slot] = 0.9
+            # Similarité de Dice sur les trigrammes du nom compact, candidats seulement
+            query_grams = _trigrams(compact)
+            for slot, count in self._candidates(query_grams).items():
+                compact_name = self.names[slot]
+                if compact_name is None:
+                    continue
+                dice = 2.0 * count / (len(query_grams) + len(_trigrams(compact_name)))
+                if compact_name == compact:
+                    score = 1.0
+                elif compact in compact_name:
+                    score = 0.6 + 0.3 * dice
+                elif dice >= 0.3:
+                    score = 0.7 * dice
+                else:
+                    continue
+                if score > scores.get(slot, 0):
+                    scores[slot] = score
+            exact = self.slots.get(query.strip())
+            for slot in list(scores) + ([exact] if exact is not None else []):
+                patient_id = self.patient_ids[slot]
+                if len(patient_id) == len(folded) and fold_text(patient_id) == folded:
+                    scores[slot] = 1.0
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], self.patient_ids[item[0]].lower()))
+            return [(self.patient_ids[slot], round(score, 3)) for slot, score in ranked[:limit]]
+
+    def matching_ids(self, query):
+        # Patients dont le nom contient la requête (sans accents, espaces ni casse)
+        compact = _compact(fold_text(query))
+        if not compact:
+            return set()
+        with self._lock:
+            if len(compact) < 3:
+                return {self.patient_ids[slot] for slot, name in enumerate(self.names)
+                        if name is not None and compact in name}
+            postings = []
+            for gram in _trigrams(compact, padded=False):
+                posting = self.trigrams.get(gram)
+                if posting is None:
+                    return set()
+                postings.append(posting)
+            postings.sort(key=len)
+            # Intersection en partant de la liste la plus courte
+            candidates = postings[0]
+            for posting in postings[1:]:
+                candidates = [slot for slot in candidates if _posting_contains(posting, slot)]
+                if not candidates:
+                    return set()
+            return {self.patient_ids[slot] for slot in candidates
+                    if self.names[slot] is not None and compact in self.names[slot]}
+
+class PatientRegistry:
+    def __init__(self):
+        self.by_id = {}
+        self.name_to_id = {}
+        self.ids = []
+        self.names = []
+        self._search = None
+        self._search_lock = threading.Lock()
+        self._search_dirty = False
+        self._search_thread = None
+        self.version = 0
+
+    # Index de recherche préparé en arrière-plan après chaque chargement (démarrage, import,
+    # changement de dossier) : construit une première fois, puis mis à jour en place. La
+    # recherche continue de servir l'index courant pendant ce temps ; elle n'attend que si
+    # aucun index n'a encore été construit
+    @property
+    def search(self):
+        thread = self._search_thread
+        if self._search is None and thread is not None:
+            thread.join()
+        with self._search_lock:
+            if self._search is None:
+                index = PatientSearchIndex()
+                index.build(list(self.by_id.values()))
+                self._search = index
+            return self._search
+
+    def refresh_search_index(self):
+        with self._search_lock:
+            self._search_dirty = True
+            if self._search_thread is None:
+                self._search_thread = threading.Thread(target=self._refresh_search_index,
+                                                       name="patient-search-index", daemon=True)
+                self._search_thread.start()
+
+    def _refresh_search_index(self):
+        while True:
+            with self._search_lock:
+                if not self._search_dirty:
+                    self._search_thread = None
+                    return
+                self._search_dirty = False
+                index = self._search
+            records = dict(self.by_id)
+            if index is None:
+                index = PatientSearchIndex()
+                index.build(records.values())
+                with self._search_lock:
+                    if self._search is None:
+                        # Patients enregistrés pendant la construction
+                        for patient_id, record in list(self.by_id.items()):
+                            if records.get(patient_id) is not record:
+                                index.add(record)
+                        self._search = index
+                        continue
+                    index = self._search
+            # Mise à jour en place : les patients inchangés ne coûtent qu'une comparaison de nom
+            with self._search_lock:
+                stale = [patient_id for patient_id in index.slots if patient_id not in self.by_id]
+                for patient_id in stale:
+                    index.remove(patient_id)
+            for patient_id, record in records.items():
+                with self._search_lock:
+                    if self.by_id.get(patient_id) is record:
+                        index.add(record)
+
+    def clear(self):
+        self.by_id.clear()
+        self.name_to_id.clear()
+        self.ids.clear()
+        self.names.clear()
+        self.refresh_search_index()
+        self.version += 1
+
+    def get(self, patient_id):
+        return self.by_id.get(patient_id)
+
+    def get_by_name(self, name):
+        patient_id = self.name_to_id.get(name)
+        return None if patient_id is None else self.by_id.get(patient_id)
+
+    def update_from_frame(self, df, replace=False):
+        # Chargement en masse (démarrage, import) : la dernière consultation de chaque patient
+        # fait foi ; replace : le registre est remplacé (rechargement complet) au lieu d'être complété
+        by_id = {} if replace else dict(self.by_id)
+        name_to_id = {} if replace else dict(self.name_to_id)
+        for values in zip(*(df[col] for col in PATIENT_COLUMNS)):
+            record = PatientRecord.from_values(*values)
+            if record.patient_id:
+                by_id[record.patient_id] = record
+                if record.name:
+                    name_to_id[record.name] = record.patient_id
+        self.by_id, self.name_to_id = by_id, name_to_id
+        self.ids[:] = sorted(by_id, key=str.lower)
+        self.names[:] = sorted(name_to_id, key=str.lower)
+        self.refresh_search_index()
+        self.version += 1
+
+    def register(self, row):
+        # Mise à jour incrémentale après un enregistrement (au lieu d'une reconstruction complète)
+        record = PatientRecord.from_values(*(row.get(col, "") for col in PATIENT_COLUMNS))
+        if not record.patient_id:
+            return
+        if record.patient_id not in self.by_id:
+            _insert_sorted(self.ids, record.patient_id)
+        if record.name and record.name not in self.name_to_id:
+            _insert_sorted(self.names, record.name)
+        self.by_id[record.patient_id] = record
+        if record.name:
+            self.name_to_id[record.name] = record.patient_id
+        # Index pas encore construit : il partira de by_id, déjà à jour
+        with self._search_lock:
+            if self._search is not None:
+                self._search.add(record)
+        self.version += 1
+
+    def suggest(self, field, prefix, limit=20):
+        if field != "id":
+            # Noms : recherche classée, insensible aux accents et aux espaces ("Benali" / "Ben Ali")
+            return [self.by_id[patient_id].name for patient_id, _ in self.search.search(prefix, limit)
+                    if self.by_id[patient_id].name]
+        # Identifiants : préfixe insensible à la casse dans la liste triée
+        values = self.ids
+        key = prefix.lower()
+        lo, hi = 0, len(values)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if values[mid].lower() < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        suggestions = []
+        for value in values[lo:lo + limit]:
+            if not value.lower().startswith(key):
+                break
+            suggestions.append(value)
+        return suggestions
+
+patient_registry = PatientRegistry()
 
 def load_patient_data():
-    global patient_ids, patient_names, patient_id_to_name, patient_name_to_id
-    global patient_name_to_age, patient_id_to_age, patient_name_to_phone, patient_id_to_phone
-    global patient_name_to_antecedents, patient_id_to_antecedents
-    global patient_name_to_dob, patient_id_to_dob, patient_name_to_gender, patient_id_to_gender
-    if os.path.exists(EXCEL_FILE_PATH):
-        df_patients = pd.read_excel(EXCEL_FILE_PATH, sheet_name=0)
-        required_columns = {'patient_id', 'patient_name', 'age', 'patient_phone', 'antecedents', 'date_of_birth', 'gender'}
-        if required_columns.issubset(set(df_patients.columns)):
-            df_patients['patient_id'] = df_patients['patient_id'].astype(str)
-            df_patients['patient_name'] = df_patients['patient_name'].astype(str)
-            df_patients['date_of_birth'] = df_patients['date_of_birth'].astype(str)
-            df_patients['gender'] = df_patients['gender'].astype(str)
-            patient_ids = sorted(df_patients['patient_id'].unique().tolist(), key=str.lower)
-            patient_names = sorted(df_patients['patient_name'].unique().tolist(), key=str.lower)
-            patient_id_to_name = dict(zip(df_patients['patient_id'], df_patients['patient_name']))
-            patient_name_to_id = dict(zip(df_patients['patient_name'], df_patients['patient_id']))
-            patient_name_to_age = dict(zip(df_patients['patient_name'], df_patients['age']))
-            patient_id_to_age = dict(zip(df_patients['patient_id'], df_patients['age']))
-            patient_name_to_phone = dict(zip(df_patients['patient_name'], df_patients['patient_phone']))
-            patient_id_to_phone = dict(zip(df_patients['patient_id'], df_patients['patient_phone']))
-            patient_name_to_antecedents = dict(zip(df_patients['patient_name'], df_patients['antecedents']))
-            patient_id_to_antecedents = dict(zip(df_patients['patient_id'], df_patients['antecedents']))
-            patient_name_to_dob = dict(zip(df_patients['patient_name'], df_patients['date_of_birth']))
-            patient_id_to_dob = dict(zip(df_patients['patient_id'], df_patients['date_of_birth']))
-            patient_name_to_gender = dict(zip(df_patients['patient_name'], df_patients['gender']))
-            patient_id_to_gender = dict(zip(df_patients['patient_id'], df_patients['gender']))
+    if consultation_store().exists():
+        df_patients = consultation_store().read_columns(PATIENT_COLUMNS)
+        if set(PATIENT_COLUMNS).issubset(set(df_patients.columns)):
+            patient_registry.update_from_frame(df_patients, replace=True)
         else:
             if has_request_context():
                 flash("Le fichier Excel ne contient pas les colonnes requises.", "error")
             else:
                 print("Erreur: Le fichier Excel ne contient pas les colonnes requises.")
     else:
-        patient_ids.clear()
-        patient_names.clear()
-        patient_id_to_name.clear()
-        patient_name_to_id.clear()
-        patient_name_to_age.clear()
-        patient_id_to_age.clear()
-        patient_name_to_phone.clear()
-        patient_id_to_phone.clear()
-        patient_name_to_antecedents.clear()
-        patient_id_to_antecedents.clear()
-        patient_name_to_dob.clear()
-        patient_id_to_dob.clear()
-        patient_name_to_gender.clear()
-        patient_id_to_gender.clear()
-
-load_patient_data()
+        patient_registry.clear()
+
+if not PDF_RENDER_WORKER:
+    load_patient_data()
+
+def register_patient(row):
+    patient_registry.register(row)
+
+@app.route("/get_patient")
+def get_patient():
+    patient_id = request.args.get("patient_id", "").strip()
+    patient_name = request.args.get("patient_name", "").strip()
+    record = patient_registry.get(patient_id) if patient_id else patient_registry.get_by_name(patient_name)
+    if record is None:
+        return jsonify({})
+    return jsonify(dict(record.to_dict(), patient_id=record.patient_id))
+
+@app.route("/suggest_patients")
+def suggest_patients():
+    q = request.args.get("q", "").strip()
+    field = request.args.get("field", "id")
+    limit = min(request.args.get("limit", 20, type=int), 100)
+    if not q:
+        return jsonify([])
+    return jsonify(patient_registry.suggest(field, q, limit))
+
+@app.route("/search_patients")
+def search_patients():
+    q = request.args.get("q", "").strip()
+    limit = min(request.args.get("limit", 10, type=int), 100)
+    results = []
+    for patient_id, score in patient_registry.search.search(q, limit):
+        record = patient_registry.get(patient_id)
+        results.append({"patient_id": patient_id, "name": record.name, "score": score})
+    return jsonify(results)
 
 @app.route("/get_last_consultation")
 def get_last_consultation():
     patient_id = request.args.get("patient_id", "").strip()
-    if patient_id and os.path.exists(EXCEL_FILE_PATH):
-        df = pd.read_excel(EXCEL_FILE_PATH, sheet_name=0)
-        df = df[df['patient_id'].astype(str) == patient_id]
+    if patient_id and consultation_store().exists():
+        df = consultation_store().read_patient(patient_id)
         if not df.empty:
             last_row = df.iloc[-1].to_dict()
             return json.dumps(last_row)
     return json.dumps({})
 
+def datatables_page(df, args):
+    # Protocole "serverSide" de DataTables : draw, start, length, columns[i][data], order[0][...], search[value]
+    requested_columns = []
+    i = 0
+    while f"columns[{i}][data]" in args:
+        requested_columns.append((args.get(f"columns[{i}][data]"),
+                                  args.get(f"columns[{i}][searchable]", "true") == "true",
+                                  args.get(f"columns[{i}][orderable]", "true") == "true"))
+        i += 1
+    columns = [col for col, _, _ in requested_columns if col in df.columns]
+    columns = list(dict.fromkeys(columns)) or list(df.columns)
+    records_total = len(df)
+
+    search_value = args.get("search[value]", "").strip().lower()
+    if search_value:
+        searchable = [col for col, is_searchable, _ in requested_columns if is_searchable and col in df.columns] or columns
+        mask = pd.Series(False, index=df.index)
+        for col in searchable:
+            mask |= df[col].fillna("").astype(str).str.lower().str.contains(search_value, regex=False)
+        df = df[mask]
+    records_filtered = len(df)
+
+    order_index = args.get("order[0][column]", type=int)
+    if order_index is not None and 0 <= order_index < len(requested_columns):
+        order_column, _, orderable = requested_columns[order_index]
+        if orderable and order_column in df.columns:
+            ascending = args.get("order[0][dir]", "asc") != "desc"
+            if pd.api.types.is_numeric_dtype(df[order_column]):
+                df = df.sort_values(order_column, ascending=ascending, kind="mergesort")
+            else:
+                df = df.sort_values(order_column, ascending=ascending, kind="mergesort",
+                                    key=lambda col: col.fillna("").astype(str).str.lower())
+
+    start = max(args.get("start", 0, type=int), 0)
+    length = args.get("length", -1, type=int)
+    page = df.iloc[start:] if length < 0 else df.iloc[start:start + length]
+    return {
+        "draw": args.get("draw", 0, type=int),
+        "recordsTotal": records_total,
+        "recordsFiltered": records_filtered,
+        "data": json.loads(page[columns].to_json(orient="records"))
+    }
+
 @app.route("/get_consultations")
 def get_consultations():
     patient_id = request.args.get("patient_id", "").strip()
-    if patient_id and os.path.exists(EXCEL_FILE_PATH):
-        df = pd.read_excel(EXCEL_FILE_PATH, sheet_name=0)
-        df = df[df['patient_id'].astype(str) == patient_id]
+    if "draw" in request.args:
+        if patient_id and consultation_store().exists():
+            df = consultation_store().read_patient(patient_id)
+        else:
+            df = pd.DataFrame(columns=CONSULTATION_COLUMNS)
+        return jsonify(datatables_page(df, request.args))
+    # Ancien format (liste complète) conservé pour les appels sans paramètres DataTables
+    if patient_id and consultation_store().exists():
+        df = consultation_store().read_patient(patient_id)
         return df.to_json(orient="records")
     return "[]"
 
@@ -654,21 +2223,163 @@ def delete_consultation():
     consultation_id = request.form.get("consultation_id", "").strip()
     if consultation_id:
         try:
-            df = pd.read_excel(EXCEL_FILE_PATH, sheet_name=0)
-            df = df[df["consultation_id"] != consultation_id]
-            df.to_excel(EXCEL_FILE_PATH, index=False)
+            submit_consultation_mutation("delete", consultation_id)
             return "OK", 200
+        except Timeout:
+            return CONSULTATION_BUSY_MESSAGE, 503
         except Exception as e:
             return str(e), 500
     return "Missing parameters", 400
 
+@app.route("/restore_consultation", methods=["POST"])
+def restore_consultation():
+    consultation_id = request.form.get("consultation_id", "").strip()
+    if consultation_id:
+        try:
+            # La suppression est peut-être encore dans la file d'écriture
+            flush_consultation_writes()
+            if consultation_store().restore(consultation_id):
+                return "OK", 200
+            return "Consultation introuvable ou suppression déjà définitive.", 404
+        except Timeout:
+            return CONSULTATION_BUSY_MESSAGE, 503
+        except Exception as e:
+            return str(e), 500
+    return "Missing parameters", 400
+
+@app.route("/storage_stats")
+def storage_stats():
+    return jsonify({
+        "storage": consultation_storage_mode(),
+        "pending_deletions": consultation_store().pending_deletions(),
+        "pending_comment_patches": consultation_store().pending_patches(),
+        "frame_cache": dict(frame_cache_stats, entries=len(_frame_cache)),
+        "snapshot": dict(snapshot_stats, fresh=snapshot_is_fresh()),
+        "pdf_cache": pdf_result_cache.info(),
+        "history_fragments": dict(history_fragment_stats, entries=len(_history_fragment_cache)),
+        "write_behind": consultation_writer.health()
+    })
+
+# Verrou du classeur non obtenu à temps (autre worker en pleine écriture) : erreur
+# temporaire plutôt qu'une erreur interne
+@app.errorhandler(Timeout)
+def consultation_lock_timeout(e):
+    return CONSULTATION_BUSY_MESSAGE, 503
+
+@app.route("/health")
+def health():
+    writes = consultation_writer.health()
+    # Dégradé si le dernier lot a échoué, si une mutation attend bien au-delà de la latence
+    # prévue ou si des mutations ont été mises de côté
+    stale = writes["oldest_pending_ms"] is not None and writes["oldest_pending_ms"] > max(10 * writes["max_latency_ms"], 5000)
+    status = "degraded" if writes["last_error"] or stale or writes["dead_letters"] else "ok"
+    return jsonify({"status": status, "write_behind": writes}), 200 if status == "ok" else 503
+
+# -----------------------------------------------------------------------------
+# Arrière-plan image des PDF : décodé et encodé une seule fois par processus (clé chemin
+# + mtime), puis dessiné une fois par document dans un objet formulaire réutilisé par page
+# -----------------------------------------------------------------------------
+IMAGE_BACKGROUND_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+# Valeur initiale (mise à jour ensuite par index() et import_background) : les PDF générés
+# hors d'une visite de la page d'accueil (travaux de fond, lots) en ont aussi besoin
+background_file = load_config().get("background_file_path") or None
+_background_image_cache = {}
+_background_image_lock = threading.Lock()
+# Réutilisation de l'image déjà encodée : repose sur des internes de ReportLab (contrôlés par
+# benchmarks/check_pdf_background_reuse.py) ; désactivée s'ils ont changé, drawImage
+# réencode alors l'image à chaque document via l'API publique
+_background_image_reuse = _digester is not None
+
+def background_image_path():
+    if background_file and background_file.lower().endswith(IMAGE_BACKGROUND_EXTENSIONS) and os.path.exists(background_file):
+        return background_file
+    return None
+
+def background_image_entry(path):
+    # Renvoie (ImageReader, nom, XObject image prêt) : l'image est décodée et, si la
+    # réutilisation est active, son flux compressé une seule fois
+    st = os.stat(path)
+    key = (st.st_mtime_ns, st.st_size, _background_image_reuse)
+    with _background_image_lock:
+        entry = _background_image_cache.get(path)
+        if entry is None or entry[0] != key:
+            reader, name, xobject = ImageReader(path), None, None
+            if _background_image_reuse:
+                name = _digester(f"{path}None".encode("utf-8"))  # même nom que canvas.drawImage(path)
+                xobject = pdfdoc.PDFImageXObject(name, reader)
+                xobject.name = name
+            entry = (key, reader, name, xobject)
+            _background_image_cache.clear()
+            _background_image_cache[path] = entry
+        return entry[1:]
+
+def register_background_image(pdf_canvas, path):
+    # Enregistré d'avance dans le document : drawImage(path) réutilise l'image au lieu de la réencoder
+    _, name, xobject = background_image_entry(path)
+    document = pdf_canvas._doc
+    if document.getXObjectName(name) not in document.idToObject:
+        document.addForm(name, copy.copy(xobject))
+
 def apply_background(pdf_canvas, width, height):
-    if background_file and os.path.exists(background_file):
-        if background_file.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-            try:
-                pdf_canvas.drawImage(background_file, 0, 0, width=width, height=height)
-            except Exception as e:
-                print(f"Erreur lors de l'importation de l'arrière-plan : {str(e)}")
+    global _background_image_reuse
+    path = background_image_path()
+    if not path:
+        return
+    form_name = f"arriere_plan_{int(width)}x{int(height)}"
+    try:
+        if not pdf_canvas.hasForm(form_name):
+            image = path
+            if _background_image_reuse:
+                try:
+                    register_background_image(pdf_canvas, path)
+                except (AttributeError, TypeError) as e:
+                    _background_image_reuse = False
+                    print(f"Avertissement : réutilisation de l'arrière-plan désactivée (ReportLab {reportlab.Version}) : {e}")
+            if not _background_image_reuse:
+                image = background_image_entry(path)[0]
+            pdf_canvas.beginForm(form_name, 0, 0, width, height)
+            pdf_canvas.drawImage(image, 0, 0, width=width, height=height)
+            pdf_canvas.endForm()
+        pdf_canvas.doForm(form_name)
+    except Exception as e:
+        print(f"Erreur lors de l'importation de l'arrière-plan : {str(e)}")
+
+# -----------------------------------------------------------------------------
+# Découpage des lignes : largeur de chaque mot mise en cache par (police, taille),
+# largeur de la ligne courante cumulée au lieu de remesurer toute la ligne à chaque mot
+# -----------------------------------------------------------------------------
+WORD_WIDTH_CACHE_MAX = 50000
+_word_width_cache = {}
+
+def word_width(word, font_name, font_size):
+    widths = _word_width_cache.get((font_name, font_size))
+    if widths is None or len(widths) > WORD_WIDTH_CACHE_MAX:
+        widths = _word_width_cache[(font_name, font_size)] = {}
+    width = widths.get(word)
+    if width is None:
+        width = widths[word] = pdfmetrics.stringWidth(word, font_name, font_size)
+    return width
+
+def break_lines(words, max_width, font_name="Helvetica", font_size=10, first_line=""):
+    # Renvoie [(ligne, largeur)] ; même découpage que l'ancien test
+    # stringWidth(f"{ligne} {mot}".strip()) <= max_width, y compris une ligne vide
+    # lorsque le premier mot dépasse à lui seul la largeur
+    space = word_width(" ", font_name, font_size)
+    lines = []
+    current_line = first_line
+    current_width = word_width(first_line, font_name, font_size) if first_line else 0
+    for word in words:
+        width = word_width(word, font_name, font_size)
+        test_width = current_width + space + width if current_line else width
+        if test_width <= max_width:
+            current_line = f"{current_line} {word}" if current_line else word
+            current_width = test_width
+        else:
+            lines.append((current_line, current_width))
+            current_line = word
+            current_width = width
+    lines.append((current_line, current_width))
+    return lines
 
 # --- Fonction de génération du PDF de consultation ---
 def generate_pdf_file(save_path, form_data, medication_list, analyses_list, radiologies_list):
@@ -699,7 +2410,9 @@ def generate_pdf_file(save_path, form_data, medication_list, analyses_list, radi
     certificate_content = form_data.get("certificate_content", "").strip()
     date_str = datetime.now().strftime('%d/%m/%Y')
 
-    c = canvas.Canvas(save_path, pagesize=A5)
+    # Avec un arrière-plan PDF, le PDF est produit en mémoire puis fusionné avant écriture
+    pdf_buffer = io.BytesIO() if background_pdf_path() else None
+    c = canvas.Canvas(pdf_buffer if pdf_buffer is not None else save_path, pagesize=A5)
     width, height = A5
     left_margin = 56.7
     header_margin = 130
@@ -707,15 +2420,25 @@ def generate_pdf_file(save_path, form_data, medication_list, analyses_list, radi
     max_line_width = width - left_margin * 2
 
     # Première page : si l'arrière-plan est une image, on l'applique
-    if background_file and os.path.exists(background_file) and background_file.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-        apply_background(c, width, height)
+    apply_background(c, width, height)
 
     def draw_header(pdf_canvas, title):
+        # Partie fixe de l'en-tête (lieu et date, médecin, patient, sexe, âge) enregistrée une
+        # seule fois par document comme objet formulaire ; seul le titre est redessiné
+        if not pdf_canvas.hasForm("entete_document"):
+            pdf_canvas.beginForm("entete_document")
+            draw_header_fields(pdf_canvas)
+            pdf_canvas.endForm()
+        pdf_canvas.doForm("entete_document")
+        pdf_canvas.setFont("Helvetica-Bold", 16)
+        pdf_canvas.drawCentredString(width / 2, height - header_margin - 25, title)
+        # Police laissée active comme après l'ancien en-tête (utilisée par draw_multiline_text)
+        pdf_canvas.setFont("Helvetica", 10)
+
+    def draw_header_fields(pdf_canvas):
         pdf_canvas.setFont("Helvetica", 10)
         location_date_str = f"{location}, le {date_str}"
         pdf_canvas.drawCentredString(width / 2, height - header_margin, location_date_str)
-        pdf_canvas.setFont("Helvetica-Bold", 16)
-        pdf_canvas.drawCentredString(width / 2, height - header_margin - 25, title)
         pdf_canvas.setFont("Helvetica-Bold", 10)
         pdf_canvas.drawString(left_margin, height - header_margin - 50, "Médecin :")
         pdf_canvas.setFont("Helvetica", 10)
@@ -736,26 +2459,14 @@ def generate_pdf_file(save_path, form_data, medication_list, analyses_list, radi
     def justify_text(pdf_canvas, text, max_width, y_position, left_margin, footer_margin, height):
         paragraphs = text.splitlines()
         for paragraph in paragraphs:
-            lines = []
-            current_line = ""
-            for word in paragraph.split():
-                test_line = f"{current_line} {word}".strip()
-                if pdf_canvas.stringWidth(test_line, "Helvetica", 10) <= max_width:
-                    current_line = test_line
-                else:
-                    lines.append(current_line)
-                    current_line = word
-            lines.append(current_line)
-            for line in lines:
-                line_width = pdf_canvas.stringWidth(line, "Helvetica", 10)
+            for line, line_width in break_lines(paragraph.split(), max_width, "Helvetica", 10):
                 centered_x = (max_width - line_width) / 2 + left_margin
                 pdf_canvas.drawString(centered_x, y_position, line)
                 y_position -= 15  # Vous pouvez ajuster cet interligne si besoin
                 if y_position < footer_margin:
                     pdf_canvas.showPage()
                     # Réappliquer l'arrière-plan si nécessaire
-                    if background_file and os.path.exists(background_file) and background_file.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                        apply_background(pdf_canvas, width, height)
+                    apply_background(pdf_canvas, width, height)
                     # Réafficher l'en-tête et réinitialiser y_position
                     draw_header(pdf_canvas, "Certificat Médical")
                     pdf_canvas.setFont("Helvetica", 10)
@@ -775,31 +2486,13 @@ def generate_pdf_file(save_path, form_data, medication_list, analyses_list, radi
         pdf_canvas.setFont("Helvetica", 10)
         max_width = 300
         for index, item in enumerate(items, start=1):
-            words = item.split()
-            current_line = f"{index}. "
-            for word in words:
-                test_line = f"{current_line} {word}".strip()
-                if pdf_canvas.stringWidth(test_line, "Helvetica", 10) <= max_width:
-                    current_line = test_line
-                else:
-                    pdf_canvas.drawString(left_margin, y_position, current_line)
-                    y_position -= 20
-                    # Vérification du bas de page et réinitialisation
-                    if y_position < footer_margin:
-                        pdf_canvas.showPage()
-                        if background_file and os.path.exists(background_file) and background_file.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                            apply_background(pdf_canvas, width, height)
-                        draw_header(pdf_canvas, title)
-                        pdf_canvas.setFont("Helvetica", 10)
-                        y_position = height - header_margin - 130
-                    current_line = word
-            if current_line:
+            for current_line, _ in break_lines(item.split(), max_width, "Helvetica", 10, first_line=f"{index}. "):
                 pdf_canvas.drawString(left_margin, y_position, current_line)
                 y_position -= 20
+                # Vérification du bas de page et réinitialisation
                 if y_position < footer_margin:
                     pdf_canvas.showPage()
-                    if background_file and os.path.exists(background_file) and background_file.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                        apply_background(pdf_canvas, width, height)
+                    apply_background(pdf_canvas, width, height)
                     draw_header(pdf_canvas, title)
                     pdf_canvas.setFont("Helvetica", 10)
                     y_position = height - header_margin - 130
@@ -810,8 +2503,7 @@ def generate_pdf_file(save_path, form_data, medication_list, analyses_list, radi
         for line in lines:
             if y_position < footer_margin:
                 pdf_canvas.showPage()
-                if background_file and os.path.exists(background_file) and background_file.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                    apply_background(pdf_canvas, width, height)
+                apply_background(pdf_canvas, width, height)
                 draw_header(pdf_canvas, "Consultation")
                 y_position = height - header_margin - 130
             pdf_canvas.drawString(left_margin, y_position, line)
@@ -825,8 +2517,7 @@ def generate_pdf_file(save_path, form_data, medication_list, analyses_list, radi
         if items and any(item.strip() for item in items):
             if has_content:
                 canvas_obj.showPage()
-                if background_file and os.path.exists(background_file) and background_file.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                    apply_background(canvas_obj, width, height)
+                apply_background(canvas_obj, width, height)
             draw_header(canvas_obj, section_title)
             y_pos = height - header_margin - 130
             y_pos = draw_list(section_title, items, y_pos, canvas_obj, left_margin, footer_margin, height)
@@ -843,8 +2534,7 @@ def generate_pdf_file(save_path, form_data, medication_list, analyses_list, radi
     if clinical_signs or bp or temperature or heart_rate or respiratory_rate or diagnosis:
         if has_content:
             c.showPage()
-            if background_file and os.path.exists(background_file) and background_file.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                apply_background(c, width, height)
+            apply_background(c, width, height)
         draw_header(c, "Consultation")
         y_pos = height - header_margin - 130
         c.setFont("Helvetica-Bold", 12)
@@ -881,8 +2571,7 @@ def generate_pdf_file(save_path, form_data, medication_list, analyses_list, radi
     if form_data.get("include_certificate", "off") == "on" and certificate_content:
         if has_content:
             c.showPage()
-            if background_file and os.path.exists(background_file) and background_file.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                apply_background(c, width, height)
+            apply_background(c, width, height)
         draw_header(c, "Certificat Médical")
         y_pos = height - header_margin - 130
         c.setFont("Helvetica-Bold", 12)
@@ -904,11 +2593,8 @@ def generate_pdf_file(save_path, form_data, medication_list, analyses_list, radi
     c.save()
 
     # Fusion post-génération de l'arrière-plan PDF si nécessaire (pour arrière-plan PDF)
-    if background_file and os.path.exists(background_file) and background_file.lower().endswith('.pdf'):
-        try:
-            merge_with_background_pdf(save_path)
-        except Exception as e:
-            print(f"Erreur lors de la fusion avec l'arrière-plan PDF : {str(e)}")
+    if pdf_buffer is not None:
+        write_pdf_with_background(pdf_buffer, save_path)
 
 @app.route("/", methods=["GET", "POST"])
 def index():
@@ -955,26 +2641,18 @@ def index():
         saved_radiologies = radiologies_list
 
         if not patient_id:
-            return render_template_string(alert_template, alert_type="warning", alert_title="Attention", alert_text="Veuillez entrer l'ID du patient.", redirect_url=url_for("index"))
-
-        # Vérification de l'unicité de l'ID pour un même patient
-        if os.path.exists(EXCEL_FILE_PATH):
-            df_existing = pd.read_excel(EXCEL_FILE_PATH, sheet_name=0)
-            if patient_id in df_existing["patient_id"].astype(str).tolist():
-                existing_name = df_existing.loc[df_existing["patient_id"].astype(str) == patient_id, "patient_name"].iloc[0]
-                if existing_name.strip().lower() != patient_name.strip().lower():
-                    flash("L'ID existe déjà et est associé à un autre patient.", "error")
-                    return render_template_string(alert_template, alert_type="error", alert_title="Erreur", alert_text="L'ID existe déjà et est associé à un autre patient.", redirect_url=url_for("index"))
-
-        if os.path.exists(EXCEL_FILE_PATH):
-            df = pd.read_excel(EXCEL_FILE_PATH, sheet_name=0)
-        else:
-            df = pd.DataFrame(columns=[
-                "consultation_date", "patient_id", "patient_name", "date_of_birth", "gender", "age", "patient_phone", "antecedents",
-                "clinical_signs", "bp", "temperature", "heart_rate", "respiratory_rate", "diagnosis",
-                "medications", "analyses", "radiologies", "certificate_category", "certificate_content",
-                "rest_duration", "doctor_comment", "consultation_id"
-            ])
+            return render_template("alert.html", alert_type="warning", alert_title="Attention", alert_text="Veuillez entrer l'ID du patient.", redirect_url=url_for("index"))
+
+        # Vérification de l'unicité de l'ID pour un même patient, consultations encore dans
+        # la file d'écriture comprises
+        existing_name = consultation_writer.pending_patient_name(patient_id)
+        if existing_name is None and consultation_store().exists():
+            existing_name = consultation_store().find_patient_name(patient_id)
+        if existing_name is not None:
+            if existing_name.strip().lower() != patient_name.strip().lower():
+                flash("L'ID existe déjà et est associé à un autre patient.", "error")
+                return render_template("alert.html", alert_type="error", alert_title="Erreur", alert_text="L'ID existe déjà et est associé à un autre patient.", redirect_url=url_for("index"))
+
         new_row = {
             "consultation_date": consultation_date,
             "patient_id": patient_id,
@@ -999,127 +2677,626 @@ def index():
             "doctor_comment": doctor_comment,
             "consultation_id": str(uuid.uuid4())
         }
-        df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-        df.to_excel(EXCEL_FILE_PATH, index=False)
-        load_patient_data()
+        submit_consultation_mutation("append", new_row)
         flash("Les données du patient ont été enregistrées avec succès.", "success")
-    patient_data = {}
-    for pid in patient_ids:
-        patient_data[pid] = {
-            "name": patient_id_to_name.get(pid, ""),
-            "age": patient_id_to_age.get(pid, ""),
-            "phone": patient_id_to_phone.get(pid, ""),
-            "antecedents": patient_id_to_antecedents.get(pid, ""),
-            "date_of_birth": patient_id_to_dob.get(pid, ""),
-            "gender": patient_id_to_gender.get(pid, "")
-        }
-    return render_template_string(main_template,
-                                  config=config,
-                                  current_date=datetime.now().strftime("%d/%m/%Y"),
-                                  medications_options=default_medications_options,
-                                  analyses_options=default_analyses_options,
-                                  radiologies_options=default_radiologies_options,
-                                  certificate_categories=certificate_categories,
-                                  default_certificate_text=default_certificate_text,
-                                  patient_ids=patient_ids,
-                                  patient_names=patient_names,
-                                  host_address=f"http://{LOCAL_IP}:3000",
-                                  patient_data=patient_data,
-                                  saved_medications=saved_medications,
-                                  saved_analyses=saved_analyses,
-                                  saved_radiologies=saved_radiologies)
+    return stream_page("main.html",
+                       config=config,
+                       current_date=datetime.now().strftime("%d/%m/%Y"),
+                       medications_options=default_medications_options,
+                       analyses_options=default_analyses_options,
+                       radiologies_options=default_radiologies_options,
+                       certificate_categories=certificate_categories,
+                       default_certificate_text=default_certificate_text,
+                       host_address=f"http://{LOCAL_IP}:3000",
+                       saved_medications=saved_medications,
+                       saved_analyses=saved_analyses,
+                       saved_radiologies=saved_radiologies)
 
-@app.route("/generate_pdf_route")
-def generate_pdf_route():
+# -----------------------------------------------------------------------------
+# Sortie des PDF : génération en mémoire (BytesIO) et archivage optionnel en tâche de fond
+# -----------------------------------------------------------------------------
+PDF_IN_MEMORY = bool(load_config().get("pdf_in_memory", True))
+PDF_ARCHIVE = bool(load_config().get("pdf_archive", True))
+_pdf_archive_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pdf-archive")
+
+def pdf_filename(prefix):
+    # Suffixe aléatoire : deux impressions dans la même seconde ne partagent plus le même fichier
+    return f"{prefix}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}.pdf"
+
+def archive_pdf(filename, data):
+    pdf_path = os.path.join(PDF_FOLDER, filename)
+    tmp_path = pdf_path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, pdf_path)
+    except Exception as e:
+        print(f"Erreur lors de l'archivage du PDF {filename} : {str(e)}")
+
+# -----------------------------------------------------------------------------
+# Cache des ordonnances générées : fichiers nommés par l'empreinte du contenu dans
+# PDF_FOLDER/cache, taille bornée, éviction du moins récemment servi (LRU)
+# -----------------------------------------------------------------------------
+PDF_LAYOUT_VERSION = 2  # À incrémenter quand la mise en page de generate_pdf_file change
+PDF_CACHE_MAX_BYTES = int(float(load_config().get("pdf_cache_max_mb", 200)) * 1024 * 1024)
+
+class PdfResultCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.folder = None
+        self.entries = OrderedDict()  # clé -> taille, du moins au plus récemment servi
+        self.total_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def _sync_folder(self):
+        # Le dossier suit PDF_FOLDER (modifiable depuis les paramètres) ; l'index est
+        # reconstruit depuis le disque, trié par date de dernier accès
+        folder = os.path.join(PDF_FOLDER, "cache")
+        if folder == self.folder:
+            return
+        os.makedirs(folder, exist_ok=True)
+        files = []
+        for name in os.listdir(folder):
+            if name.endswith(".pdf"):
+                st = os.stat(os.path.join(folder, name))
+                files.append((st.st_mtime, name[:-4], st.st_size))
+        self.folder = folder
+        self.entries = OrderedDict((key, size) for _, key, size in sorted(files))
+        self.total_bytes = sum(self.entries.values())
+
+    def path(self, key):
+        return os.path.join(self.folder, f"{key}.pdf")
+
+    def get(self, key):
+        if self.max_bytes <= 0:
+            return None
+        with self.lock:
+            self._sync_folder()
+            if key not in self.entries:
+                self.stats["misses"] += 1
+                return None
+            try:
+                with open(self.path(key), "rb") as f:
+                    data = f.read()
+                os.utime(self.path(key))
+            except FileNotFoundError:
+                self.total_bytes -= self.entries.pop(key)
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return data
+
+    def put(self, key, data):
+        if self.max_bytes <= 0 or len(data) > self.max_bytes:
+            return
+        with self.lock:
+            self._sync_folder()
+            tmp_path = self.path(key) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self.path(key))
+            self.total_bytes += len(data) - self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                old_key, size = self.entries.popitem(last=False)
+                self.total_bytes -= size
+                self.stats["evictions"] += 1
+                try:
+                    os.remove(self.path(old_key))
+                except FileNotFoundError:
+                    pass
+
+    def info(self):
+        return dict(self.stats, entries=len(self.entries), bytes=self.total_bytes, max_bytes=self.max_bytes)
+
+pdf_result_cache = PdfResultCache(PDF_CACHE_MAX_BYTES)
+
+def _background_identity():
+    if not background_file:
+        return None
+    try:
+        st = os.stat(background_file)
+        return [background_file, st.st_mtime_ns, st.st_size]
+    except OSError:
+        return [background_file, None, None]
+
+def prescription_cache_key(form_data, medication_list, analyses_list, radiologies_list):
+    normalized = {
+        "version": PDF_LAYOUT_VERSION,
+        "form": {k: str(v).strip() for k, v in sorted(form_data.items())},
+        "medications": [m.strip() for m in medication_list],
+        "analyses": [a.strip() for a in analyses_list],
+        "radiologies": [r.strip() for r in radiologies_list],
+        "background": _background_identity(),
+        # La date imprimée et l'âge calculé dépendent du jour de génération
+        "date": date.today().isoformat(),
+    }
+    payload = json.dumps(normalized, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def send_generated_pdf(prefix, render, cache_key=None):
+    # render(destination) écrit le PDF dans destination (chemin ou flux) ; avec cache_key,
+    # un PDF déjà généré pour le même contenu est renvoyé sans relancer ReportLab
+    filename = pdf_filename(prefix)
+    data = pdf_result_cache.get(cache_key) if cache_key else None
+    if data is None and not PDF_IN_MEMORY:
+        pdf_path = os.path.join(PDF_FOLDER, filename)
+        render(pdf_path)
+        if cache_key:
+            with open(pdf_path, "rb") as f:
+                pdf_result_cache.put(cache_key, f.read())
+        return send_file(pdf_path, as_attachment=True)
+    if data is None:
+        buffer = io.BytesIO()
+        render(buffer)
+        data = buffer.getvalue()
+        if cache_key:
+            pdf_result_cache.put(cache_key, data)
+    if PDF_ARCHIVE:
+        _pdf_archive_executor.submit(archive_pdf, filename, data)
+    return send_file(io.BytesIO(data), mimetype="application/pdf", as_attachment=True, download_name=filename)
+
+def prescription_from_payload(payload):
+    # payload : request.args ou dictionnaire d'un document de lot ; les listes sont
+    # des chaînes séparées par des retours à la ligne ou des listes JSON
+    def as_list(key):
+        value = payload.get(key, "")
+        if isinstance(value, (list, tuple)):
+            return [str(v) for v in value]
+        return str(value).split("\n")
     form_data = {
-        "doctor_name": request.args.get("doctor_name", "Dr. Exemple"),
-        "patient_name": request.args.get("patient_name", "Patient Exemple"),
-        "patient_age": request.args.get("patient_age", "30"),
-        "date_of_birth": request.args.get("date_of_birth", ""),
-        "gender": request.args.get("gender", ""),
-        "location": request.args.get("location", "Ville Exemple"),
-        "clinical_signs": request.args.get("clinical_signs", "Signes cliniques..."),
-        "bp": request.args.get("bp", "120/80"),
-        "temperature": request.args.get("temperature", "37"),
-        "heart_rate": request.args.get("heart_rate", "70"),
-        "respiratory_rate": request.args.get("respiratory_rate", "16"),
-        "diagnosis": request.args.get("diagnosis", "Diagnostic exemple"),
-        "certificate_content": request.args.get("certificate_content", default_certificate_text),
-        "include_certificate": request.args.get("include_certificate", "off")
+        "doctor_name": payload.get("doctor_name", "Dr. Exemple"),
+        "patient_name": payload.get("patient_name", "Patient Exemple"),
+        "patient_age": payload.get("patient_age", "30"),
+        "date_of_birth": payload.get("date_of_birth", ""),
+        "gender": payload.get("gender", ""),
+        "location": payload.get("location", "Ville Exemple"),
+        "clinical_signs": payload.get("clinical_signs", "Signes cliniques..."),
+        "bp": payload.get("bp", "120/80"),
+        "temperature": payload.get("temperature", "37"),
+        "heart_rate": payload.get("heart_rate", "70"),
+        "respiratory_rate": payload.get("respiratory_rate", "16"),
+        "diagnosis": payload.get("diagnosis", "Diagnostic exemple"),
+        "certificate_content": payload.get("certificate_content", default_certificate_text),
+        "include_certificate": payload.get("include_certificate", "off")
     }
-    medication_list = request.args.get("medications_list", "").split("\n") or ["Médicament Exemple"]
-    analyses_list = request.args.get("analyses_list", "").split("\n") or ["Analyse Exemple"]
-    radiologies_list = request.args.get("radiologies_list", "").split("\n") or ["Radiologie Exemple"]
+    medication_list = as_list("medications_list") or ["Médicament Exemple"]
+    analyses_list = as_list("analyses_list") or ["Analyse Exemple"]
+    radiologies_list = as_list("radiologies_list") or ["Radiologie Exemple"]
+    return form_data, medication_list, analyses_list, radiologies_list
+
+@app.route("/generate_pdf_route")
+def generate_pdf_route():
+    form_data, medication_list, analyses_list, radiologies_list = prescription_from_payload(request.args)
+
+    return send_generated_pdf("Ordonnance", lambda destination: generate_pdf_file(
+        destination, form_data, medication_list, analyses_list, radiologies_list),
+        cache_key=prescription_cache_key(form_data, medication_list, analyses_list, radiologies_list))
+
+# -----------------------------------------------------------------------------
+# Impression par lot : documents rendus en parallèle dans un pool de processus
+# -----------------------------------------------------------------------------
+PDF_BATCH_WORKERS = int(load_config().get("pdf_batch_workers", 0)) or os.cpu_count() or 1
+PDF_BATCH_MAX_DOCUMENTS = int(load_config().get("pdf_batch_max_documents", 200))
+PDF_BATCH_REPORT_TTL = 3600  # secondes de conservation du rapport détaillé d'un lot
+_pdf_batch_pool = None
+_pdf_batch_pool_lock = threading.Lock()
+
+def pdf_batch_pool():
+    # Pool créé à la première utilisation puis conservé : chaque processus garde en cache
+    # l'arrière-plan décodé (background_image_entry / background_pdf_forms) d'un lot à l'autre
+    global _pdf_batch_pool
+    with _pdf_batch_pool_lock:
+        if _pdf_batch_pool is None:
+            # Hérité par les processus du pool (lancés à la demande) : import allégé, voir
+            # PDF_RENDER_WORKER ; sans effet sur le serveur lui-même
+            os.environ["MEDICSAS_PDF_RENDER_WORKER"] = "1"
+            # "spawn" partout (comme sous Windows) : pas de fork d'un serveur multi-thread
+            _pdf_batch_pool = ProcessPoolExecutor(max_workers=PDF_BATCH_WORKERS,
+                                                  mp_context=multiprocessing.get_context("spawn"))
+        return _pdf_batch_pool
+
+def render_prescription_worker(background_path, form_data, medication_list, analyses_list, radiologies_list):
+    # Exécuté dans un processus du pool : renvoie (octets du PDF, durée en ms)
+    global background_file
+    background_file = background_path
+    start = time.perf_counter()
+    buffer = io.BytesIO()
+    generate_pdf_file(buffer, form_data, medication_list, analyses_list, radiologies_list)
+    return buffer.getvalue(), (time.perf_counter() - start) * 1000
 
-    pdf_path = os.path.join(PDF_FOLDER, f"Ordonnance_{datetime.now().strftime('%Y%m%d%H%M%S')}.pdf")
-    generate_pdf_file(pdf_path, form_data, medication_list, analyses_list, radiologies_list)
-    return send_file(pdf_path, as_attachment=True)
+# Rapport détaillé d'un lot (durée par document), écrit dans PDF_FOLDER/batch_reports pour
+# être relu depuis n'importe quel worker via l'identifiant donné dans X-Batch-Report
+def batch_report_path(report_id):
+    folder = os.path.join(PDF_FOLDER, "batch_reports")
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f"{report_id}.json")
+
+def save_batch_report(summary):
+    report_id = uuid.uuid4().hex
+    path = batch_report_path(report_id)
+    folder, now = os.path.dirname(path), time.time()
+    for name in os.listdir(folder):
+        with contextlib.suppress(OSError):
+            if now - os.path.getmtime(os.path.join(folder, name)) > PDF_BATCH_REPORT_TTL:
+                os.remove(os.path.join(folder, name))
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+    return report_id
+
+def batch_payloads_from_request():
+    if "batch_file" in request.files and request.files["batch_file"].filename:
+        file = request.files["batch_file"]
+        if file.filename.lower().endswith(".csv"):
+            df = pd.read_csv(file, dtype=str, sep=None, engine="python")
+        else:
+            df = pd.read_excel(file, dtype=str)
+        payloads = df.fillna("").to_dict("records")
+        # Dans un fichier, les listes peuvent aussi être séparées par des points-virgules
+        for payload in payloads:
+            for key in ("medications_list", "analyses_list", "radiologies_list"):
+                if key in payload:
+                    payload[key] = "\n".join(v.strip() for v in re.split(r"[;\n]", payload[key]))
+        return payloads
+    data = request.get_json(silent=True) or {}
+    payloads = data if isinstance(data, list) else data.get("documents", []) if isinstance(data, dict) else None
+    if not isinstance(payloads, list):
+        raise ValueError("la liste des documents est attendue.")
+    for index, payload in enumerate(payloads, start=1):
+        if not isinstance(payload, dict):
+            raise ValueError(f"le document {index} doit être un objet JSON.")
+    return payloads
+
+@app.route("/generate_pdf_batch", methods=["POST"])
+def generate_pdf_batch():
+    try:
+        payloads = batch_payloads_from_request()
+    except Exception as e:
+        return jsonify({"error": f"Lecture du lot impossible : {e}"}), 400
+    if not payloads:
+        return jsonify({"error": "Aucun document à générer."}), 400
+    if len(payloads) > PDF_BATCH_MAX_DOCUMENTS:
+        return jsonify({"error": f"Lot limité à {PDF_BATCH_MAX_DOCUMENTS} documents."}), 400
+    data = request.get_json(silent=True)
+    output_format = (request.form.get("format") or request.args.get("format")
+                     or (data.get("format") if isinstance(data, dict) else None) or "pdf").lower()
+
+    start = time.perf_counter()
+    documents = [None] * len(payloads)
+    report = [None] * len(payloads)
+    futures = {}
+    for index, payload in enumerate(payloads):
+        prescription = prescription_from_payload(payload)
+        cache_key = prescription_cache_key(*prescription)
+        cached = pdf_result_cache.get(cache_key)
+        if cached is not None:
+            documents[index] = cached
+            report[index] = {"index": index, "patient_name": prescription[0]["patient_name"], "ms": 0.0, "cache": True}
+        else:
+            futures[index] = (cache_key, prescription[0]["patient_name"],
+                              pdf_batch_pool().submit(render_prescription_worker, background_file, *prescription))
+    for index, (cache_key, patient_name, future) in futures.items():
+        try:
+            pdf_bytes, elapsed_ms = future.result()
+        except Exception as e:
+            return jsonify({"error": f"Erreur lors de la génération du document {index + 1} : {e}"}), 500
+        pdf_result_cache.put(cache_key, pdf_bytes)
+        documents[index] = pdf_bytes
+        report[index] = {"index": index, "patient_name": patient_name, "ms": round(elapsed_ms, 1), "cache": False}
+    summary = {"documents": report, "total_ms": round((time.perf_counter() - start) * 1000, 1),
+               "workers": PDF_BATCH_WORKERS}
+    try:
+        report_id = save_batch_report(summary)
+    except OSError as e:
+        print(f"Erreur lors de l'enregistrement du rapport de lot : {str(e)}")
+        report_id = None
+
+    if output_format == "zip":
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+            for index, (pdf_bytes, entry) in enumerate(zip(documents, report), start=1):
+                name = secure_filename(str(entry["patient_name"])) or "patient"
+                archive.writestr(f"{index:03d}_{name}.pdf", pdf_bytes)
+            archive.writestr("rapport.json", json.dumps(summary, ensure_ascii=False, indent=2))
+        buffer.seek(0)
+        response = send_file(buffer, mimetype="application/zip", as_attachment=True,
+                             download_name=pdf_filename("Lot").replace(".pdf", ".zip"))
+    else:
+        writer = PdfWriter()
+        for pdf_bytes in documents:
+            writer.append(PdfReader(io.BytesIO(pdf_bytes)))
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        buffer.seek(0)
+        response = send_file(buffer, mimetype="application/pdf", as_attachment=True,
+                             download_name=pdf_filename("Lot"))
+    # En-tête limité au résumé (les proxys refusent les en-têtes de plusieurs Ko) ; le détail
+    # par document est dans rapport.json du ZIP et, quel que soit le format, à report_url
+    response.headers["X-Batch-Report"] = json.dumps({"count": len(report), "total_ms": summary["total_ms"],
+                                                     "cached": sum(1 for entry in report if entry["cache"]),
+                                                     "workers": PDF_BATCH_WORKERS, "report_id": report_id,
+                                                     "report_url": url_for("pdf_batch_report", report_id=report_id) if report_id else None})
+    return response
+
+@app.route("/generate_pdf_batch/<report_id>/report")
+def pdf_batch_report(report_id):
+    if not re.fullmatch(r"[0-9a-f]{32}", report_id):
+        return jsonify({"error": "Rapport introuvable."}), 404
+    try:
+        with open(batch_report_path(report_id), "r", encoding="utf-8") as f:
+            return jsonify(json.load(f))
+    except (OSError, ValueError):
+        return jsonify({"error": "Rapport introuvable."}), 404
 
 def add_background_platypus(canvas_obj, doc):
-    bg_path = background_file if background_file and os.path.exists(background_file) else None
-    if bg_path:
-        if bg_path.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-            try:
-                canvas_obj.drawImage(bg_path, 0, 0, width=doc.pagesize[0], height=doc.pagesize[1])
-            except Exception as e:
-                print(f"Erreur lors de l'ajout de l'arrière-plan image : {str(e)}")
+    apply_background(canvas_obj, doc.pagesize[0], doc.pagesize[1])
 
 from reportlab.lib.enums import TA_JUSTIFY
 
 import copy
 from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2.generic import ArrayObject, DecodedStreamObject, DictionaryObject, FloatObject, NameObject
 
-def merge_with_background_pdf(foreground_path):
-    if not (background_file and os.path.exists(background_file) and background_file.lower().endswith('.pdf')):
-        return
+# -----------------------------------------------------------------------------
+# Arrière-plan PDF : lu une seule fois par processus (clé chemin + mtime). Chaque page de
+# fond devient un XObject formulaire partagé par toutes les pages qui l'utilisent.
+# -----------------------------------------------------------------------------
+_background_pdf_cache = {}
+_background_pdf_lock = threading.Lock()
 
-    bg_reader = PdfReader(background_file)
-    fg_reader = PdfReader(foreground_path)
-    writer = PdfWriter()
+def background_pdf_path():
+    if background_file and background_file.lower().endswith('.pdf') and os.path.exists(background_file):
+        return background_file
+    return None
 
-    num_bg_pages = len(bg_reader.pages)
-    for i in range(len(fg_reader.pages)):
-        fg_page = fg_reader.pages[i]
-        # Créer une copie indépendante de la page d'arrière‑plan pour éviter la réutilisation
-        if i < num_bg_pages:
-            bg_page = copy.deepcopy(bg_reader.pages[i])
-        else:
-            bg_page = copy.deepcopy(bg_reader.pages[-1])
-        # Fusionner le contenu généré sur le fond
-        bg_page.merge_page(fg_page)
-        writer.add_page(bg_page)
+def background_pdf_forms(path):
+    # Renvoie [(XObject formulaire, MediaBox)] pour chaque page du PDF d'arrière-plan
+    st = os.stat(path)
+    key = (st.st_mtime_ns, st.st_size)
+    entry = _background_pdf_cache.get(path)
+    if entry is None or entry[0] != key:
+        reader = PdfReader(path)
+        forms = []
+        for page in reader.pages:
+            contents = page.get_contents()
+            form = DecodedStreamObject()
+            form.set_data(contents.get_data() if contents is not None else b"")
+            form = form.flate_encode()
+            form.update({
+                NameObject("/Type"): NameObject("/XObject"),
+                NameObject("/Subtype"): NameObject("/Form"),
+                NameObject("/BBox"): ArrayObject([FloatObject(v) for v in page.mediabox]),
+                NameObject("/Resources"): page.get("/Resources", DictionaryObject()),
+            })
+            forms.append((form, page.mediabox))
+        entry = (key, forms)
+        _background_pdf_cache.clear()
+        _background_pdf_cache[path] = entry
+    return entry[1]
 
-    with open(foreground_path, "wb") as f_out:
+def merge_with_background_pdf(foreground, output_path=None):
+    # foreground : chemin ou flux du PDF généré ; le résultat est écrit dans output_path,
+    # chemin ou flux (par défaut le chemin du PDF généré)
+    path = background_pdf_path()
+    if not path:
+        return
+    if output_path is None:
+        output_path = foreground
+    if hasattr(foreground, "seek"):
+        foreground.seek(0)
+    fg_reader = PdfReader(foreground)
+    writer = PdfWriter()
+    stamps = {}
+    # Le lecteur d'arrière-plan est partagé entre les requêtes : la copie de ses objets est sérialisée
+    with _background_pdf_lock:
+        forms = background_pdf_forms(path)
+        for i, fg_page in enumerate(fg_reader.pages):
+            index = min(i, len(forms) - 1)
+            if index not in stamps:
+                form, mediabox = forms[index]
+                form_ref = writer._add_object(form.clone(writer))
+                stamp = DecodedStreamObject()
+                stamp.set_data(f"q /MedicsasFond{index} Do Q\n".encode("ascii"))
+                stamps[index] = (form_ref, writer._add_object(stamp), mediabox)
+            form_ref, stamp_ref, mediabox = stamps[index]
+            writer.add_page(fg_page)
+            page = writer.pages[-1]
+            # Le fond est dessiné avant le contenu généré, comme l'ancien merge_page sur le fond
+            resources = page.setdefault(NameObject("/Resources"), DictionaryObject()).get_object()
+            xobjects = resources.setdefault(NameObject("/XObject"), DictionaryObject()).get_object()
+            xobjects[NameObject(f"/MedicsasFond{index}")] = form_ref
+            contents = page.get("/Contents")
+            if contents is None:
+                page_contents = []
+            elif isinstance(contents.get_object(), ArrayObject):
+                page_contents = list(contents.get_object())
+            else:
+                page_contents = [contents]
+            page[NameObject("/Contents")] = ArrayObject([stamp_ref] + page_contents)
+            page[NameObject("/MediaBox")] = mediabox
+
+    if hasattr(output_path, "write"):
+        writer.write(output_path)
+        return
+    with open(output_path, "wb") as f_out:
         writer.write(f_out)
+
+def write_pdf_with_background(buffer, output_path):
+    # Fusion en mémoire du PDF généré avec l'arrière-plan PDF, puis écriture unique vers la destination
+    try:
+        merge_with_background_pdf(buffer, output_path)
+    except Exception as e:
+        print(f"Erreur lors de la fusion avec l'arrière-plan PDF : {str(e)}")
+        if hasattr(output_path, "write"):
+            output_path.seek(0)
+            output_path.truncate()
+            output_path.write(buffer.getvalue())
+            return
+        with open(output_path, "wb") as f_out:
+            f_out.write(buffer.getvalue())
   
-def generate_history_pdf_file(pdf_path, df_filtered):
+# -----------------------------------------------------------------------------
+# Fragments d'historique : les flowables d'une consultation sont construits une fois et
+# gardés en cache (clé consultation_id + empreinte de la ligne) ; une consultation modifiée
+# (commentaire) change d'empreinte, une consultation supprimée n'est plus demandée
+# -----------------------------------------------------------------------------
+HISTORY_FRAGMENT_CACHE_SIZE = int(load_config().get("history_fragment_cache_size", 5000))
+_history_fragment_cache = OrderedDict()
+_history_fragment_lock = threading.Lock()
+history_fragment_stats = {"hits": 0, "misses": 0}
+_history_pdf_styles = None
+
+def history_pdf_styles():
+    # Styles créés une seule fois : les fragments en cache y font référence
+    global _history_pdf_styles
+    if _history_pdf_styles is None:
+        styles = getSampleStyleSheet()
+        style_heading = ParagraphStyle(
+            'CustomHeading',
+            parent=styles["Heading1"],
+            fontSize=styles["Heading1"].fontSize - 2,
+            alignment=TA_JUSTIFY,
+            leading=styles["Heading1"].leading - 2
+        )
+        style_normal = ParagraphStyle(
+            'JustifiedNormal',
+            parent=styles["Normal"],
+            fontSize=styles["Normal"].fontSize - 2,
+            alignment=TA_JUSTIFY
+        )
+        _history_pdf_styles = (style_heading, style_normal, styles["Heading2"])
+    return _history_pdf_styles
+
+class HistoryParagraph(Paragraph):
+    # Paragraphe dont le découpage en lignes est mémorisé par largeur disponible : le
+    # dictionnaire est partagé par les copies superficielles servies depuis le cache, un
+    # fragment déjà imprimé n'est donc plus redécoupé (seule sa position sur la page change)
+    def __init__(self, *args, **kwargs):
+        Paragraph.__init__(self, *args, **kwargs)
+        self._laid_out = {}
+
+    def breakLines(self, width):
+        key = tuple(width) if isinstance(width, (list, tuple)) else width
+        blPara = self._laid_out.get(key)
+        if blPara is None:
+            blPara = self._laid_out[key] = Paragraph.breakLines(self, width)
+        return blPara
+
+def _history_row_key(row):
+    values = [None if pd.isnull(v) else str(v) for v in row.values]
+    digest = hashlib.sha1(json.dumps(values, ensure_ascii=False).encode("utf-8")).hexdigest()
+    return (str(row.get("consultation_id", "")), digest)
+
+def history_consultation_flowables(row, style_normal, style_subheading):
+    key = _history_row_key(row)
+    with _history_fragment_lock:
+        fragment = _history_fragment_cache.get(key)
+        if fragment is not None:
+            _history_fragment_cache.move_to_end(key)
+            history_fragment_stats["hits"] += 1
+    if fragment is None:
+        fragment = build_history_consultation_flowables(row, style_normal, style_subheading)
+        with _history_fragment_lock:
+            history_fragment_stats["misses"] += 1
+            _history_fragment_cache[key] = fragment
+            while len(_history_fragment_cache) > HISTORY_FRAGMENT_CACHE_SIZE:
+                _history_fragment_cache.popitem(last=False)
+    # Copies superficielles : la mise en page (wrap/split) modifie les flowables, pas leur
+    # contenu analysé (fragments de texte) qui reste partagé avec le cache
+    return [copy.copy(flowable) for flowable in fragment]
+
+def build_history_consultation_flowables(row, style_normal, style_subheading):
+    elements = []
+    consultation_date = str(row['consultation_date'])
+    clinical_signs = str(row.get('clinical_signs', '')) if pd.notnull(row.get('clinical_signs', '')) else ''
+    bp = str(row.get('bp', '')) if pd.notnull(row.get('bp', '')) else ''
+    temperature = str(row.get('temperature', '')) if pd.notnull(row.get('temperature', '')) else ''
+    heart_rate = str(row.get('heart_rate', '')) if pd.notnull(row.get('heart_rate', '')) else ''
+    respiratory_rate = str(row.get('respiratory_rate', '')) if pd.notnull(row.get('respiratory_rate', '')) else ''
+    diagnosis = str(row.get('diagnosis', '')) if pd.notnull(row.get('diagnosis', '')) else ''
+    medications = str(row.get('medications', '')) if pd.notnull(row.get('medications', '')) else ''
+    analyses = str(row.get('analyses', '')) if pd.notnull(row.get('analyses', '')) else ''
+    radiologies = str(row.get('radiologies', '')) if pd.notnull(row.get('radiologies', '')) else ''
+    certificate_category = str(row.get('certificate_category', '')) if pd.notnull(row.get('certificate_category', '')) else ''
+    rest_duration = str(row.get('rest_duration', '')) if pd.notnull(row.get('rest_duration', '')) else ''
+    doctor_comment = str(row.get('doctor_comment', '')) if pd.notnull(row.get('doctor_comment', '')) else ''
+
+    elements.append(HistoryParagraph(f"Date de consultation : {consultation_date}", style_subheading))
+    elements.append(Spacer(1, 6))
+
+    if clinical_signs:
+        elements.append(HistoryParagraph("<b>Signes Cliniques / Motifs de Consultation :</b>", style_normal))
+        elements.append(HistoryParagraph(clinical_signs, style_normal))
+
+    if bp or temperature or heart_rate or respiratory_rate:
+        elements.append(HistoryParagraph("<b>Paramètres Vitaux :</b>", style_normal))
+        vitals = []
+        if bp:
+            vitals.append(f"Tension Artérielle : {bp} mmHg")
+        if temperature:
+            vitals.append(f"Température : {temperature} °C")
+        if heart_rate:
+            vitals.append(f"Fréquence Cardiaque : {heart_rate} bpm")
+        if respiratory_rate:
+            vitals.append(f"Fréquence Respiratoire : {respiratory_rate} rpm")
+        vitals_text = '; '.join(vitals)
+        elements.append(HistoryParagraph(vitals_text, style_normal))
+
+    if diagnosis:
+        elements.append(HistoryParagraph(f"<b>Diagnostic :</b> {diagnosis}", style_normal))
+
+    if medications:
+        elements.append(HistoryParagraph("<b>Médicaments prescrits :</b>", style_normal))
+        meds_list = medications.split('; ')
+        for med in meds_list:
+            elements.append(HistoryParagraph(f"- {med}", style_normal))
+
+    if analyses:
+        elements.append(HistoryParagraph("<b>Analyses demandées :</b>", style_normal))
+        analyses_list = analyses.split('; ')
+        for analysis in analyses_list:
+            elements.append(HistoryParagraph(f"- {analysis}", style_normal))
+
+    if radiologies:
+        elements.append(HistoryParagraph("<b>Radiologies demandées :</b>", style_normal))
+        radiologies_list = radiologies.split('; ')
+        for radiology in radiologies_list:
+            elements.append(HistoryParagraph(f"- {radiology}", style_normal))
+
+    if certificate_category:
+        elements.append(HistoryParagraph(f"<b>Certificat médical :</b> {certificate_category}", style_normal))
+
+    if rest_duration:
+        elements.append(HistoryParagraph(f"<b>Durée du repos :</b> {rest_duration} jours", style_normal))
+
+    if doctor_comment.strip():
+        elements.append(HistoryParagraph("<b>Commentaire du médecin :</b>", style_normal))
+        elements.append(HistoryParagraph(doctor_comment, style_normal))
+
+    end_marker = Spacer(1, 12)
+    end_marker.end_of_consultation = True
+    elements.append(end_marker)
+    return elements
+
+def generate_history_pdf_file(pdf_path, df_filtered, progress=None):
+    # progress(consultations rendues, total) est appelé pendant la mise en page
     from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
     from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
     from reportlab.lib.pagesizes import A5
     import pandas as pd
 
+    pdf_buffer = io.BytesIO() if background_pdf_path() else None
     doc = SimpleDocTemplate(
-        pdf_path,
+        pdf_buffer if pdf_buffer is not None else pdf_path,
         pagesize=A5,
         rightMargin=56.7, leftMargin=56.7,
         topMargin=130, bottomMargin=56.7
     )
     elements = []
-    styles = getSampleStyleSheet()
-    style_heading = ParagraphStyle(
-        'CustomHeading',
-        parent=styles["Heading1"],
-        fontSize=styles["Heading1"].fontSize - 2,
-        alignment=TA_JUSTIFY,
-        leading=styles["Heading1"].leading - 2
-    )
-    style_normal = ParagraphStyle(
-        'JustifiedNormal',
-        parent=styles["Normal"],
-        fontSize=styles["Normal"].fontSize - 2,
-        alignment=TA_JUSTIFY
-    )
-    style_subheading = styles["Heading2"]
+    style_heading, style_normal, style_subheading = history_pdf_styles()
 
     if not df_filtered.empty:
         patient_row = df_filtered.iloc[0]
@@ -1139,103 +3316,206 @@ def generate_history_pdf_file(pdf_path, df_filtered):
         elements.append(Spacer(1, 12))
 
         for index, row in df_filtered.iterrows():
-            consultation_date = str(row['consultation_date'])
-            clinical_signs = str(row.get('clinical_signs', '')) if pd.notnull(row.get('clinical_signs', '')) else ''
-            bp = str(row.get('bp', '')) if pd.notnull(row.get('bp', '')) else ''
-            temperature = str(row.get('temperature', '')) if pd.notnull(row.get('temperature', '')) else ''
-            heart_rate = str(row.get('heart_rate', '')) if pd.notnull(row.get('heart_rate', '')) else ''
-            respiratory_rate = str(row.get('respiratory_rate', '')) if pd.notnull(row.get('respiratory_rate', '')) else ''
-            diagnosis = str(row.get('diagnosis', '')) if pd.notnull(row.get('diagnosis', '')) else ''
-            medications = str(row.get('medications', '')) if pd.notnull(row.get('medications', '')) else ''
-            analyses = str(row.get('analyses', '')) if pd.notnull(row.get('analyses', '')) else ''
-            radiologies = str(row.get('radiologies', '')) if pd.notnull(row.get('radiologies', '')) else ''
-            certificate_category = str(row.get('certificate_category', '')) if pd.notnull(row.get('certificate_category', '')) else ''
-            rest_duration = str(row.get('rest_duration', '')) if pd.notnull(row.get('rest_duration', '')) else ''
-            doctor_comment = str(row.get('doctor_comment', '')) if pd.notnull(row.get('doctor_comment', '')) else ''
-
-            elements.append(Paragraph(f"Date de consultation : {consultation_date}", style_subheading))
-            elements.append(Spacer(1, 6))
-
-            if clinical_signs:
-                elements.append(Paragraph("<b>Signes Cliniques / Motifs de Consultation :</b>", style_normal))
-                elements.append(Paragraph(clinical_signs, style_normal))
-
-            if bp or temperature or heart_rate or respiratory_rate:
-                elements.append(Paragraph("<b>Paramètres Vitaux :</b>", style_normal))
-                vitals = []
-                if bp:
-                    vitals.append(f"Tension Artérielle : {bp} mmHg")
-                if temperature:
-                    vitals.append(f"Température : {temperature} °C")
-                if heart_rate:
-                    vitals.append(f"Fréquence Cardiaque : {heart_rate} bpm")
-                if respiratory_rate:
-                    vitals.append(f"Fréquence Respiratoire : {respiratory_rate} rpm")
-                vitals_text = '; '.join(vitals)
-                elements.append(Paragraph(vitals_text, style_normal))
-
-            if diagnosis:
-                elements.append(Paragraph(f"<b>Diagnostic :</b> {diagnosis}", style_normal))
-
-            if medications:
-                elements.append(Paragraph("<b>Médicaments prescrits :</b>", style_normal))
-                meds_list = medications.split('; ')
-                for med in meds_list:
-                    elements.append(Paragraph(f"- {med}", style_normal))
-
-            if analyses:
-                elements.append(Paragraph("<b>Analyses demandées :</b>", style_normal))
-                analyses_list = analyses.split('; ')
-                for analysis in analyses_list:
-                    elements.append(Paragraph(f"- {analysis}", style_normal))
-
-            if radiologies:
-                elements.append(Paragraph("<b>Radiologies demandées :</b>", style_normal))
-                radiologies_list = radiologies.split('; ')
-                for radiology in radiologies_list:
-                    elements.append(Paragraph(f"- {radiology}", style_normal))
-
-            if certificate_category:
-                elements.append(Paragraph(f"<b>Certificat médical :</b> {certificate_category}", style_normal))
-
-            if rest_duration:
-                elements.append(Paragraph(f"<b>Durée du repos :</b> {rest_duration} jours", style_normal))
-
-            if doctor_comment.strip():
-                elements.append(Paragraph("<b>Commentaire du médecin :</b>", style_normal))
-                elements.append(Paragraph(doctor_comment, style_normal))
-
-            elements.append(Spacer(1, 12))
+            elements.extend(history_consultation_flowables(row, style_normal, style_subheading))
 
+    if progress is not None:
+        total = len(df_filtered)
+        rendered = [0]
+        progress(0, total)
+        def after_flowable(flowable):
+            if getattr(flowable, "end_of_consultation", False):
+                rendered[0] += 1
+                progress(rendered[0], total)
+        doc.afterFlowable = after_flowable
     doc.build(elements, onFirstPage=add_background_platypus, onLaterPages=add_background_platypus)
-    if background_file and background_file.lower().endswith('.pdf'):
-        try:
-            merge_with_background_pdf(pdf_path)
-        except Exception as e:
-            print(f"Erreur lors de la fusion avec l'arrière-plan PDF : {str(e)}")
+    if pdf_buffer is not None:
+        write_pdf_with_background(pdf_buffer, pdf_path)
     return
 
+def history_consultations(patient_id_filter, patient_name_filter):
+    if patient_id_filter:
+        return consultation_store().read_patient(patient_id_filter)
+    return consultation_store().read_patients(patient_registry.search.matching_ids(patient_name_filter))
+
 @app.route("/generate_history_pdf")
 def generate_history_pdf():
     patient_id_filter = request.args.get("patient_id_filter", "").strip()
     patient_name_filter = request.args.get("patient_name_filter", "").strip()
-    if not os.path.exists(EXCEL_FILE_PATH):
+    if not consultation_store().exists():
         flash("Aucune donnée de consultation n'a été trouvée.", "warning")
         return redirect(url_for("index"))
-    df = pd.read_excel(EXCEL_FILE_PATH, sheet_name=0)
-    if patient_id_filter:
-        df_filtered = df[df['patient_id'].astype(str) == patient_id_filter]
-    elif patient_name_filter:
-        df_filtered = df[df['patient_name'].astype(str).str.contains(patient_name_filter, case=False, na=False)]
-    else:
+    if not patient_id_filter and not patient_name_filter:
         flash("Veuillez sélectionner l'ID ou le nom du patient.", "warning")
         return redirect(url_for("index"))
+    df_filtered = history_consultations(patient_id_filter, patient_name_filter)
     if df_filtered.empty:
         flash("Aucune consultation trouvée pour ce patient.", "info")
         return redirect(url_for("index"))
-    pdf_path = os.path.join(PDF_FOLDER, f"Historique_{datetime.now().strftime('%Y%m%d%H%M%S')}.pdf")
-    generate_history_pdf_file(pdf_path, df_filtered)
-    return send_file(pdf_path, as_attachment=True)
+    return send_generated_pdf("Historique", lambda destination: generate_history_pdf_file(destination, df_filtered))
+
+# -----------------------------------------------------------------------------
+# Historiques PDF en tâche de fond : file de travaux bornée, dédupliquée par patient,
+# avec suivi de progression et téléchargement du résultat. L'état de chaque travail
+# (<job_id>.json) et son résultat (<job_id>.pdf) sont écrits dans PDF_FOLDER/jobs : le
+# suivi et le téléchargement répondent quel que soit le worker gunicorn interrogé
+# -----------------------------------------------------------------------------
+HISTORY_PDF_WORKERS = int(load_config().get("history_pdf_workers", 2))
+HISTORY_JOB_TTL = 3600  # secondes de conservation d'un travail terminé (ou abandonné)
+HISTORY_JOB_SAVE_INTERVAL = 0.5  # écriture de la progression au plus toutes les 0,5 s
+_history_pdf_executor = ThreadPoolExecutor(max_workers=HISTORY_PDF_WORKERS, thread_name_prefix="history-pdf")
+_history_jobs = {}  # travaux lancés par ce processus, suivis sans relire le disque
+_history_jobs_lock = threading.Lock()
+
+def history_jobs_folder():
+    folder = os.path.join(PDF_FOLDER, "jobs")
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+def history_job_path(job_id, ext):
+    return os.path.join(history_jobs_folder(), f"{job_id}.{ext}")
+
+class HistoryPdfJob:
+    __slots__ = ("job_id", "key", "status", "done", "total", "filename", "error", "finished_at", "saved_at")
+
+    def __init__(self, key):
+        self.job_id = uuid.uuid4().hex
+        self.key = list(key)
+        self.status = "en_attente"
+        self.done = 0
+        self.total = 0
+        self.filename = pdf_filename("Historique")
+        self.error = None
+        self.finished_at = None
+        self.saved_at = 0.0
+
+    def state(self):
+        return {"job_id": self.job_id, "key": self.key, "status": self.status, "done": self.done,
+                "total": self.total, "filename": self.filename, "error": self.error,
+                "finished_at": self.finished_at, "updated_at": time.time()}
+
+    def save(self):
+        path = history_job_path(self.job_id, "json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.state(), f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+        self.saved_at = time.monotonic()
+
+def load_history_job(job_id):
+    if not re.fullmatch(r"[0-9a-f]{32}", job_id):
+        return None
+    job = _history_jobs.get(job_id)
+    if job is not None:
+        return job.state()
+    try:
+        with open(history_job_path(job_id, "json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def history_job_response(state):
+    return {
+        "job_id": state["job_id"],
+        "status": state["status"],
+        "done": state["done"],
+        "total": state["total"],
+        "error": state["error"],
+        "download_url": url_for("download_history_pdf_job", job_id=state["job_id"]) if state["status"] == "termine" else None,
+    }
+
+def history_job_expired(state, now):
+    # Travail terminé depuis plus de HISTORY_JOB_TTL, ou resté inachevé aussi longtemps
+    # (worker arrêté pendant le rendu)
+    return now - (state.get("finished_at") or state.get("updated_at") or 0) > HISTORY_JOB_TTL
+
+# Appelée sous le verrou de fichier du dossier : parcourt les travaux de tous les workers,
+# retire les travaux expirés et renvoie le travail en cours pour key s'il existe
+def _scan_history_jobs(key):
+    folder, now, current = history_jobs_folder(), time.time(), None
+    for name in os.listdir(folder):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(folder, name), "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if history_job_expired(state, now):
+            for ext in ("json", "pdf"):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(history_job_path(state["job_id"], ext))
+            _history_jobs.pop(state["job_id"], None)
+        elif state["key"] == list(key) and state["finished_at"] is None:
+            current = state
+    return current
+
+def run_history_pdf_job(job, patient_id_filter, patient_name_filter):
+    def progress(done, total):
+        job.done, job.total = done, total
+        if time.monotonic() - job.saved_at >= HISTORY_JOB_SAVE_INTERVAL:
+            job.save()
+    try:
+        job.status = "en_cours"
+        job.save()
+        df_filtered = history_consultations(patient_id_filter, patient_name_filter)
+        if df_filtered.empty:
+            raise ValueError("Aucune consultation trouvée pour ce patient.")
+        pdf_path = history_job_path(job.job_id, "pdf")
+        generate_history_pdf_file(pdf_path + ".tmp", df_filtered, progress=progress)
+        os.replace(pdf_path + ".tmp", pdf_path)
+        job.status = "termine"
+    except Exception as e:
+        job.error = str(e)
+        job.status = "erreur"
+    finally:
+        job.finished_at = time.time()
+        try:
+            job.save()
+        except OSError as e:
+            print(f"Erreur lors de l'enregistrement du travail {job.job_id} : {e}")
+        with _history_jobs_lock:
+            _history_jobs.pop(job.job_id, None)
+
+@app.route("/history_pdf_jobs", methods=["POST"])
+def submit_history_pdf_job():
+    patient_id_filter = request.values.get("patient_id_filter", "").strip()
+    patient_name_filter = request.values.get("patient_name_filter", "").strip()
+    if not patient_id_filter and not patient_name_filter:
+        return jsonify({"error": "Veuillez sélectionner l'ID ou le nom du patient."}), 400
+    if not consultation_store().exists():
+        return jsonify({"error": "Aucune donnée de consultation n'a été trouvée."}), 404
+    key = (patient_id_filter, fold_text(patient_name_filter) if not patient_id_filter else "")
+    with _history_jobs_lock, FileLock(os.path.join(history_jobs_folder(), "jobs.lock"), timeout=CONSULTATION_LOCK_TIMEOUT):
+        # Même historique déjà demandé et pas encore terminé (dans n'importe quel worker) :
+        # on renvoie le travail existant
+        state = _scan_history_jobs(key)
+        if state is None:
+            job = HistoryPdfJob(key)
+            job.save()
+            _history_jobs[job.job_id] = job
+            _history_pdf_executor.submit(run_history_pdf_job, job, patient_id_filter, patient_name_filter)
+            state = job.state()
+        return jsonify(history_job_response(state)), 202
+
+@app.route("/history_pdf_jobs/<job_id>")
+def history_pdf_job_status(job_id):
+    state = load_history_job(job_id)
+    if state is None:
+        return jsonify({"error": "Travail introuvable."}), 404
+    return jsonify(history_job_response(state))
+
+@app.route("/history_pdf_jobs/<job_id>/download")
+def download_history_pdf_job(job_id):
+    state = load_history_job(job_id)
+    if state is None or state["status"] != "termine":
+        return jsonify({"error": "Historique non disponible."}), 404
+    try:
+        with open(history_job_path(job_id, "pdf"), "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return jsonify({"error": "Historique non disponible."}), 404
+    if PDF_ARCHIVE:
+        _pdf_archive_executor.submit(archive_pdf, state["filename"], data)
+    return send_file(io.BytesIO(data), mimetype="application/pdf", as_attachment=True, download_name=state["filename"])
 
 # --- Modification pour les importations via AJAX ---
 @app.route("/import_excel", methods=["POST"])
@@ -1249,7 +3529,8 @@ def import_excel():
     file_path = os.path.join(EXCEL_FOLDER, filename)
     file.save(file_path)
     try:
-        df = pd.read_excel(file_path)
+        wanted = {"medications", "analyses", "radiologies", *PATIENT_COLUMNS}
+        df = pd.read_excel(file_path, usecols=lambda col: str(col).lower() in wanted)
         df.columns = [col.lower() for col in df.columns]
         global default_medications_options, default_analyses_options, default_radiologies_options
         if 'medications' in df.columns:
@@ -1258,24 +3539,8 @@ def import_excel():
             default_analyses_options.extend(df['analyses'].dropna().tolist())
         if 'radiologies' in df.columns:
             default_radiologies_options.extend(df['radiologies'].dropna().tolist())
-        if all(x in df.columns for x in ['patient_name', 'patient_id', 'age', 'patient_phone', 'antecedents', 'date_of_birth', 'gender']):
-            global patient_ids, patient_names, patient_id_to_name, patient_name_to_id, patient_name_to_age, patient_id_to_age, patient_name_to_phone, patient_id_to_phone, patient_name_to_antecedents, patient_id_to_antecedents, patient_name_to_dob, patient_id_to_dob, patient_name_to_gender, patient_id_to_gender
-            patient_ids.extend(df['patient_id'].astype(str).tolist())
-            patient_names.extend(df['patient_name'].astype(str).tolist())
-            patient_ids = sorted(set(patient_ids), key=str.lower)
-            patient_names = sorted(set(patient_names), key=str.lower)
-            patient_id_to_name.update(dict(zip(df['patient_id'].astype(str), df['patient_name'].astype(str))))
-            patient_name_to_id.update(dict(zip(df['patient_name'].astype(str), df['patient_id'].astype(str))))
-            patient_name_to_age.update(dict(zip(df['patient_name'], df['age'])))
-            patient_id_to_age.update(dict(zip(df['patient_id'], df['age'])))
-            patient_name_to_phone.update(dict(zip(df['patient_name'], df['patient_phone'])))
-            patient_id_to_phone.update(dict(zip(df['patient_id'], df['patient_phone'])))
-            patient_name_to_antecedents.update(dict(zip(df['patient_name'], df['antecedents'])))
-            patient_id_to_antecedents.update(dict(zip(df['patient_id'], df['antecedents'])))
-            patient_name_to_dob.update(dict(zip(df['patient_name'], df['date_of_birth'].astype(str))))
-            patient_id_to_dob.update(dict(zip(df['patient_id'], df['date_of_birth'].astype(str))))
-            patient_name_to_gender.update(dict(zip(df['patient_name'], df['gender'].astype(str))))
-            patient_id_to_gender.update(dict(zip(df['patient_id'], df['gender'].astype(str))))
+        if set(PATIENT_COLUMNS).issubset(df.columns):
+            patient_registry.update_from_frame(df)
         default_medications_options = list(set(default_medications_options))
         default_analyses_options = list(set(default_analyses_options))
         default_radiologies_options = list(set(default_radiologies_options))
@@ -1288,6 +3553,54 @@ def import_excel():
     except Exception as e:
         return jsonify({"status": "error", "message": f"Erreur lors de l'importation des données : {str(e)}"})
 
+# -----------------------------------------------------------------------------
+# Normalisation des arrière-plans image à l'import : résolution ramenée à BACKGROUND_DPI
+# pour une page A5, transparence aplatie sur fond blanc, format JPEG ou PNG selon l'image
+# -----------------------------------------------------------------------------
+BACKGROUND_DPI = int(load_config().get("background_dpi", 150))
+
+def normalized_background_path(path, dpi):
+    root, _ = os.path.splitext(path)
+    return f"{root}.{dpi}dpi"
+
+def normalize_background_image(path, dpi=None):
+    # Renvoie le chemin de la variante traitée (mise en cache à côté de l'original), ou
+    # celui de l'original si la variante n'est pas plus petite
+    dpi = BACKGROUND_DPI if dpi is None else dpi
+    if dpi <= 0:
+        return path
+    base = normalized_background_path(path, dpi)
+    for ext in (".jpg", ".png"):
+        cached = base + ext
+        if os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(path):
+            return cached
+    with Image.open(path) as im:
+        im.load()
+        # Transparence aplatie sur blanc : identique au rendu sur la page blanche du PDF
+        if im.mode in ("RGBA", "LA") or (im.mode == "P" and "transparency" in im.info):
+            im = im.convert("RGBA")
+            flat = Image.new("RGB", im.size, (255, 255, 255))
+            flat.paste(im, mask=im.getchannel("A"))
+            im = flat
+        elif im.mode != "RGB":
+            im = im.convert("RGB")
+        target = (round(A5[0] / 72 * dpi), round(A5[1] / 72 * dpi))
+        if im.width > target[0] or im.height > target[1]:
+            # L'image est étirée sur toute la page A5 : on ne garde que les pixels utiles
+            im = im.resize(target, Image.LANCZOS)
+        # Peu de couleurs (en-tête, logos) : PNG sans perte ; sinon (scan, photo) : JPEG
+        if im.getcolors(256) is not None:
+            output = base + ".png"
+            im.save(output, "PNG", optimize=True)
+        else:
+            output = base + ".jpg"
+            im.save(output, "JPEG", quality=90, optimize=True, dpi=(dpi, dpi))
+    # Image déjà compacte (JPEG réencodé, petite image) : l'original est conservé
+    if os.path.getsize(output) >= os.path.getsize(path):
+        os.remove(output)
+        return path
+    return output
+
 @app.route("/import_background", methods=["POST"])
 def import_background():
     if 'background_file' not in request.files:
@@ -1306,25 +3619,47 @@ def import_background():
         bg_type = None
     if bg_type:
         global background_file
+        message = f"L'arrière-plan a été importé depuis : {file_path}"
+        if bg_type == 'image':
+            try:
+                start = time.perf_counter()
+                processed_path = normalize_background_image(file_path)
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                if processed_path != file_path:
+                    original_size = os.path.getsize(file_path)
+                    processed_size = os.path.getsize(processed_path)
+                    message += (f". Image optimisée ({BACKGROUND_DPI} DPI, {elapsed_ms:.0f} ms) : "
+                                f"{original_size / 1024:.0f} Ko → {processed_size / 1024:.0f} Ko")
+                    file_path = processed_path
+            except Exception as e:
+                print(f"Erreur lors de l'optimisation de l'arrière-plan : {str(e)}")
         background_file = file_path
         current_config = load_config()
         current_config['background_file_path'] = background_file
         save_config(current_config)
-        return jsonify({"status": "success", "message": f"L'arrière-plan a été importé depuis : {file_path}"})
+        return jsonify({"status": "success", "message": message})
     else:
         return jsonify({"status": "warning", "message": "Format de fichier non supporté. Veuillez sélectionner une image ou un PDF."})
 
 @app.route("/update_comment", methods=["POST"])
 def update_comment():
     patient_id = request.form.get("suivi_patient_id", "").strip()
+    consultation_id = request.form.get("consultation_id", "").strip()
     new_comment = request.form.get("new_doctor_comment", "").strip()
+    if consultation_id:
+         # Mise à jour ciblée d'une seule consultation (appel AJAX)
+         try:
+             submit_consultation_mutation("consultation_comment", consultation_id, new_comment)
+             return "OK", 200
+         except Timeout:
+             return CONSULTATION_BUSY_MESSAGE, 503
+         except Exception as e:
+             return str(e), 500
     if not patient_id:
          flash("Veuillez entrer l'ID du patient.", "warning")
          return redirect(url_for("index"))
-    if os.path.exists(EXCEL_FILE_PATH):
-         df = pd.read_excel(EXCEL_FILE_PATH, sheet_name=0)
-         df.loc[df['patient_id'].astype(str)==patient_id, 'doctor_comment'] = new_comment
-         df.to_excel(EXCEL_FILE_PATH, index=False)
+    if consultation_store().exists():
+         submit_consultation_mutation("comment", patient_id, new_comment)
          flash("Commentaire mis à jour.", "success")
     else:
          flash("Fichier de données non trouvé.", "error")
@@ -1333,6 +3668,7 @@ def update_comment():
 @app.route("/settings", methods=["GET", "POST"])
 def settings():
     global default_medications_options, default_analyses_options, default_radiologies_options
+    global BASE_DIR, EXCEL_FOLDER, PDF_FOLDER, CONFIG_FOLDER, BACKGROUND_FOLDER, CONFIG_FILE, EXCEL_FILE_PATH, JOURNAL_FILE_PATH, SQLITE_FILE_PATH, TOMBSTONE_FILE_PATH, PATCH_FILE_PATH, SNAPSHOT_FILE_PATH, DEADLETTER_FILE_PATH
     current_config = load_config()
     if request.method == "POST":
         current_config['nom_clinique'] = request.form.get("nom_clinique", "")
@@ -1342,12 +3678,18 @@ def settings():
         current_config['location'] = request.form.get("lieu", "")
         current_config['theme'] = request.form.get("theme", current_config.get("theme", "Default"))
         current_config['background_file_path'] = request.form.get("arriere_plan", "")
+        switch_consultation_storage(request.form.get("consultation_storage", consultation_storage_mode()))
+        current_config['consultation_storage'] = consultation_storage_mode()
         # Nouveau champ pour le chemin de stockage personnalisé
         storage_path = request.form.get("storage_path", "").strip()
         if storage_path:
             current_config['storage_path'] = storage_path
+            storage_changed = os.path.abspath(storage_path) != os.path.abspath(BASE_DIR)
+            if storage_changed:
+                # Les consultations en attente (file d'écriture, journal, base SQLite) sont exportées dans l'ancien classeur
+                flush_consultation_writes()
+                consultation_store().materialize()
             # Mise à jour globale du chemin de stockage et des dossiers associés
-            global BASE_DIR, EXCEL_FOLDER, PDF_FOLDER, CONFIG_FOLDER, BACKGROUND_FOLDER, CONFIG_FILE, EXCEL_FILE_PATH
             BASE_DIR = storage_path
             os.makedirs(BASE_DIR, exist_ok=True)
             EXCEL_FOLDER = os.path.join(BASE_DIR, "Excel")
@@ -1360,6 +3702,17 @@ def settings():
             os.makedirs(BACKGROUND_FOLDER, exist_ok=True)
             CONFIG_FILE = os.path.join(CONFIG_FOLDER, "config.json")
             EXCEL_FILE_PATH = os.path.join(EXCEL_FOLDER, "ConsultationData.xlsx")
+            JOURNAL_FILE_PATH = os.path.join(EXCEL_FOLDER, "ConsultationData.journal.jsonl")
+            SQLITE_FILE_PATH = os.path.join(EXCEL_FOLDER, "ConsultationData.sqlite3")
+            TOMBSTONE_FILE_PATH = os.path.join(EXCEL_FOLDER, "ConsultationData.tombstones.jsonl")
+            PATCH_FILE_PATH = os.path.join(EXCEL_FOLDER, "ConsultationData.patches.jsonl")
+            SNAPSHOT_FILE_PATH = os.path.join(EXCEL_FOLDER, "ConsultationData.snapshot.pkl")
+            DEADLETTER_FILE_PATH = os.path.join(EXCEL_FOLDER, "ConsultationData.deadletter.jsonl")
+            if storage_changed:
+                if consultation_storage_mode() == "sqlite":
+                    CONSULTATION_STORES["sqlite"].ensure_migrated()
+                # Nouveau dossier de données : reconstruction complète du registre des patients
+                load_patient_data()
             # Sauvegarde dans le fichier de configuration de stockage
             try:
                 with open(STORAGE_CONFIG_FILE, "w", encoding="utf-8") as f:
@@ -1376,7 +3729,7 @@ def settings():
         flash("Paramètres mis à jour avec succès.", "success")
         return redirect(url_for("index"))
     else:
-        return render_template_string(settings_template, config=current_config)
+        return render_template("settings.html", config=current_config)
 
 # -----------------------------------------------------------------------------
 # Templates HTML
@@ -1545,7 +3898,6 @@ main_template = """
       window.medicationCount = 1;
       window.analysisCount = 1;
       window.radiologyCount = 1;
-      console.log("Patient data:", patientData);
     });
     function updateListNumbers(listboxId) {
       var listbox = document.getElementById(listboxId);
@@ -1612,32 +3964,74 @@ main_template = """
       updateListNumbers("radiologies_listbox");
       window.radiologyCount = listbox.options.length + 1;
     }
-    var patientData = {{ patient_data|tojson }};
+    // Saisie semi-automatique des patients : les suggestions et la fiche sont chargées à la demande
+    function attachPatientTypeahead(inputId, datalistId, field) {
+      var input = document.getElementById(inputId);
+      var datalist = document.getElementById(datalistId);
+      var timer = null;
+      var lastQuery = null;
+      input.addEventListener("input", function() {
+        var q = this.value.trim();
+        clearTimeout(timer);
+        timer = setTimeout(function() {
+          if (q === lastQuery) { return; }
+          lastQuery = q;
+          if (!q) { datalist.innerHTML = ""; return; }
+          fetch("/suggest_patients?field=" + field + "&q=" + encodeURIComponent(q))
+          .then(response => response.json())
+          .then(values => {
+            if (q !== lastQuery) { return; }
+            datalist.innerHTML = "";
+            values.forEach(function(value) {
+              var option = document.createElement("option");
+              option.value = value;
+              datalist.appendChild(option);
+            });
+          })
+          .catch(error => { console.error("Erreur lors de la recherche des patients :", error); });
+        }, 150);
+      });
+    }
+    function fetchPatient(params) {
+      return fetch("/get_patient?" + new URLSearchParams(params).toString()).then(response => response.json());
+    }
     document.addEventListener("DOMContentLoaded", function(){
+      attachPatientTypeahead("patient_id", "patient_ids", "id");
+      attachPatientTypeahead("patient_name", "patient_names", "name");
+      attachPatientTypeahead("suivi_patient_id", "suivi_patient_ids", "id");
+      attachPatientTypeahead("suivi_patient_name", "suivi_patient_names", "name");
       document.getElementById("suivi_patient_id").addEventListener("change", function() {
          var id = this.value.trim();
-         if(patientData[id]){
-            document.getElementById("suivi_patient_name").value = patientData[id].name;
-         } else {
+         if (!id) {
             document.getElementById("suivi_patient_name").value = "";
+            $('#consultationsTable').DataTable().ajax.reload();
+            return;
          }
+         fetchPatient({patient_id: id}).then(patient => {
+            document.getElementById("suivi_patient_name").value = patient.name || "";
+         });
          $('#consultationsTable').DataTable().ajax.reload();
       });
     });
     document.addEventListener("DOMContentLoaded", function(){
       document.getElementById("patient_id").addEventListener("change", function() {
          var id = this.value.trim();
-         console.log("Patient ID modifié:", id);
-         if(patientData[id]){
-            document.getElementById("patient_name").value = patientData[id].name;
-            document.getElementById("patient_age").value = patientData[id].age;
-            document.getElementById("patient_phone").value = patientData[id].phone;
-            document.getElementById("antecedents").value = patientData[id].antecedents;
-            document.getElementById("date_of_birth").value = patientData[id].date_of_birth;
-            document.getElementById("gender").value = patientData[id].gender;
-            document.getElementById("suivi_patient_id").value = id;
-            document.getElementById("suivi_patient_name").value = patientData[id].name;
-         } else { console.log("Aucune donnée trouvée pour cet ID:", id); }
+         if(id){
+              fetchPatient({patient_id: id})
+              .then(patient => {
+                  if(patient.name !== undefined){
+                      document.getElementById("patient_name").value = patient.name;
+                      document.getElementById("patient_age").value = patient.age;
+                      document.getElementById("patient_phone").value = patient.phone;
+                      document.getElementById("antecedents").value = patient.antecedents;
+                      document.getElementById("date_of_birth").value = patient.date_of_birth;
+                      document.getElementById("gender").value = patient.gender;
+                      document.getElementById("suivi_patient_id").value = id;
+                      document.getElementById("suivi_patient_name").value = patient.name;
+                  } else { console.log("Aucune donnée trouvée pour cet ID:", id); }
+              })
+              .catch(error => { console.error("Erreur lors de la récupération du patient :", error); });
+         }
          if(id){
               fetch("/get_last_consultation?patient_id=" + id)
               .then(response => response.json())
@@ -1732,8 +4126,32 @@ main_template = """
        var params = new URLSearchParams();
        if (id) { params.set("patient_id_filter", id); }
        if (name) { params.set("patient_name_filter", name); }
-       var url = "{{ url_for('generate_history_pdf') }}" + "?" + params.toString();
-       window.open(url, "_blank");
+       // Génération en tâche de fond : suivi de la progression puis téléchargement
+       fetch("{{ url_for('submit_history_pdf_job') }}", { method: "POST", body: params })
+         .then(function(r) { return r.json(); })
+         .then(function(job) {
+           if (job.error) {
+             Swal.fire({ icon: 'info', title: 'Historique', text: job.error });
+             return;
+           }
+           Swal.fire({ title: 'Génération de l\'historique…', html: 'Préparation…', allowOutsideClick: false, didOpen: function() { Swal.showLoading(); } });
+           var poll = function() {
+             fetch("{{ url_for('history_pdf_job_status', job_id='JOB') }}".replace("JOB", job.job_id))
+               .then(function(r) { return r.json(); })
+               .then(function(state) {
+                 if (state.status === "termine") {
+                   Swal.close();
+                   window.location.href = state.download_url;
+                 } else if (state.status === "erreur") {
+                   Swal.fire({ icon: 'error', title: 'Historique', text: state.error });
+                 } else {
+                   Swal.getHtmlContainer().textContent = state.total ? (state.done + " / " + state.total + " consultations") : "Préparation…";
+                   setTimeout(poll, 500);
+                 }
+               });
+           };
+           poll();
+         });
     }
     function generatePDF() {
       const doctor_name = document.getElementById("doctor_name").value;
@@ -1785,12 +4203,13 @@ main_template = """
     }
     $(document).ready(function(){
       var table = $('#consultationsTable').DataTable({
+         serverSide: true,
+         processing: true,
          ajax: {
            url: "/get_consultations",
            data: function(d) {
              d.patient_id = $('#suivi_patient_id').val();
-           },
-           dataSrc: ''
+           }
          },
          columns: [
            { data: "consultation_date" },
@@ -1816,6 +4235,8 @@ main_template = """
            { data: "doctor_comment" },
            { 
              data: "consultation_id",
+             orderable: false,
+             searchable: false,
              render: function(data, type, row, meta) {
                 return '<button class="btn btn-sm btn-danger delete-btn" data-id="'+data+'">Supprimer</button>';
              }
@@ -1831,7 +4252,17 @@ main_template = """
              method: 'POST',
              data: { consultation_id: consultationId },
              success: function(response){
-                table.ajax.reload();
+                table.ajax.reload(null, false);
+                Swal.fire({
+                  toast: true, position: 'bottom-end', icon: 'success', timer: 8000, timerProgressBar: true,
+                  title: 'Consultation supprimée', showConfirmButton: true, confirmButtonText: 'Annuler'
+                }).then(function(result){
+                  if(result.isConfirmed){
+                    $.post('/restore_consultation', { consultation_id: consultationId })
+                      .done(function(){ table.ajax.reload(null, false); })
+                      .fail(function(xhr){ alert(xhr.responseText || "Erreur lors de la restauration"); });
+                  }
+                });
              },
              error: function(err){
                 alert("Erreur lors de la suppression");
@@ -1965,22 +4396,14 @@ main_template = """
               <label for="patient_id" class="col-sm-3 col-form-label">ID du Patient :</label>
               <div class="col-sm-9">
                 <input type="text" class="form-control" name="patient_id" id="patient_id" list="patient_ids" value="{{ request.form.get('patient_id', request.args.get('patient_id_filter', '')) }}">
-                <datalist id="patient_ids">
-                  {% for pid in patient_ids %}
-                  <option value="{{ pid }}"></option>
-                  {% endfor %}
-                </datalist>
+                <datalist id="patient_ids"></datalist>
               </div>
             </div>
             <div class="mb-3 row">
               <label for="patient_name" class="col-sm-3 col-form-label">Nom du Patient :</label>
               <div class="col-sm-9">
                 <input type="text" class="form-control" name="patient_name" id="patient_name" list="patient_names" value="{{ request.form.get('patient_name', '') }}">
-                <datalist id="patient_names">
-                  {% for pname in patient_names %}
-                  <option value="{{ pname }}"></option>
-                  {% endfor %}
-                </datalist>
+                <datalist id="patient_names"></datalist>
               </div>
             </div>
             <div class="mb-3 row">
@@ -2147,23 +4570,15 @@ main_template = """
             <div class="mb-3 row">
               <label for="suivi_patient_id" class="col-sm-3 col-form-label">ID du Patient :</label>
               <div class="col-sm-9">
-                <input type="text" class="form-control" id="suivi_patient_id" name="suivi_patient_id" list="patient_ids" value="{{ request.args.get('patient_id_filter', '') }}">
-                <datalist id="patient_ids">
-                  {% for pid in patient_ids %}
-                  <option value="{{ pid }}"></option>
-                  {% endfor %}
-                </datalist>
+                <input type="text" class="form-control" id="suivi_patient_id" name="suivi_patient_id" list="suivi_patient_ids" value="{{ request.args.get('patient_id_filter', '') }}">
+                <datalist id="suivi_patient_ids"></datalist>
               </div>
             </div>
             <div class="mb-3 row">
               <label for="suivi_patient_name" class="col-sm-3 col-form-label">Nom du Patient :</label>
               <div class="col-sm-9">
-                <input type="text" class="form-control" id="suivi_patient_name" name="suivi_patient_name" list="patient_names" value="{{ request.args.get('patient_name_filter', '') }}">
-                <datalist id="patient_names">
-                  {% for pname in patient_names %}
-                  <option value="{{ pname }}"></option>
-                  {% endfor %}
-                </datalist>
+                <input type="text" class="form-control" id="suivi_patient_name" name="suivi_patient_name" list="suivi_patient_names" value="{{ request.args.get('patient_name_filter', '') }}">
+                <datalist id="suivi_patient_names"></datalist>
               </div>
             </div>
             <div class="table-responsive">
@@ -2390,6 +4805,14 @@ settings_template = """
       <label for="arriere_plan" class="form-label">Arrière-plan (URL ou chemin) :</label>
       <input type="text" class="form-control" name="arriere_plan" id="arriere_plan" value="{{ config.background_file_path or '' }}">
     </div>
+    <div class="mb-3">
+      <label for="consultation_storage" class="form-label">Stockage des consultations :</label>
+      <select class="form-select" name="consultation_storage" id="consultation_storage">
+        <option value="excel" {% if config.consultation_storage not in ('journal', 'sqlite') %}selected{% endif %}>Classeur Excel</option>
+        <option value="journal" {% if config.consultation_storage == 'journal' %}selected{% endif %}>Journal (enregistrement rapide)</option>
+        <option value="sqlite" {% if config.consultation_storage == 'sqlite' %}selected{% endif %}>Base SQLite indexée</option>
+      </select>
+    </div>
     <div class="mb-3">
       <label for="liste_medicaments" class="form-label">Liste des Médicaments :</label>
       <textarea class="form-control" name="liste_medicaments" id="liste_medicaments" rows="5">{% if config.medications_options %}{{ config.medications_options | join('\n') }}{% endif %}</textarea>
@@ -2409,6 +4832,31 @@ settings_template = """
 </body>
 </html>
 """
+# -----------------------------------------------------------------------------
+# Gabarits précompilés : chargés par nom et compilés une seule fois au démarrage
+# -----------------------------------------------------------------------------
+app.jinja_env.loader = ChoiceLoader([
+    DictLoader({
+        "main.html": main_template,
+        "alert.html": alert_template,
+        "admin.html": admin_template,
+        "settings.html": settings_template,
+        "activation.html": activation_template,
+        "trial_expired.html": trial_expired_template,
+    }),
+    app.jinja_env.loader,
+])
+if not PDF_RENDER_WORKER:
+    for _template_name in app.jinja_env.loader.loaders[0].list_templates():
+        app.jinja_env.get_template(_template_name)
+
+def stream_page(template_name, **context):
+    # Rendu en flux : le navigateur reçoit l'en-tête (CSS/JS) avant la fin du rendu de la page
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(64)
+    return app.response_class(stream_with_context(stream), mimetype="text/html")
+
 @app.route("/download_app")
 def download_app():
     file_path = os.path.join(BASE_DIR, "MedicSastouka.rar")